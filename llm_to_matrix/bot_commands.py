@@ -1,23 +1,37 @@
-import logging
-import requests
+import asyncio
 import json
-from urllib.parse import urljoin
+import logging
 from nio import AsyncClient, MatrixRoom, RoomMessageText
 from llm_to_matrix.conversation_store import ConversationStore, MessageType, Role
-from llm_to_matrix.helper import prepare_msg, validate_url
+from llm_to_matrix.helper import CHARS_PER_TOKEN, prepare_msg, split_into_chunks, validate_url
+from llm_to_matrix.parser.fetcher import PageFetcher
 from llm_to_matrix.parser.parser import get_main_content
 # from llm_to_matrix.storage import Storage
 from llm_to_matrix.config import Config
-from llm_to_matrix.chat_functions import react_to_event, send_text_to_room, send_typing_to_room
+from llm_to_matrix.context import ContextBuilder
+from llm_to_matrix.errors import LLMError
+from llm_to_matrix.lanes import Lane
+from llm_to_matrix.llm_client import LLMClient
+from llm_to_matrix.rendering import append_footer
+from llm_to_matrix.chat_functions import StreamingReply, react_to_event, send_text_to_room, typing_in_room
 
 logger = logging.getLogger()
 
+# The models used by the `code` and `li` commands
+CODE_MODEL = "deepseek-coder-6.7b-instruct:latest"
+SUMMARY_MODEL = "mistral-7b-instruct:latest"
+
+SUMMARY_PROMPT = "Please provide a brief summary of the following content, ensuring to use the same language as the original. Keep the summary concise.\n\n---\n{content}\n---\nEnd of content."
+COMBINE_PROMPT = "The following are summaries of consecutive parts of one text. Please combine them into one brief summary, ensuring to use the same language as the original. Keep the summary concise.\n\n---\n{content}\n---\nEnd of content."
+
 class Command:
     def __init__(
         self,
         client: AsyncClient,
         store: ConversationStore,
         config: Config,
+        llm: LLMClient,
+        fetcher: PageFetcher,
         command: str,
         room: MatrixRoom,
         event: RoomMessageText,
@@ -31,6 +45,10 @@ class Command:
 
             config: Bot configuration parameters.
 
+            llm: The shared client used to talk to the LLM backend.
+
+            fetcher: The shared fetcher for web pages.
+
             command: The command and arguments.
 
             room: The room the command was sent in.
@@ -40,13 +58,77 @@ class Command:
         self.client = client
         self.store = store
         self.config = config
+        self.llm = llm
+        self.fetcher = fetcher
         self.command = command
         self.room = room
         self.event = event
         self.args = self.command.split()[1:]
 
+        self.context = ContextBuilder(
+            store,
+            config.llm_param_num_ctx,
+            config.llm_param_num_predict,
+            config.llm_history_turns,
+        )
+
+        # Our hold on the room's typing indicator, while the command is worked on
+        self._typing = None
+
+        # `--fresh` anywhere in a generation command skips the response cache. Other
+        # commands keep it as an ordinary argument.
+        self.bypass_cache = self.lane == Lane.GENERATION and "--fresh" in self.args
+        if self.bypass_cache:
+            self.args = [arg for arg in self.args if arg != "--fresh"]
+
+    @property
+    def lane(self) -> Lane:
+        """The lane this command is processed in, see `CommandLanes`"""
+        if self.command.startswith(("echo", "react", "help")):
+            return Lane.INSTANT
+        elif self.command.startswith("ls"):
+            return Lane.METADATA
+        return Lane.GENERATION
+
+    @property
+    def model(self):
+        """The model the command will use, if it uses one"""
+        if self.lane != Lane.GENERATION:
+            return None
+        if self.command.startswith("code"):
+            return CODE_MODEL
+        if self.command.startswith("li"):
+            return SUMMARY_MODEL
+        if self.command.startswith("cm"):
+            model_info = self.llm.catalog.get(self.args[0]) if self.args else None
+            return model_info.name if model_info is not None else None
+        return self.config.llm_model
+
+    def warm_up(self):
+        """Start loading the command's model on the backend, if it isn't loaded"""
+        self.llm.warmer.warm(self.model)
+
     async def process(self):
         """Process the command"""
+        try:
+            await self._process()
+        finally:
+            self._stop_typing()
+
+    def _show_typing(self):
+        """Show that we are typing in the room, until `_stop_typing`"""
+        if self._typing is None:
+            self._typing = typing_in_room(self.client, self.room.room_id)
+
+    def _stop_typing(self):
+        """Let go of the typing indicator. It stays up while other commands in the
+        room hold it.
+        """
+        if self._typing is not None:
+            self._typing.release()
+            self._typing = None
+
+    async def _process(self):
         if self.command.startswith("echo"):
             await self._echo()
         elif self.command.startswith("react"):
@@ -67,32 +149,43 @@ class Command:
 
     async def _query_for_code(self):
         """Make the bot forward the query to llm for code generation and wait for an answer"""
-        model = "deepseek-coder-6.7b-instruct:latest"
+        model = await self._resolve_model(CODE_MODEL)
+        if model is None:
+            return
         message = " ".join(self.args[0::]).strip()
         prompt = f"Please generate a short and accurate code snippet based on the following specifications. The code should be precise, efficient, and adhere closely to the requirements. Ensure the solution is concise and to the point.\n{message}"
         logger.info(self.event.event_id)
-        self.store.add_message(message, self.event.sender, Role.USER, MessageType.CODE, None, prompt, self.event.event_id)
+        await self.store.add_message(message, self.event.sender, Role.USER, MessageType.CODE, None, prompt, self.event.event_id)
         await self.send_llm_message(model=model, message=prompt, messageType=MessageType.CODE, event_id=self.event.event_id)
 
     async def _query_for_available_llms(self):
-        await send_typing_to_room(self.client, self.room.room_id, True)
+        # Answered from the catalog, which is refreshed in the background
         try:
-            headers = {
-                'Content-Type': 'application/json'
-            }
-            url = urljoin(self.config.llm_base_url, self.config.llm_tags_suffix)
-            response = requests.request("GET", url, headers=headers, stream=False)
+            models = await self.llm.catalog.models()
+            model_names = '\n'.join(
+                f"⭑ {model.name} ({model.describe()})" if model.describe() else f"⭑ {model.name}"
+                for model in models
+            )
+            await send_text_to_room(self.client, self.room.room_id, f"Available models:\n{model_names}", markdown_convert=True)
+        except LLMError as e:
+            await send_text_to_room(self.client, self.room.room_id, str(e))
+            logger.warning(f"Listing models failed: {e}")
 
-            if (200 <= int(response.status_code) < 300):
-                json_data = response.json()
-                await send_typing_to_room(self.client, self.room.room_id, False)
-                model_names = [model['name'] for model in json_data['models']]
-                model_names = '\n'.join(f"⭑ {name}" for name in model_names)
-                await send_text_to_room(self.client, self.room.room_id, f"Available models:\n{model_names}", markdown_convert=True)
-        except requests.RequestException as e :
-            await send_typing_to_room(self.client, self.room.room_id, False)
-            await send_text_to_room(self.client, self.room.room_id, f"An unknown error: {e}")
-            print('Error Occurred', e)
+    async def _resolve_model(self, model):
+        """Check that a model is installed, and point out similar names if it isn't.
+
+        Returns:
+            The full name of the model, or None if it isn't installed.
+        """
+        name, suggestions = await self.llm.catalog.resolve(model)
+        if name is None:
+            text = f"The model `{model}` is not available."
+            if suggestions:
+                text += " Did you mean " + " or ".join(f"`{s}`" for s in suggestions) + "?"
+            else:
+                text += " Use `ls` to list the available models."
+            await send_text_to_room(self.client, self.room.room_id, text, markdown_convert=True)
+        return name
 
 
     async def _query_llm_for_summery(self):
@@ -110,33 +203,117 @@ class Command:
 
         if not is_valid_url:
             await send_text_to_room(self.client, self.room.room_id, f"The given URL is invalid\n>{link}", markdown_convert=True)
+            return
+
+        model = await self._resolve_model(SUMMARY_MODEL)
+        if model is None:
+            return
+
+        # Leave half of the context for the instructions and the answer
+        chunk_chars = self.config.llm_param_num_ctx * CHARS_PER_TOKEN // 2
+        content = await get_main_content(parsed_url, self.fetcher, max_chars=chunk_chars * self.config.llm_summary_max_chunks)
+
+        chunks = split_into_chunks(content, chunk_chars)
+        if len(chunks) > 1:
+            # Too long for a single prompt: summarize the parts, then combine the summaries
+            self._show_typing()
+            await send_text_to_room(self.client, self.room.room_id, f">The page is long, summarizing it in {len(chunks)} parts.")
+            try:
+                content = await self._summarize_chunks(model, chunks, chunk_chars)
+            except LLMError as e:
+                self._stop_typing()
+                await send_text_to_room(self.client, self.room.room_id, str(e))
+                logger.warning(f"Summarizing {parsed_url} failed: {e}")
+                return
+            prompt = COMBINE_PROMPT.format(content=content)
+        else:
+            prompt = SUMMARY_PROMPT.format(content=content)
 
-        content = get_main_content(parsed_url)
-        model = "mistral-7b-instruct:latest"
-        prompt = f"Please provide a brief summary of the following content, ensuring to use the same language as the original. Keep the summary concise.\n\n---\n{content}\n---\nEnd of content."
-        self.store.add_message(parsed_url, self.event.sender, Role.USER, MessageType.LINK, None, prompt, self.event.event_id)
+        await self.store.add_message(parsed_url, self.event.sender, Role.USER, MessageType.LINK, None, prompt, self.event.event_id)
         await self.send_llm_message(model=model, message=prompt, messageType=MessageType.LINK, event_id=self.event.event_id)
 
+    async def _summarize_chunks(self, model, chunks, chunk_chars):
+        """Summarize each chunk (concurrently, as far as the scheduler allows) and
+        reduce the partial summaries until they fit into a single prompt.
+
+        Returns:
+            The partial summaries, to be combined into the final answer. At most
+            `chunk_chars` long.
+        """
+        prompt = SUMMARY_PROMPT
+        while True:
+            tasks = [
+                asyncio.ensure_future(self._summarize_chunk(model, prompt, chunk))
+                for chunk in chunks
+            ]
+            try:
+                summaries = await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't keep generating the other parts when one of them failed
+                for task in tasks:
+                    task.cancel()
+                raise
+            combined = "\n\n".join(summaries)
+            if len(combined) <= chunk_chars:
+                return combined
+            reduced = split_into_chunks(combined, chunk_chars)
+            if len(reduced) >= len(chunks):
+                # The summaries aren't getting any shorter. Keep the parts that fit
+                # into the prompt, rather than sending more than the model can take.
+                kept = 0
+                size = len(reduced[0])
+                while kept + 1 < len(reduced) and size + 2 + len(reduced[kept + 1]) <= chunk_chars:
+                    kept += 1
+                    size += 2 + len(reduced[kept])
+                logger.warning(f"Partial summaries stopped getting shorter, only keeping {kept + 1} of {len(reduced)} parts")
+                return "\n\n".join(reduced[: kept + 1])
+            chunks, prompt = reduced, COMBINE_PROMPT
+
+    async def _summarize_chunk(self, model, prompt, content):
+        """Summarize one part of a long text.
+
+        Partial summaries are kept in `LLMClient.summaries`, by the content of the
+        part, so summarizing a slightly changed page only redoes the changed parts.
+        With `--fresh`, every part is summarized again.
+        """
+        cache = self.llm.summaries
+        cache_key = cache.make_key(model, prompt, content)
+        if not self.bypass_cache:
+            summary = cache.get(cache_key)
+            if summary is not None:
+                return summary
+
+        payload = self._build_payload(model, prompt.format(content=content), [])
+
+        async with self.llm.scheduler.slot(model, self.room.room_id, self.event.sender):
+            json_data = await self.llm.generate(payload)
+        summary = json_data['response'].replace('<0x0A>', '\n')
+
+        cache.put(cache_key, summary)
+        return summary
+
     async def _query_llm_with_name(self):
         """Make the bot forward the query to a specific llm and wait for an answer"""
         model = None
         if self.args:
-            model = self.args[0]
+            model = await self._resolve_model(self.args[0])
+            if model is None:
+                return
 
         message = " ".join(self.args[1::])
 
-        self.store.add_message(message, self.event.sender, Role.USER, MessageType.CUSTOM, None, None, self.event.event_id)
+        await self.store.add_message(message, self.event.sender, Role.USER, MessageType.CUSTOM, None, None, self.event.event_id)
         await self.send_llm_message(model=model, message=message, messageType=MessageType.CUSTOM, event_id=self.event.event_id)
 
 
     async def _query_llm(self):
         """Make the bot forward the query to llm and wait for an answer"""
         message = " ".join(self.args)
-        self.store.add_message(message, self.event.sender, Role.USER, MessageType.DEFAULT, None, None, self.event.event_id)
+        await self.store.add_message(message, self.event.sender, Role.USER, MessageType.DEFAULT, None, None, self.event.event_id)
         await self.send_llm_message(message=message, event_id=self.event.event_id)
 
     async def send_llm_message(self, model=None, message='', messageType=MessageType.DEFAULT, event_id=None):
-        await send_typing_to_room(self.client, self.room.room_id, True, 60000)
+        self._show_typing()
 
         llm_param_stop = []
         if self.config.llm_param_stop != "" and model is None:
@@ -148,55 +325,170 @@ class Command:
 
         prompt = prepare_msg(self.config.llm_msg_template, message) if model is None else message
 
+        # Summaries stand on their own, everything else continues the conversation
+        with_history = messageType != MessageType.LINK
+        session_key = (self.room.room_id, self.event.sender, model_name)
+        model_info = self.llm.catalog.get(model_name)
+        fingerprint = self.llm.sessions.fingerprint(
+            model_name,
+            model_info.digest if model_info is not None else None,
+            self.config.llm_msg_template if model is None else None,
+            self.config.llm_param_num_ctx,
+        )
+        context = await self.context.build(
+            message,
+            self.event.sender,
+            messageType,
+            exclude_event_id=event_id,
+            with_history=with_history,
+            session=self.llm.sessions.get(session_key, fingerprint) if with_history else None,
+            template=self.config.llm_msg_template if model is None else "",
+        )
+        logger.debug(f"The prompt takes about {context.tokens} of {context.budget} tokens, with {context.messages} earlier messages")
+
+        payload = self._build_payload(model_name, context.prompt, llm_param_stop)
+        if context.session is not None:
+            payload["context"] = context.session
+
+        cache_key = None
+        if self.llm.cache is not None and self.llm.cache.is_cacheable(payload):
+            cache_key = self.llm.cache.make_key(payload)
+            cached = None if self.bypass_cache else await self.llm.cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f"Answered from the response cache {self.llm.cache.stats()}")
+                self._stop_typing()
+                await self.store.add_message(cached, self.client.user_id, Role.ASSISTANT, messageType, model_name, prompt, event_id)
+                await send_text_to_room(self.client, self.room.room_id, append_footer(cached, f'>Your request has been answered by `{model_name}` from the cache'), markdown_convert=True)
+                return
+
+        # Identical requests running at the same time (e.g. several people summarizing
+        # the same link) share a single generation
+        key = json.dumps(payload, sort_keys=True)
+
+        def stats(json_data):
+            return self._describe_stats(model_name, json_data, context)
+
         try:
-            payload = {
-                "model": model_name,
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "seed": self.config.llm_param_seed,
-                    "num_predict": self.config.llm_param_num_predict,
-                    "top_k": self.config.llm_param_top_k,
-                    "top_p": self.config.llm_param_top_p,
-                    "repeat_last_n": self.config.llm_param_repeat_last_n,
-                    "temperature": self.config.llm_param_temp,
-                    "repeat_penalty": self.config.llm_param_repeat_penalty,
-                    "stop": llm_param_stop,
-                    "num_ctx": self.config.llm_param_num_ctx,
-                }
-            }
+            (json_data, response), shared = await self.llm.inflight.do(key, lambda: self._generate(model_name, payload, hedge=messageType != MessageType.LINK, stats=stats))
+            if shared:
+                self._stop_typing()
+                await send_text_to_room(self.client, self.room.room_id, append_footer(response, stats(json_data)), markdown_convert=True)
+        except LLMError as e:
+            # Start over from the stored history, in case the context was the problem
+            self.llm.sessions.discard(session_key)
+            self._stop_typing()
+            await send_text_to_room(self.client, self.room.room_id, str(e), merge=True)
+            logger.warning(f"Generation with {model_name} failed: {e}")
+            return
 
-            headers = {
-                'Content-Type': 'application/json'
+        if with_history and "context" in json_data:
+            self.llm.sessions.put(session_key, fingerprint, json_data["context"])
+
+        await self.store.add_message(response, self.client.user_id, Role.ASSISTANT, messageType, model_name, prompt, event_id, json_data.get('eval_count'))
+        if cache_key is not None and not shared:
+            await self.llm.cache.put(cache_key, model_name, response)
+
+    def _describe_stats(self, model_name, json_data, context):
+        """The statistics of a generation, shown below its answer"""
+        if "eval_duration" not in json_data or "eval_count" not in json_data:
+            return ""
+        eval_dur = int(json_data["eval_duration"])
+        eval_cnt = int(json_data['eval_count'])
+        if eval_dur != 0 and eval_cnt != 0:
+            toks_per_sek = eval_cnt / (eval_dur / 1e9)
+            return f'>Your request has been answered by `{model_name}` and took {round((eval_dur)/1000000000, 3)} seconds and generated {round(toks_per_sek, 3)} tokens/s.{self._describe_context(context)}'
+        return '>Your request took some time but couldn\'t calculate the token generation rate due to zero values of eval_duration or eval_count'
+
+    def _describe_context(self, context):
+        """Say how much of the context a prompt took, for the statistics message"""
+        text = f" The prompt took about {context.tokens} of {self.config.llm_param_num_ctx} context tokens"
+        if context.session is not None:
+            text += ", continuing the conversation"
+        elif context.messages:
+            text += f", including {context.messages} earlier messages"
+        return text + "."
+
+    def _build_payload(self, model_name, prompt, llm_param_stop):
+        """Build the request body for a generation with the configured options"""
+        return {
+            "model": model_name,
+            "prompt": prompt,
+            "options": {
+                "seed": self.config.llm_param_seed,
+                "num_predict": self.config.llm_param_num_predict,
+                "top_k": self.config.llm_param_top_k,
+                "top_p": self.config.llm_param_top_p,
+                "repeat_last_n": self.config.llm_param_repeat_last_n,
+                "temperature": self.config.llm_param_temp,
+                "repeat_penalty": self.config.llm_param_repeat_penalty,
+                "stop": llm_param_stop,
+                "num_ctx": self.config.llm_param_num_ctx,
             }
-            url = urljoin(self.config.llm_base_url, self.config.llm_url_suffix)
-            response = requests.request("POST", url, data=json.dumps(payload), headers=headers, stream=False)
-
-            if (200 <= int(response.status_code) < 300):
-                json_data = response.json()
-                await send_typing_to_room(self.client, self.room.room_id, False)
-                response = (json_data['response'])
-                response = response.replace('<0x0A>', '\n') # some models have inconsistencies and use <0x0A> as \n
-                
-                self.store.add_message(response, self.client.user_id, Role.ASSISTANT, messageType, model_name, prompt, event_id)
-                await send_text_to_room(self.client, self.room.room_id, response, markdown_convert=True)
-
-                if "eval_duration" in json_data and "eval_count" in json_data:
-                    eval_dur = int(json_data["eval_duration"])
-                    eval_cnt = int(json_data['eval_count'])
-                    if eval_dur != 0 and eval_cnt != 0:
-                        toks_per_sek = eval_cnt / (eval_dur / 1e9)
-                        await send_text_to_room(self.client, self.room.room_id, f'>Your request has been answered by `{model_name}` and took {round((eval_dur)/1000000000, 3)} seconds and generated {round(toks_per_sek, 3)} tokens/s')
-                    else:
-                        await send_text_to_room(self.client, self.room.room_id,'>Your request took some time but couldn\'t calculate the token generation rate due to zero values of eval_duration or eval_count')
-            else:
-                await send_typing_to_room(self.client, self.room.room_id, False)
-                await send_text_to_room(self.client, self.room.room_id, f"An error occurred while fetching the API({response.status_code}): {response}")
+        }
 
-        except requests.RequestException as e :
-            await send_typing_to_room(self.client, self.room.room_id, False)
-            await send_text_to_room(self.client, self.room.room_id, f"An unknown error: {e}")
-            print('Error Occurred', e)
+    async def _generate(self, model_name, payload, hedge=False, stats=None):
+        """Run a generation and send its answer to the room.
+
+        Args:
+            model_name: The model to generate the answer with.
+
+            payload: The request body for the generation.
+
+            hedge: Whether someone is waiting for the answer, so that the request
+                may be hedged (see `LLMClient.generate`). Summaries are not.
+
+            stats: Describes the final response of the backend. The description is
+                sent along with the answer, in the same message.
+
+        Returns:
+            The final response from the backend (holding the timing statistics) and the
+            full answer.
+        """
+        async with self.llm.scheduler.slot(model_name, self.room.room_id, self.event.sender, on_queued=self._notify_queued):
+            if self.config.llm_stream:
+                return await self._generate_streamed(payload, hedge, stats)
+
+            json_data = await self.llm.generate(payload, hedge=hedge)
+            self._stop_typing()
+            response = (json_data['response'])
+            response = response.replace('<0x0A>', '\n') # some models have inconsistencies and use <0x0A> as \n
+            footer = stats(json_data) if stats is not None else ""
+            await send_text_to_room(self.client, self.room.room_id, append_footer(response, footer), markdown_convert=True)
+            return json_data, response
+
+    async def _notify_queued(self, position):
+        """Let the room know that its request has to wait for a free slot"""
+        if self.config.llm_queue_notice:
+            await send_text_to_room(self.client, self.room.room_id, f">The model is busy, your request is number {position} in the queue.", merge=True)
+
+    async def _generate_streamed(self, payload, hedge=False, stats=None):
+        """Stream the answer into the room as it is generated.
+
+        Returns:
+            The final chunk (holding the timing statistics) and the full answer.
+        """
+        reply = StreamingReply(
+            self.client,
+            self.room.room_id,
+            edit_interval=self.config.llm_stream_edit_interval / 1000,
+            edit_tokens=self.config.llm_stream_edit_tokens,
+        )
+        json_data = {}
+        try:
+            async for json_data in self.llm.generate_stream(payload, hedge=hedge):
+                piece = json_data.get('response', '').replace('<0x0A>', '\n') # some models have inconsistencies and use <0x0A> as \n
+                await reply.append(piece)
+                if reply.event_id is not None:
+                    # The answer itself now shows that we are working on it
+                    self._stop_typing()
+        finally:
+            # Never leave a half-written answer behind, even if the stream broke off.
+            # The statistics go into the final edit, once the answer is complete.
+            answer = reply.text
+            footer = stats(json_data) if stats is not None and json_data.get('done') else ""
+            await reply.finish(append_footer(answer, footer))
+        self._stop_typing()
+        return json_data, answer
 
     async def _echo(self):
         """Echo back the command's arguments"""
@@ -237,6 +529,7 @@ class Command:
                 "• `cm`: Queries a custom model. Example: `cm stablelm-zephyr-3b:latest _your query_`.\n"
                 "• `li`: Summarizes the content of a link. Example: `li https://www.example.com`.\n"
                 "• `code`: Generates code based on a given prompt. Example: `code give me a typescript function that mirrors a given string`.\n"
+                "\nAdd `--fresh` to a query to get a newly generated answer instead of a cached one.\n"
                 )
         else:
             text = "Unknown help topic!"
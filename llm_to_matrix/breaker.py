@@ -0,0 +1,97 @@
+import time
+from enum import Enum
+from typing import Optional
+
+
+class BreakerState(Enum):
+    """The states of a `CircuitBreaker`"""
+
+    # Requests go through
+    CLOSED = "closed"
+    # Requests fail straight away
+    OPEN = "open"
+    # A single trial request goes through, to find out whether the backend recovered
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    def __init__(self, max_failures: int = 3, reset_time: float = 30):
+        """Stops sending requests to a backend that keeps failing.
+
+        After `max_failures` failures in a row the breaker opens, and requests fail
+        straight away instead of waiting for the backend. Once `reset_time` seconds
+        have passed it is half-open: a single trial request is let through, which
+        closes the breaker again if it succeeds and opens it for another
+        `reset_time` seconds if it fails.
+
+        Args:
+            max_failures: Failures in a row after which the breaker opens.
+
+            reset_time: Seconds the breaker stays open before a trial request is let
+                through.
+        """
+        self.max_failures = max_failures
+        self.reset_time = reset_time
+        # Failed requests in a row
+        self.failures = 0
+        # When the breaker opened last (monotonic time)
+        self.opened_at = None  # type: Optional[float]
+        # Whether the trial request of the half-open breaker is in flight
+        self._trial = False
+
+    @property
+    def state(self) -> BreakerState:
+        if self.opened_at is None:
+            return BreakerState.CLOSED
+        if time.monotonic() - self.opened_at < self.reset_time:
+            return BreakerState.OPEN
+        return BreakerState.HALF_OPEN
+
+    @property
+    def available(self) -> bool:
+        """Whether a request may be sent now"""
+        state = self.state
+        return state == BreakerState.CLOSED or (state == BreakerState.HALF_OPEN and not self._trial)
+
+    @property
+    def retry_after(self) -> float:
+        """Seconds until a request may be sent again"""
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.reset_time - time.monotonic(), 0.0)
+
+    def acquire(self) -> None:
+        """Record that a request is sent. Makes it the trial request of a half-open
+        breaker.
+        """
+        if self.state == BreakerState.HALF_OPEN:
+            self._trial = True
+
+    def release(self) -> None:
+        """Record that a request ended without telling anything about the backend
+        (e.g. it was cancelled)
+        """
+        self._trial = False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def failure(self) -> bool:
+        """Record a failed request.
+
+        Returns:
+            Whether the breaker opened because of it.
+        """
+        self.failures += 1
+        self._trial = False
+        state = self.state
+        # A failure while half-open (of the trial request or a health check) opens
+        # the breaker again straight away
+        if state == BreakerState.HALF_OPEN or (
+            state == BreakerState.CLOSED and self.failures >= self.max_failures
+        ):
+            self.opened_at = time.monotonic()
+            return True
+        return False
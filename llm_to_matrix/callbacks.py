@@ -1,8 +1,11 @@
 import logging
+import time
+from typing import Optional
 
 from nio import (
     AsyncClient,
     InviteMemberEvent,
+    Event,
     JoinError,
     MatrixRoom,
     MegolmEvent,
@@ -14,14 +17,25 @@ from nio import (
 from llm_to_matrix.bot_commands import Command
 from llm_to_matrix.chat_functions import make_pill, react_to_event, send_text_to_room
 from llm_to_matrix.config import Config
+from llm_to_matrix.lanes import CommandLanes
+from llm_to_matrix.llm_client import LLMClient
 from llm_to_matrix.message_responses import Message
+from llm_to_matrix.parser.fetcher import PageFetcher
 from llm_to_matrix.storage import Storage
 
 logger = logging.getLogger(__name__)
 
 
 class Callbacks:
-    def __init__(self, client: AsyncClient, store: Storage, config: Config):
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        config: Config,
+        llm: LLMClient,
+        fetcher: PageFetcher,
+        started: Optional[float] = None,
+    ):
         """
         Args:
             client: nio client used to interact with matrix.
@@ -29,12 +43,50 @@ class Callbacks:
             store: Bot storage.
 
             config: Bot configuration parameters.
+
+            llm: The shared client used to talk to the LLM backend.
+
+            fetcher: The shared fetcher for web pages.
+
+            started: When the bot was started (as returned by `time.time()`), to
+                report how long it took until the first message was handled.
         """
         self.client = client
         self.store = store
         self.config = config
+        self.llm = llm
+        self.fetcher = fetcher
         self.command_prefix = config.command_prefix
 
+        # Commands are processed in the background, so a slow generation in one room
+        # doesn't stop the bot from serving any other room
+        self.lanes = CommandLanes(config.lane_workers)
+
+        self.started = started if started is not None else time.time()
+        self.first_handled = None  # type: Optional[float]
+        # Events sent before this (in milliseconds since the epoch) are old history
+        # that is ignored, see `skip_backlog`
+        self.ignore_before = None  # type: Optional[int]
+        self.skipped = 0
+
+    def skip_backlog(self, before: Optional[float] = None) -> None:
+        """Ignore messages, reactions and undecryptable events sent before the given
+        time (by default, when the bot was started).
+
+        Without a stored sync token, the first sync brings the recent history of
+        every room. Those messages were meant for an earlier run of the bot (or for
+        nobody), so answering them would only repeat old answers and keep the LLM
+        busy. Invites are still accepted.
+        """
+        self.ignore_before = int((before if before is not None else self.started) * 1000)
+
+    def _is_backlog(self, event: Event) -> bool:
+        if self.ignore_before is None or event.server_timestamp >= self.ignore_before:
+            return False
+        self.skipped += 1
+        logger.debug(f"Ignoring {event.event_id} from {event.sender}, it was sent before the bot started")
+        return True
+
     async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
         """Callback for when a message event is received
 
@@ -50,6 +102,16 @@ class Callbacks:
         if event.sender == self.client.user:
             return
 
+        if self._is_backlog(event):
+            return
+
+        if self.first_handled is None:
+            self.first_handled = time.time()
+            logger.info(
+                f"First message handled {self.first_handled - self.started:.2f}s after start, "
+                f"{self.skipped} old events ignored"
+            )
+
         logger.debug(
             f"Bot message received for room {room.display_name} | "
             f"{room.user_name(event.sender)}: {msg}"
@@ -74,8 +136,19 @@ class Callbacks:
             # Remove the command prefix
             msg = msg[len(self.command_prefix) :]
 
-        command = Command(self.client, self.store, self.config, msg, room, event)
-        await command.process()
+        command = Command(
+            self.client,
+            self.store,
+            self.config,
+            self.llm,
+            self.fetcher,
+            msg,
+            room,
+            event,
+        )
+        # The model can load while the command waits for its lane and builds its prompt
+        command.warm_up()
+        self.lanes.submit(command.lane, command.process)
 
     async def invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -167,6 +240,10 @@ class Callbacks:
 
             event: The encrypted event that we were unable to decrypt.
         """
+        # Old events often can't be decrypted after the store was lost
+        if self._is_backlog(event):
+            return
+
         logger.error(
             f"Failed to decrypt event '{event.event_id}' in room '{room.room_id}'!"
             f"\n\n"
@@ -198,6 +275,9 @@ class Callbacks:
             event: The event itself.
         """
         if event.type == "m.reaction":
+            if self._is_backlog(event):
+                return
+
             # Get the ID of the event this was a reaction to
             relation_dict = event.source.get("content", {}).get("m.relates_to", {})
 
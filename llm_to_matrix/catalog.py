@@ -0,0 +1,170 @@
+import asyncio
+import difflib
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+from llm_to_matrix.errors import LLMError
+from llm_to_matrix.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from llm_to_matrix.llm_client import LLMClient
+
+logger = logging.getLogger(__name__)
+
+# The tag Ollama assumes when a model name has none
+DEFAULT_TAG = ":latest"
+
+
+class ModelInfo:
+    def __init__(
+        self,
+        name: str,
+        size: int = 0,
+        digest: Optional[str] = None,
+        family: Optional[str] = None,
+        parameter_size: Optional[str] = None,
+        quantization_level: Optional[str] = None,
+    ):
+        """A model installed on the LLM backend.
+
+        Args:
+            name: The full name of the model, including its tag.
+
+            size: The size of the model in bytes.
+
+            digest: Identifies the exact model files. Changes when the model is
+                pulled again under the same name.
+
+            family: The model architecture, e.g. "llama".
+
+            parameter_size: The number of parameters, e.g. "7B".
+
+            quantization_level: The quantization of the weights, e.g. "Q4_0".
+        """
+        self.name = name
+        self.size = size
+        self.digest = digest
+        self.family = family
+        self.parameter_size = parameter_size
+        self.quantization_level = quantization_level
+
+    @classmethod
+    def from_tags(cls, model: Dict[str, Any]) -> "ModelInfo":
+        """Create from an entry of the backend's /api/tags response"""
+        details = model.get("details") or {}
+        return cls(
+            model["name"],
+            size=model.get("size", 0),
+            digest=model.get("digest"),
+            family=details.get("family"),
+            parameter_size=details.get("parameter_size"),
+            quantization_level=details.get("quantization_level"),
+        )
+
+    def describe(self) -> str:
+        """A short description of the model, for listings"""
+        parts = [p for p in (self.parameter_size, self.quantization_level) if p]
+        if self.size:
+            parts.append(f"{self.size / 1e9:.1f} GB")
+        return ", ".join(parts)
+
+
+class ModelCatalog:
+    def __init__(self, llm: "LLMClient", refresh_interval: int = 300):
+        """The models installed on the LLM backend, kept in memory.
+
+        `run` refreshes the list in the background, so listing models and checking
+        model names never waits for the backend.
+
+        Args:
+            llm: The client for the LLM backend.
+
+            refresh_interval: Seconds between two refreshes of the list.
+        """
+        self.llm = llm
+        self.refresh_interval = refresh_interval
+        self._models = None  # type: Optional[Dict[str, ModelInfo]]
+        self._inflight = SingleFlight()
+
+    @property
+    def loaded(self) -> bool:
+        return self._models is not None
+
+    async def refresh(self) -> None:
+        """Fetch the list of models from the backend.
+
+        Raises:
+            LLMError: If the backend couldn't be reached.
+        """
+        await self._inflight.do("tags", self._refresh)
+
+    async def _refresh(self) -> None:
+        json_data = await self.llm.list_models()
+        self._models = {
+            model["name"]: ModelInfo.from_tags(model) for model in json_data.get("models", [])
+        }
+        logger.debug(f"Model catalog refreshed, {len(self._models)} models")
+
+    async def run(self) -> None:
+        """Refresh the list every `refresh_interval` seconds, until cancelled"""
+        while True:
+            try:
+                await self.refresh()
+            except LLMError as e:
+                logger.warning(f"Refreshing the model catalog failed: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    async def models(self) -> List[ModelInfo]:
+        """The installed models, sorted by name. Only waits for the backend if the
+        list hasn't been loaded yet.
+
+        Raises:
+            LLMError: If the list hasn't been loaded and the backend couldn't be reached.
+        """
+        if self._models is None:
+            await self.refresh()
+        return [self._models[name] for name in sorted(self._models)]
+
+    def get(self, name: str) -> Optional[ModelInfo]:
+        """Look up an installed model, e.g. to route requests by its size"""
+        if self._models is None:
+            return None
+        return self._models.get(name) or self._models.get(name + DEFAULT_TAG)
+
+    async def resolve(self, name: str) -> Tuple[Optional[str], List[str]]:
+        """Check a model name given by a user.
+
+        Returns:
+            The full name of the model, or None if it isn't installed, along with the
+            names of installed models that are close to the given name. If the list of
+            models isn't available, the name is assumed to be valid.
+        """
+        if self._models is None:
+            try:
+                await self.refresh()
+            except LLMError as e:
+                logger.warning(f"Can't check the model name '{name}': {e}")
+                return name, []
+
+        model = self.get(name)
+        if model is not None:
+            return model.name, []
+
+        by_lower_name = {n.lower(): n for n in self._models}
+        if name.lower() in by_lower_name:
+            return by_lower_name[name.lower()], []
+        if (name + DEFAULT_TAG).lower() in by_lower_name:
+            return by_lower_name[(name + DEFAULT_TAG).lower()], []
+
+        # Match with and without the default tag, as it is usually left out
+        candidates = {}  # type: Dict[str, str]
+        for n in self._models:
+            candidates[n.lower()] = n
+            if n.endswith(DEFAULT_TAG):
+                candidates[n[: -len(DEFAULT_TAG)].lower()] = n
+        matches = difflib.get_close_matches(name.lower(), list(candidates), n=5, cutoff=0.6)
+        suggestions = []  # type: List[str]
+        for match in matches:
+            if candidates[match] not in suggestions:
+                suggestions.append(candidates[match])
+        return None, suggestions[:3]
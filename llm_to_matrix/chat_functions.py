@@ -1,7 +1,7 @@
 import logging
+import time
 from typing import Optional, Union
 
-import markdown2
 from nio import (
     AsyncClient,
     ErrorResponse,
@@ -9,9 +9,12 @@ from nio import (
     MegolmEvent,
     Response,
     RoomSendResponse,
-    SendRetryError,
 )
 
+from llm_to_matrix.outbox import get_outbox
+from llm_to_matrix.rendering import IncrementalRenderer, MarkdownRenderer, default_renderer
+from llm_to_matrix.typing_indicators import TypingHold
+
 logger = logging.getLogger(__name__)
 
 
@@ -21,12 +24,19 @@ async def send_typing_to_room(
     is_typing: bool,
     timeout: int = 30000
 ):
-    """Send typing event to room"""
-    try:
-        return await client.room_typing(room_id, is_typing, timeout)
-    except SendRetryError:
-        logger.exception(f"Unable to send typing message response to {room_id}")
-    
+    """Send typing event to room. Dropped if it changes nothing or we are being rate
+    limited, see `Outbox.typing`.
+    """
+    await get_outbox(client).typing(room_id, is_typing, timeout)
+
+
+def typing_in_room(client: AsyncClient, room_id: str) -> TypingHold:
+    """Show that we are typing in a room until the returned hold is released. The
+    indicator stays up (refreshed in the background) as long as any request in the
+    room holds it, see `TypingIndicators`.
+    """
+    return get_outbox(client).indicators.hold(room_id)
+
 
 async def send_text_to_room(
     client: AsyncClient,
@@ -35,7 +45,9 @@ async def send_text_to_room(
     notice: bool = True,
     markdown_convert: bool = True,
     reply_to_event_id: Optional[str] = None,
-) -> Union[RoomSendResponse, ErrorResponse]:
+    renderer: Optional[Union[MarkdownRenderer, IncrementalRenderer]] = None,
+    merge: bool = False,
+) -> Optional[Union[RoomSendResponse, ErrorResponse]]:
     """Send text to a matrix room.
 
     Args:
@@ -54,9 +66,76 @@ async def send_text_to_room(
         reply_to_event_id: Whether this message is a reply to another event. The event
             ID this is message is a reply to.
 
+        renderer: Renders the markdown. Defaults to the shared, cached renderer.
+
+        merge: Whether the message may be sent together with other messages to the
+            room that are waiting to be sent, see `Outbox.send`. Only for messages
+            that are never edited.
+
+    Returns:
+        A RoomSendResponse if the request was successful, else an ErrorResponse, or
+        None if the message couldn't be sent at all.
+    """
+    content = await _make_text_content(message, notice, markdown_convert, renderer)
+
+    if reply_to_event_id:
+        content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
+
+    return await get_outbox(client).send(room_id, "m.room.message", content, merge=merge)
+
+
+async def edit_text_in_room(
+    client: AsyncClient,
+    room_id: str,
+    event_id: str,
+    message: str,
+    notice: bool = True,
+    markdown_convert: bool = True,
+    renderer: Optional[Union[MarkdownRenderer, IncrementalRenderer]] = None,
+) -> Optional[Union[RoomSendResponse, ErrorResponse]]:
+    """Replace the content of a message previously sent to a matrix room.
+
+    Args:
+        client: The client to communicate to matrix with.
+
+        room_id: The ID of the room the message was sent to.
+
+        event_id: The ID of the message event to replace.
+
+        message: The new message content.
+
+        notice: Whether the message should be sent with an "m.notice" message type
+            (will not ping users).
+
+        markdown_convert: Whether to convert the message content to markdown.
+            Defaults to true.
+
+        renderer: Renders the markdown. Defaults to the shared, cached renderer.
+
     Returns:
-        A RoomSendResponse if the request was successful, else an ErrorResponse.
+        A RoomSendResponse if the request was successful, else an ErrorResponse, or
+        None if the edit couldn't be sent at all. An edit that is superseded by a
+        newer one before it was sent gets the response of the newer one.
     """
+    new_content = await _make_text_content(message, notice, markdown_convert, renderer)
+
+    # Clients that don't understand edits show the fallback body
+    content = dict(new_content, body=f"* {new_content['body']}")
+    if "formatted_body" in new_content:
+        content["formatted_body"] = f"* {new_content['formatted_body']}"
+    content["m.new_content"] = new_content
+    content["m.relates_to"] = {"rel_type": "m.replace", "event_id": event_id}
+
+    return await get_outbox(client).send(room_id, "m.room.message", content)
+
+
+async def _make_text_content(
+    message: str,
+    notice: bool,
+    markdown_convert: bool,
+    renderer: Optional[Union[MarkdownRenderer, IncrementalRenderer]] = None,
+) -> dict:
+    """Build the content of an `m.room.message` event holding the given text"""
     # Determine whether to ping room members or not
     msgtype = "m.notice" if notice else "m.text"
 
@@ -67,24 +146,97 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = markdown2.markdown(message, extras={
-            'breaks': {'on_newline': True, 'on_backslash': True},
-            'fenced-code-blocks':{}
-            })
-        logger.info(f'formatted\n{content["formatted_body"]}')
-
-    if reply_to_event_id:
-        content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
-
-    try:
-        return await client.room_send(
-            room_id,
-            "m.room.message",
-            content,
-            ignore_unverified_devices=True,
+        renderer = renderer or default_renderer
+        content["formatted_body"] = await renderer.render_async(message)
+        logger.debug(
+            f"Rendered {len(message)} characters of markdown into "
+            f"{len(content['formatted_body'])} characters of HTML"
         )
-    except SendRetryError:
-        logger.exception(f"Unable to send message response to {room_id}")
+
+    return content
+
+
+class StreamingReply:
+    def __init__(
+        self,
+        client: AsyncClient,
+        room_id: str,
+        edit_interval: float = 1.0,
+        edit_tokens: int = 0,
+    ):
+        """A message that is built up piece by piece while an answer is generated.
+
+        The first piece is sent as a new message, which is then updated with
+        `m.replace` edits. Edits are rate limited so the homeserver isn't flooded
+        with one event per token.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            room_id: The ID of the room to send the message to.
+
+            edit_interval: Send an edit once this many seconds have passed since the
+                previous one.
+
+            edit_tokens: Edit sooner, once this many new pieces have arrived, even
+                if `edit_interval` hasn't passed yet. This adds edits on top of the
+                interval rather than limiting them; the rate of all events sent is
+                bounded by the outbox. 0 disables this trigger.
+        """
+        self.client = client
+        self.room_id = room_id
+        self.edit_interval = edit_interval
+        self.edit_tokens = edit_tokens
+
+        self.text = ""
+        self.event_id = None  # type: Optional[str]
+        # Only renders what changed since the previous edit
+        self._renderer = IncrementalRenderer(default_renderer)
+        self._sent_text = ""
+        self._pending_tokens = 0
+        self._last_sent = 0.0
+
+    async def append(self, piece: str) -> None:
+        """Add the next piece of the answer, sending it if it is due"""
+        self.text += piece
+        self._pending_tokens += 1
+        if not self.text.strip():
+            return
+
+        # Show the first piece right away
+        if self.event_id is None and not self._sent_text:
+            await self._send()
+            return
+
+        due = time.monotonic() - self._last_sent >= self.edit_interval
+        if not due and self.edit_tokens > 0:
+            due = self._pending_tokens >= self.edit_tokens
+        if due:
+            await self._send()
+
+    async def finish(self, text: Optional[str] = None) -> None:
+        """Send the complete answer, if it isn't already shown in full.
+
+        Args:
+            text: The final text. Defaults to the concatenation of all pieces.
+        """
+        if text is not None:
+            self.text = text
+        if self.text != self._sent_text:
+            await self._send()
+
+    async def _send(self) -> None:
+        text = self.text
+        if self.event_id is None:
+            response = await send_text_to_room(self.client, self.room_id, text, renderer=self._renderer)
+            if isinstance(response, RoomSendResponse):
+                self.event_id = response.event_id
+        else:
+            await edit_text_in_room(self.client, self.room_id, self.event_id, text, renderer=self._renderer)
+
+        self._sent_text = text
+        self._pending_tokens = 0
+        self._last_sent = time.monotonic()
 
 
 def make_pill(user_id: str, displayname: str = None) -> str:
@@ -112,7 +264,7 @@ async def react_to_event(
     room_id: str,
     event_id: str,
     reaction_text: str,
-) -> Union[Response, ErrorResponse]:
+) -> Optional[Union[Response, ErrorResponse]]:
     """Reacts to a given event in a room with the given reaction text
 
     Args:
@@ -125,10 +277,8 @@ async def react_to_event(
         reaction_text: The string to react with. Can also be (one or more) emoji characters.
 
     Returns:
-        A nio.Response or nio.ErrorResponse if an error occurred.
-
-    Raises:
-        SendRetryError: If the reaction was unable to be sent.
+        A nio.Response or nio.ErrorResponse if an error occurred, or None if the
+        reaction couldn't be sent at all.
     """
     content = {
         "m.relates_to": {
@@ -138,12 +288,7 @@ async def react_to_event(
         }
     }
 
-    return await client.room_send(
-        room_id,
-        "m.reaction",
-        content,
-        ignore_unverified_devices=True,
-    )
+    return await get_outbox(client).send(room_id, "m.reaction", content)
 
 
 async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
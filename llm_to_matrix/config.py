@@ -70,6 +70,14 @@ class Config:
                     f"storage.store_path '{self.store_path}' is not a directory"
                 )
 
+        # Fetching of web pages (for the `li` command)
+        self.fetch_timeout = self._get_cfg(["fetch", "timeout"], default=15)
+        self.fetch_max_bytes = self._get_cfg(["fetch", "max_bytes"], default=2 * 1024 * 1024)
+        self.fetch_pool_size = self._get_cfg(["fetch", "pool_size"], default=10)
+        self.fetch_cache_entries = self._get_cfg(["fetch", "cache_entries"], default=256)
+        self.fetch_extractor = self._get_cfg(["fetch", "extractor"], default="stream")
+        self.fetch_cache_path = os.path.join(self.store_path, "page_cache")
+
         # Database setup
         database_path = self._get_cfg(["storage", "database"], required=True)
 
@@ -81,12 +89,36 @@ class Config:
             self.database = {
                 "type": "sqlite",
                 "connection_string": database_path[len(sqlite_scheme) :],
+                # Applied to the connection in this order
+                "pragmas": {
+                    "journal_mode": self._get_cfg(["storage", "sqlite", "journal_mode"], default="WAL"),
+                    "synchronous": self._get_cfg(["storage", "sqlite", "synchronous"], default="NORMAL"),
+                    # A negative cache size is in KiB rather than pages
+                    "cache_size": -self._get_cfg(["storage", "sqlite", "cache_size"], default=16384),
+                    "mmap_size": self._get_cfg(["storage", "sqlite", "mmap_size"], default=268435456),
+                    "busy_timeout": self._get_cfg(["storage", "sqlite", "busy_timeout"], default=5000),
+                },
+                "maintenance_interval": self._get_cfg(["storage", "sqlite", "maintenance_interval"], default=3600),
+                "vacuum_pages": self._get_cfg(["storage", "sqlite", "vacuum_pages"], default=1000),
             }
+            for name, value in self.database["pragmas"].items():
+                if not re.match(r"^-?\w+$", str(value)):
+                    raise ConfigError(f"Invalid value '{value}' for storage.sqlite.{name}")
         elif database_path.startswith(postgres_scheme):
-            self.database = {"type": "postgres", "connection_string": database_path}
+            self.database = {
+                "type": "postgres",
+                "connection_string": database_path,
+                "pool_min_size": self._get_cfg(["storage", "pool_min_size"], default=1),
+                "pool_max_size": self._get_cfg(["storage", "pool_max_size"], default=4),
+                "pool_check_idle": self._get_cfg(["storage", "pool_check_idle"], default=30),
+            }
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
+        # Messages are written in batches, so a busy bot doesn't wait for a commit per message
+        self.database_write_batch_size = self._get_cfg(["storage", "write_batch_size"], default=50)
+        self.database_write_batch_interval = self._get_cfg(["storage", "write_batch_interval"], default=200)
+
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
         if not re.match("@.*:.*", self.user_id):
@@ -102,15 +134,87 @@ class Config:
             ["matrix", "device_name"], default="nio-template"
         )
         self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
+        # Sending to the homeserver: events per second, events at once, and retries
+        self.send_rate = self._get_cfg(["matrix", "send_rate"], default=10)
+        self.send_burst = self._get_cfg(["matrix", "send_burst"], default=20)
+        self.send_retries = self._get_cfg(["matrix", "send_retries"], default=5)
+        if self.send_rate <= 0 or self.send_burst < 1:
+            raise ConfigError("matrix.send_rate must be positive and matrix.send_burst at least 1")
+        # Sync only the events the bot handles, with members loaded lazily
+        self.lean_sync = self._get_cfg(["matrix", "lean_sync"], default=True)
+        self.sync_timeline_limit = self._get_cfg(["matrix", "sync_timeline_limit"], default=20)
+        # Whether to ignore the history the first sync brings when no sync token is stored
+        self.skip_backlog = self._get_cfg(["matrix", "skip_backlog"], default=True)
 
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
+        # How many commands of each kind are processed at the same time
+        self.lane_workers = {
+            "instant": self._get_cfg(["lanes", "instant"], default=8),
+            "metadata": self._get_cfg(["lanes", "metadata"], default=4),
+            "generation": self._get_cfg(["lanes", "generation"], default=32),
+        }
+
         self.llm_name = self._get_cfg(["llm", "llm_name"], default="Bot")
         self.llm_base_url = self._get_cfg(["llm", "llm_base_url"], required=True)
         self.llm_url_suffix = self._get_cfg(["llm", "llm_url_suffix"], required=True)
         self.llm_tags_suffix = self._get_cfg(["llm", "llm_tags_suffix"], required=True)
         self.llm_model = self._get_cfg(["llm", "llm_model"], required=True)
 
+        # Several backends can share the load, with llm_base_url as the only one by default
+        self.llm_backends = self._get_cfg(["llm", "llm_backends"], default=[], required=False) or [self.llm_base_url]
+        self.llm_health_interval = self._get_cfg(["llm", "llm_health_interval"], default=15)
+        self.llm_backend_max_failures = self._get_cfg(["llm", "llm_backend_max_failures"], default=3)
+        self.llm_backend_eject_time = self._get_cfg(["llm", "llm_backend_eject_time"], default=30)
+        self.llm_hedge = self._get_cfg(["llm", "llm_hedge"], default=False, required=False)
+        self.llm_hedge_max_prompt_tokens = self._get_cfg(["llm", "llm_hedge_max_prompt_tokens"], default=256)
+        self.llm_hedge_percentile = self._get_cfg(["llm", "llm_hedge_percentile"], default=95)
+        if not 0 < self.llm_hedge_percentile <= 100:
+            raise ConfigError("llm.llm_hedge_percentile must be between 0 and 100")
+
+        # Connection pool and timeouts (in seconds) used for requests to the backend
+        self.llm_timeout = self._get_cfg(["llm", "llm_timeout"], default=300)
+        self.llm_connect_timeout = self._get_cfg(["llm", "llm_connect_timeout"], default=10)
+        self.llm_pool_size = self._get_cfg(["llm", "llm_pool_size"], default=10)
+        self.llm_keepalive_timeout = self._get_cfg(["llm", "llm_keepalive_timeout"], default=60)
+
+        # How many generations may run on the backend at once, overall and per model
+        self.llm_max_concurrent = self._get_cfg(["llm", "llm_max_concurrent"], default=2)
+        self.llm_model_concurrency = self._get_cfg(["llm", "llm_model_concurrency"], default={}, required=False)
+        self.llm_default_model_concurrency = self._get_cfg(["llm", "llm_default_model_concurrency"], default=0, required=False)
+        self.llm_queue_notice = self._get_cfg(["llm", "llm_queue_notice"], default=True)
+
+        # Reuse the answers of deterministic generations (fixed seed or temperature 0)
+        self.llm_cache_enabled = self._get_cfg(["llm", "llm_cache_enabled"], default=True)
+        self.llm_cache_size = self._get_cfg(["llm", "llm_cache_size"], default=512)
+        self.llm_cache_ttl = self._get_cfg(["llm", "llm_cache_ttl"], default=86400)
+        self.llm_cache_max_rows = self._get_cfg(["llm", "llm_cache_max_rows"], default=10000)
+
+        # Pages too long for the context are summarized in at most this many parts
+        self.llm_summary_max_chunks = self._get_cfg(["llm", "llm_summary_max_chunks"], default=8)
+        # Summaries of those parts are kept, so a page summarized again is mostly not regenerated
+        self.llm_summary_cache_size = self._get_cfg(["llm", "llm_summary_cache_size"], default=256, required=False)
+
+        # Earlier turns of the conversation put in front of a prompt, as far as they fit
+        self.llm_history_turns = self._get_cfg(["llm", "llm_history_turns"], default=5)
+        # How long (in seconds) models stay loaded on the backend after they were used
+        self.llm_keep_alive = self._get_cfg(["llm", "llm_keep_alive"], default=300)
+        self.llm_hot_keep_alive = self._get_cfg(["llm", "llm_hot_keep_alive"], default=3600)
+        self.llm_hot_models = self._get_cfg(["llm", "llm_hot_models"], default=2)
+        # Models loaded at startup, in addition to the ones the commands use
+        self.llm_preload_models = self._get_cfg(["llm", "llm_preload_models"], default=[], required=False)
+
+        # The list of installed models is refreshed in the background this often (in seconds)
+        self.llm_catalog_refresh = self._get_cfg(["llm", "llm_catalog_refresh"], default=300)
+        # The backend's state of a conversation is reused for the next turn of it
+        self.llm_sessions = self._get_cfg(["llm", "llm_sessions"], default=256)
+        self.llm_session_ttl = self._get_cfg(["llm", "llm_session_ttl"], default=3600)
+
+        # Stream answers into the room as they are generated, using message edits
+        self.llm_stream = self._get_cfg(["llm", "llm_stream"], default=True)
+        self.llm_stream_edit_interval = self._get_cfg(["llm", "llm_stream_edit_interval"], default=1000)
+        self.llm_stream_edit_tokens = self._get_cfg(["llm", "llm_stream_edit_tokens"], default=0, required=False)
+
         self.llm_param_temp = self._get_cfg(["llm", "llm_param_temp"], default=0.7)
         self.llm_param_num_ctx = self._get_cfg(["llm", "llm_param_num_ctx"], default=215)
         self.llm_param_num_predict = self._get_cfg(["llm", "llm_param_num_predict"], default=-1)
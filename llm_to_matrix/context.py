@@ -0,0 +1,176 @@
+import logging
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+from llm_to_matrix.conversation_store import ConversationStore, MessageType, Role
+from llm_to_matrix.helper import estimate_tokens, prepare_msg
+
+logger = logging.getLogger(__name__)
+
+# The earlier messages are put in front of the prompt like this
+HISTORY_TEMPLATE = "The conversation so far:\n\n{history}\n\n---\n\n{prompt}"
+HISTORY_TEMPLATE_TOKENS = estimate_tokens(HISTORY_TEMPLATE.format(history="", prompt=""))
+
+ROLE_LABELS = {
+    Role.USER.value: "User",
+    Role.ASSISTANT.value: "Assistant",
+    Role.SYSTEM.value: "System",
+}
+
+# Tokens taken by the role label and the line breaks around each earlier message
+MESSAGE_OVERHEAD = 4
+
+
+class Context:
+    def __init__(
+        self,
+        prompt: str,
+        tokens: int,
+        budget: int,
+        messages: int = 0,
+        session: Optional[List[int]] = None,
+    ):
+        """A prompt, along with as much of the conversation as fits into the context.
+
+        Args:
+            prompt: The prompt to send, including the earlier messages.
+
+            tokens: The (estimated) number of tokens of the prompt.
+
+            budget: The number of tokens the prompt may take.
+
+            messages: The number of earlier messages included.
+
+            session: The backend's context to continue from. The earlier messages
+                are part of it, rather than of the prompt.
+        """
+        self.prompt = prompt
+        self.tokens = tokens
+        self.budget = budget
+        self.messages = messages
+        self.session = session
+
+    @property
+    def fits(self) -> bool:
+        return self.tokens <= self.budget
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        store: ConversationStore,
+        num_ctx: int,
+        num_predict: int = -1,
+        turns: int = 5,
+    ):
+        """Puts the latest turns of a conversation in front of a prompt, as far as they
+        fit into the model's context.
+
+        Turns (a request and the answers to it) are added newest first, until the next
+        one would exceed the budget. Token counts are stored with every message, so
+        the history is never tokenized again.
+
+        Args:
+            store: The database holding the conversation history.
+
+            num_ctx: The size of the model's context in tokens.
+
+            num_predict: The maximum number of tokens generated, which is kept free
+                for the answer. If unlimited (-1), a quarter of the context is kept
+                free.
+
+            turns: The maximum number of earlier turns considered. 0 disables the
+                history.
+        """
+        self.store = store
+        self.num_ctx = num_ctx
+        self.num_predict = num_predict
+        self.turns = turns
+
+    @property
+    def budget(self) -> int:
+        """The number of tokens the prompt may take"""
+        reserve = self.num_predict if self.num_predict > 0 else self.num_ctx // 4
+        return max(self.num_ctx - reserve, 0)
+
+    async def build(
+        self,
+        prompt: str,
+        user: str,
+        messageType: MessageType,
+        exclude_event_id: Optional[str] = None,
+        with_history: bool = True,
+        session: Optional[List[int]] = None,
+        template: str = "",
+    ) -> Context:
+        """Build the prompt for a request.
+
+        Args:
+            prompt: The prompt of the request itself, without the message template.
+
+            user: The user making the request.
+
+            messageType: Only earlier requests of this type (and their answers) are
+                included.
+
+            exclude_event_id: The event of the request itself, which may already be
+                stored.
+
+            with_history: Whether to include earlier messages at all.
+
+            session: The backend's context of the conversation, see `SessionCache`.
+                It is used instead of the stored history if it leaves room for the
+                prompt.
+
+            template: The message template (`llm_msg_template`), applied once to the
+                earlier messages and the prompt together.
+        """
+        budget = self.budget
+        tokens = estimate_tokens(prepare_msg(template, prompt))
+        if tokens > budget:
+            logger.warning(f"The prompt takes about {tokens} tokens, more than the {budget} available")
+        if not with_history:
+            return Context(prepare_msg(template, prompt), tokens, budget)
+        if session is not None and len(session) + tokens <= budget:
+            return Context(prepare_msg(template, prompt), len(session) + tokens, budget, session=session)
+        if not self.turns or tokens + HISTORY_TEMPLATE_TOKENS >= budget:
+            return Context(prepare_msg(template, prompt), tokens, budget)
+
+        # The request itself is usually stored already, and one of the latest turns
+        turns_fetched = self.turns + 1 if exclude_event_id is not None else self.turns
+        rows = await self.store.get_conversation(user, messageType, turns_fetched)
+
+        # Group the messages by the request they belong to
+        turns = OrderedDict()  # type: OrderedDict[Any, List[Any]]
+        for row in rows:
+            event_id = row[6]
+            if event_id is None or event_id == exclude_event_id:
+                continue
+            turns.setdefault(event_id, []).append(row)
+
+        used = tokens + HISTORY_TEMPLATE_TOKENS
+        included = []  # type: List[List[Any]]
+        for turn in reversed(list(turns.values())[-self.turns :]):
+            cost = sum(
+                (row[7] if row[7] is not None else estimate_tokens(row[1])) + MESSAGE_OVERHEAD
+                for row in turn
+            )
+            if used + cost > budget:
+                break
+            used += cost
+            included.append(turn)
+
+        if not included:
+            return Context(prepare_msg(template, prompt), tokens, budget)
+
+        history = "\n\n".join(
+            f"{ROLE_LABELS.get(row[0], row[0])}: {row[1]}"
+            for turn in reversed(included)
+            for row in turn
+        )
+        return Context(
+            prepare_msg(template, HISTORY_TEMPLATE.format(history=history, prompt=prompt)),
+            used,
+            budget,
+            sum(len(turn) for turn in included),
+        )
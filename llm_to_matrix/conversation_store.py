@@ -1,8 +1,13 @@
 
-from typing import Dict
+import asyncio
+import logging
+from typing import Awaitable, Dict, Optional, Set
+from llm_to_matrix.helper import estimate_tokens
 from llm_to_matrix.storage import Storage
 from enum import Enum
 
+logger = logging.getLogger(__name__)
+
 
 class Role(Enum):
     USER = 'user'
@@ -16,19 +21,69 @@ class MessageType(Enum):
    DEFAULT = 'default'
 
 
+# History lookups, built once. `user` is quoted as it is a reserved word in postgres.
+HISTORY_COLUMNS = 'SELECT role, content, "user", model, messageType, prompt, event_id, token_count FROM messages '
+HISTORY_QUERIES = {
+    (True, True): HISTORY_COLUMNS + 'WHERE "user" = ? AND messageType = ? ORDER BY id DESC LIMIT ?',
+    (True, False): HISTORY_COLUMNS + 'WHERE "user" = ? ORDER BY id DESC LIMIT ?',
+    (False, True): HISTORY_COLUMNS + 'WHERE messageType = ? ORDER BY id DESC LIMIT ?',
+}
+
+INSERT_MESSAGE = '''
+    INSERT INTO messages (role, content, "user", model, messageType, prompt, event_id, token_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# The latest requests of a user, and the answers to them (which are stored under the
+# bot's user, with the event ID of the request)
+CONVERSATION_QUERY = HISTORY_COLUMNS + '''
+    WHERE event_id IN (
+      SELECT event_id FROM messages WHERE "user" = ? AND messageType = ? ORDER BY id DESC LIMIT ?
+    )
+    ORDER BY id DESC LIMIT ?
+'''
+
+
 class ConversationStore(Storage):
-    def __init__(self, database_config: Dict[str, str]):
+    def __init__(self, database_config: Dict[str, str], write_batch_size: int = 1, write_batch_interval: float = 0.2):
+      """
+      Args:
+          database_config: See `Storage`.
+
+          write_batch_size: Messages are written in batches of up to this many, in a
+              single transaction. 1 writes every message straight away.
+
+          write_batch_interval: Seconds a message may wait for its batch to fill up.
+      """
       super().__init__(database_config)
+      # Databases created before a table was added get it here
+      self._init_db()
+
+      self.write_batch_size = write_batch_size
+      self.write_batch_interval = write_batch_interval
+      # Messages (in HISTORY_COLUMNS order) not yet handed to the storage thread
+      self._pending = []
+      self._flush_timer = None  # type: Optional[asyncio.Handle]
+      # Batch writes and history reads in progress. On different storage threads they
+      # could overtake each other, and a read would miss or double count a batch.
+      self._writes = set()  # type: Set[asyncio.Future]
+      self._reads = set()  # type: Set[asyncio.Future]
+
+    def _initial_setup(self) -> None:
+      super()._initial_setup()
+      # Migrations (e.g. indexes) expect the tables to exist already
       self._init_db()
 
     def _init_db(self):
+      primary_key = "SERIAL PRIMARY KEY" if self.db_type == "postgres" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+
       # Create the messages table if it doesn't exist
-      self._execute('''
+      self._execute(f'''
           CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id {primary_key},
             role TEXT,
             content TEXT,
-            user TEXT,
+            "user" TEXT,
             model TEXT,
             messageType TEXT,
             prompt TEXT,
@@ -37,7 +92,17 @@ class ConversationStore(Storage):
           )
       ''')
 
-    def add_message(self, content, user, role: Role, messageType: MessageType, model=None, prompt=None, event_id=None):
+      # Responses of deterministic generations, see `ResponseCache`
+      self._execute('''
+          CREATE TABLE IF NOT EXISTS response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            created_at BIGINT
+          )
+      ''')
+
+    async def add_message(self, content, user, role: Role, messageType: MessageType, model=None, prompt=None, event_id=None, token_count=None):
       # Ensure that the role is an instance of the Role enum
       if not isinstance(role, Role):
         raise ValueError("role must be an instance of Role enum")
@@ -45,28 +110,136 @@ class ConversationStore(Storage):
       if not isinstance(messageType, MessageType):
         raise ValueError("messageType must be an instance of MessageType enum")
 
-      self._execute('''
-          INSERT INTO messages (role, content, user, model, messageType, prompt, event_id)
-          VALUES (?, ?, ?, ?, ?, ?, ?)
-      ''', (role.value, content, user, model, messageType.value, prompt, event_id))
+      # Counted once here, so history never has to be tokenized again
+      if token_count is None:
+        token_count = estimate_tokens(content)
+
+      row = (role.value, content, user, model, messageType.value, prompt, event_id, token_count)
+      if self.write_batch_size <= 1:
+        await self._run(self._execute, INSERT_MESSAGE, row, prepare=True)
+        return
 
-    def get_last_five_messages(self, user=None, messageType=None, limit=5):
+      self._pending.append(row)
+      if len(self._pending) >= self.write_batch_size:
+        await self.flush()
+      elif self._flush_timer is None:
+        self._flush_timer = asyncio.get_event_loop().call_later(
+            self.write_batch_interval, lambda: asyncio.ensure_future(self._flush_in_background())
+        )
 
+    async def flush(self):
+      """Write all pending messages in a single transaction"""
+      if self._flush_timer is not None:
+        self._flush_timer.cancel()
+        self._flush_timer = None
+
+      rows, self._pending = self._pending, []
+      if rows:
+        await self._track(self._writes, self._write_batch(rows))
+
+    async def _write_batch(self, rows):
+      if self._reads:
+        await asyncio.wait(list(self._reads))
+      await self._run(self._execute_batch, INSERT_MESSAGE, rows, prepare=True)
+
+    def _track(self, futures: Set[asyncio.Future], coroutine: Awaitable) -> asyncio.Future:
+      future = asyncio.ensure_future(coroutine)
+      futures.add(future)
+      future.add_done_callback(futures.discard)
+      return future
+
+    async def _flush_in_background(self):
+      try:
+        await self.flush()
+      except Exception:
+        logger.exception("Failed to write pending messages")
+
+    async def close(self):
+      """Write any pending messages, wait for the batches being written, then close
+      the database"""
+      try:
+        await self.flush()
+        # Batches may still be waiting for reads before they reach the storage thread
+        while self._writes:
+          await asyncio.wait(list(self._writes))
+      finally:
+        super().close()
+
+    async def get_last_five_messages(self, user=None, messageType=None, limit=5):
+      """Return the latest messages of a user and/or of a message type, oldest first"""
       if user is None and messageType is None:
-         raise('Please provide any search criteria.')
-
-      query = "SELECT role, content, user, model, messageType, prompt, event_id FROM messages "
-      params = ()
-      if user is not None and messageType is not None:
-          query += "WHERE user = ? and messageType = ?"
-          params = (user, messageType)
-      if user is not None and messageType is None:
-          query += "WHERE user = ? "
-          params = (user,)
-      if user is None and messageType is not None:
-        query += "WHERE messageType = ? "
-        params = (messageType,)
-      query += f"ORDER BY id DESC LIMIT {limit}"
-
-      self._execute(query, params)
-      return list(reversed(self.cursor.fetchall()))
+         raise ValueError('Please provide any search criteria.')
+
+      if isinstance(messageType, MessageType):
+        messageType = messageType.value
+
+      query = HISTORY_QUERIES[(user is not None, messageType is not None)]
+      params = tuple(p for p in (user, messageType) if p is not None) + (limit,)
+
+      rows, pending = await self._read(query, params)
+      pending = [
+          row for row in pending
+          if (user is None or row[2] == user) and (messageType is None or row[4] == messageType)
+      ]
+      return (rows + pending)[-limit:]
+
+    async def get_conversation(self, user, messageType, turns=5):
+      """Return the latest `turns` requests of a user of a message type, along with
+      the answers to them, oldest first.
+
+      Rows hold the columns of `HISTORY_COLUMNS`.
+      """
+      if isinstance(messageType, MessageType):
+        messageType = messageType.value
+
+      rows, pending = await self._read(CONVERSATION_QUERY, (user, messageType, turns, 2 * turns))
+      event_ids = {row[6] for row in rows}
+      event_ids.update(row[6] for row in pending if row[2] == user and row[4] == messageType)
+      rows += [row for row in pending if row[6] in event_ids]
+      return rows[-2 * turns:]
+
+    async def _read(self, query, params):
+      """Run a lookup on the messages table.
+
+      Returns:
+          The resulting rows in reverse order (for queries sorting newest first), and
+          the messages that have not been written yet.
+      """
+      # More batches may start while waiting, and those don't wait for this read
+      while self._writes:
+        await asyncio.wait(list(self._writes))
+
+      # Batches taken from here on wait for the query, so they are not in its result
+      pending = list(self._pending)
+      rows = await self._track(self._reads, self._run(self._fetchall, query, params, prepare=True))
+      return list(reversed(rows)), pending
+
+    async def get_cached_response(self, cache_key, min_created_at):
+      """Return the cached response for the key, if it was stored at or after `min_created_at`"""
+      row = await self._run(
+          self._fetchone,
+          "SELECT response FROM response_cache WHERE cache_key = ? AND created_at >= ?",
+          (cache_key, min_created_at),
+      )
+      return row[0] if row else None
+
+    async def put_cached_response(self, cache_key, model, response, created_at):
+      await self._run(self._execute, '''
+          INSERT INTO response_cache (cache_key, model, response, created_at)
+          VALUES (?, ?, ?, ?)
+          ON CONFLICT (cache_key) DO UPDATE SET response = excluded.response, created_at = excluded.created_at
+      ''', (cache_key, model, response, created_at))
+
+    async def evict_cached_responses(self, min_created_at, max_rows):
+      """Remove expired cache entries, then the oldest ones until at most `max_rows` remain"""
+      await self._run(self._evict_cached_responses, min_created_at, max_rows)
+
+    def _evict_cached_responses(self, min_created_at, max_rows):
+      self._execute("DELETE FROM response_cache WHERE created_at < ?", (min_created_at,))
+      excess = self._fetchone("SELECT COUNT(*) FROM response_cache")[0] - max_rows
+      if excess > 0:
+        self._execute('''
+            DELETE FROM response_cache WHERE cache_key IN (
+              SELECT cache_key FROM response_cache ORDER BY created_at ASC LIMIT ?
+            )
+        ''', (excess,))
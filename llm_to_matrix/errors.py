@@ -1,4 +1,5 @@
 # This file holds custom error types that you can define for your application.
+from typing import Optional
 
 
 class ConfigError(RuntimeError):
@@ -10,3 +11,42 @@ class ConfigError(RuntimeError):
 
     def __init__(self, msg: str):
         super(ConfigError, self).__init__("%s" % (msg,))
+
+
+class LLMError(RuntimeError):
+    """An error encountered while talking to the LLM backend.
+
+    Args:
+        msg: The message displayed to the user on error.
+
+        status: The HTTP status code returned by the backend, if any.
+    """
+
+    def __init__(self, msg: str, status: Optional[int] = None):
+        super(LLMError, self).__init__("%s" % (msg,))
+        self.status = status
+
+
+class BackendUnavailableError(LLMError):
+    """Raised instead of sending a request while no LLM backend takes requests.
+
+    Args:
+        msg: The message displayed to the user on error.
+
+        retry_after: Seconds until a backend takes requests again.
+    """
+
+    def __init__(self, msg: str, retry_after: float = 0):
+        super(BackendUnavailableError, self).__init__(msg, status=503)
+        self.retry_after = retry_after
+
+
+class FetchError(RuntimeError):
+    """An error encountered while fetching a web page.
+
+    Args:
+        msg: The message displayed to the user on error.
+    """
+
+    def __init__(self, msg: str):
+        super(FetchError, self).__init__("%s" % (msg,))
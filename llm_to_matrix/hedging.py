@@ -0,0 +1,52 @@
+from collections import deque
+from typing import Deque, Dict, Hashable, Optional
+
+
+class LatencyTracker:
+    def __init__(self, percentile: float = 95, window: int = 100, min_samples: int = 20):
+        """Tracks recent latencies of the LLM backends, to decide when to hedge a
+        request.
+
+        A hedged request is sent to a second backend once the first one has taken
+        longer than nearly all recent requests of the same kind did (the
+        `percentile` of their latencies). Whichever backend answers first wins, so a
+        slow or stuck backend no longer sets the latency. As only the slowest few
+        percent of requests are sent twice, the extra load stays small.
+
+        Args:
+            percentile: The percentile of recent latencies after which a request is
+                hedged.
+
+            window: The number of latest requests of each kind that are considered.
+
+            min_samples: Requests of a kind are only hedged once this many of them
+                have finished.
+        """
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}  # type: Dict[Hashable, Deque[float]]
+
+    def record(self, key: Hashable, seconds: float) -> None:
+        """Record the latency of a finished request.
+
+        Args:
+            key: The kind of request, e.g. the model and whether it is streamed.
+
+            seconds: The time the request took.
+        """
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def hedge_delay(self, key: Hashable) -> Optional[float]:
+        """Seconds after which a request of the given kind should be hedged, or None
+        if too few of them have finished to tell
+        """
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)
+        return ordered[index]
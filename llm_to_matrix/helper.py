@@ -1,6 +1,21 @@
 import re
+import zlib
 from urllib.parse import urlparse
 
+# Rough number of characters per token, used to turn token budgets into text lengths
+CHARS_PER_TOKEN = 4
+
+# Sentence or paragraph ends, the units content is chunked on
+UNIT_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+
+# On average, end a chunk after every this many units (once it is big enough)
+CHUNK_BOUNDARY_EVERY = 8
+
+def estimate_tokens(text):
+    """Estimate the number of tokens of a text, without tokenizing it"""
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
 def prepare_msg(tmplt, msg):
     if not tmplt.strip():
         return msg
@@ -25,3 +40,42 @@ def validate_url(url):
         r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
     return re.match(regex, url) is not None and bool(parsed_url.netloc), url
+
+
+def split_into_chunks(text, max_chars):
+    """Split text into chunks of at most `max_chars` characters.
+
+    Chunks end on sentence or paragraph boundaries. Where a chunk ends is decided by
+    the content of the sentence at the boundary, not by its position, so an edit to
+    one part of the text only changes the chunks around the edit.
+    """
+    min_chars = max_chars // 4
+
+    units = []
+    for unit in UNIT_BOUNDARY.split(text):
+        unit = unit.strip()
+        # A single unit that doesn't fit is cut into pieces
+        while len(unit) > max_chars:
+            units.append(unit[:max_chars])
+            unit = unit[max_chars:]
+        if unit:
+            units.append(unit)
+
+    chunks = []
+    current = []
+    size = 0
+    for unit in units:
+        if current and size + len(unit) > max_chars:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+
+        current.append(unit)
+        size += len(unit) + 1
+
+        if size >= min_chars and zlib.crc32(unit.encode()) % CHUNK_BOUNDARY_EVERY == 0:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
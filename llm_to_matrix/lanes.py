@@ -0,0 +1,79 @@
+import asyncio
+import logging
+from enum import Enum
+from typing import Awaitable, Callable, Dict, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Lane(Enum):
+    """The kinds of commands, by how long they take to process"""
+
+    # Answered straight away without touching the LLM backend (help, echo, ...)
+    INSTANT = "instant"
+    # Needs a quick round trip to the LLM backend (ls)
+    METADATA = "metadata"
+    # Runs a generation, which can take minutes (cm, code, li, ...)
+    GENERATION = "generation"
+
+
+class CommandLanes:
+    def __init__(self, workers: Dict[str, int]):
+        """Runs commands in the background, with a separate worker budget per lane.
+
+        A saturated generation lane only holds up other generations, so cheap commands
+        are answered right away even when every generation slot is taken.
+
+        Args:
+            workers: The number of commands of each lane (keyed by `Lane.value`)
+                that may be processed at the same time.
+        """
+        self.workers = workers
+        self.waiting = {lane: 0 for lane in Lane}  # type: Dict[Lane, int]
+        self.running = {lane: 0 for lane in Lane}  # type: Dict[Lane, int]
+
+        # Created on first use so they are bound to the running event loop
+        self._semaphores = {}  # type: Dict[Lane, asyncio.Semaphore]
+        self._tasks = set()  # type: Set[asyncio.Future]
+
+    def submit(self, lane: Lane, process: Callable[[], Awaitable[None]]) -> asyncio.Future:
+        """Process a command in the given lane without waiting for it to finish.
+
+        Args:
+            lane: The lane the command belongs to.
+
+            process: Called to process the command once a worker of the lane is free.
+
+        Returns:
+            The task processing the command.
+        """
+        task = asyncio.ensure_future(self._run(lane, process))
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    async def _run(self, lane: Lane, process: Callable[[], Awaitable[None]]) -> None:
+        semaphore = self._semaphores.get(lane)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.workers[lane.value])
+            self._semaphores[lane] = semaphore
+
+        self.waiting[lane] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[lane] -= 1
+
+        self.running[lane] += 1
+        try:
+            await process()
+        finally:
+            self.running[lane] -= 1
+            semaphore.release()
+
+    def _task_done(self, task: asyncio.Future) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Error while processing a command", exc_info=task.exception()
+            )
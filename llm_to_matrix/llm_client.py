@@ -0,0 +1,480 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+from urllib.parse import urljoin
+
+import aiohttp
+
+from llm_to_matrix.catalog import ModelCatalog
+from llm_to_matrix.config import Config
+from llm_to_matrix.errors import BackendUnavailableError, LLMError
+from llm_to_matrix.hedging import LatencyTracker
+from llm_to_matrix.helper import estimate_tokens
+from llm_to_matrix.response_cache import ResponseCache
+from llm_to_matrix.router import Backend, BackendRouter, has_model
+from llm_to_matrix.scheduler import GenerationScheduler
+from llm_to_matrix.sessions import SessionCache
+from llm_to_matrix.singleflight import SingleFlight
+from llm_to_matrix.summary_cache import SummaryCache
+from llm_to_matrix.warmup import ModelWarmer
+
+logger = logging.getLogger(__name__)
+
+# Health checks fail after this many seconds
+HEALTH_CHECK_TIMEOUT = 5
+
+# Lists the models loaded into memory
+PS_SUFFIX = "/api/ps"
+
+
+class LLMClient:
+    def __init__(self, config: Config, cache: Optional[ResponseCache] = None):
+        """An async client for the LLM backend (the Ollama HTTP API).
+
+        A single instance is created by `main()` and shared by every command, so all
+        requests go through one keep-alive connection pool instead of opening a new
+        blocking connection per call.
+
+        Args:
+            config: Bot configuration parameters.
+
+            cache: Cache for the answers of deterministic generations. None disables
+                caching.
+        """
+        self.config = config
+        self.cache = cache
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+
+        # Spreads requests over the configured backends
+        self.router = BackendRouter(
+            config.llm_backends,
+            config.llm_backend_max_failures,
+            config.llm_backend_eject_time,
+        )
+
+        # Decides when a request is sent to a second backend, see `LatencyTracker`
+        self.latency = LatencyTracker(config.llm_hedge_percentile)
+        self.hedged = 0
+        self.hedges_won = 0
+
+        # Admission control for generations, see `GenerationScheduler.slot`
+        self.scheduler = GenerationScheduler(
+            config.llm_max_concurrent,
+            config.llm_model_concurrency,
+            config.llm_default_model_concurrency,
+        )
+
+        # Identical generations that are in flight at the same time are only run once
+        self.inflight = SingleFlight()
+
+        # The backend's state of each conversation, to continue it from
+        self.sessions = SessionCache(config.llm_sessions, config.llm_session_ttl)
+
+        # Summaries of the parts of long pages, see `Command._summarize_chunk`
+        self.summaries = SummaryCache(config.llm_summary_cache_size)
+
+        # The installed models, refreshed in the background by `main()`
+        self.catalog = ModelCatalog(self, config.llm_catalog_refresh)
+
+        # Keeps the models in use loaded on the backend
+        self.warmer = ModelWarmer(
+            self,
+            config.llm_keep_alive,
+            config.llm_hot_keep_alive,
+            config.llm_hot_models,
+        )
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The pooled HTTP session. Created lazily so that it is bound to the running
+        event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.config.llm_pool_size,
+                keepalive_timeout=self.config.llm_keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers={"Content-Type": "application/json"},
+            )
+        return self._session
+
+    def _timeout(self, timeout: Optional[float] = None) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(
+            total=timeout if timeout is not None else self.config.llm_timeout,
+            connect=self.config.llm_connect_timeout,
+        )
+
+    async def _request(
+        self,
+        method: str,
+        suffix: str,
+        payload: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+        base_url: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        url = urljoin(base_url or self.router.pick().url, suffix)
+        try:
+            async with self.session.request(
+                method, url, json=payload, timeout=self._timeout(timeout)
+            ) as response:
+                if not 200 <= response.status < 300:
+                    text = await response.text()
+                    raise LLMError(
+                        f"An error occurred while fetching the API({response.status}): {text}",
+                        status=response.status,
+                    )
+                return await response.json(content_type=None)
+        except ValueError as e:
+            raise LLMError(f"Invalid response from the LLM backend: {e}")
+        except asyncio.TimeoutError:
+            raise LLMError(f"The request to {url} timed out")
+        except aiohttp.ClientError as e:
+            raise LLMError(f"An unknown error: {e}")
+
+    async def generate(
+        self, payload: Dict[str, Any], timeout: Optional[float] = None, hedge: bool = False
+    ) -> Dict[str, Any]:
+        """Run a (non-streaming) generation against the backend.
+
+        Args:
+            payload: The request body for the generate endpoint.
+
+            timeout: Total timeout in seconds. Defaults to `llm.llm_timeout`.
+
+            hedge: Whether the generation is latency-sensitive and may be hedged, see
+                `LatencyTracker`.
+
+        Returns:
+            The decoded JSON response.
+
+        Raises:
+            BackendUnavailableError: If no backend takes requests right now.
+
+            LLMError: If the backend could not be reached, timed out, returned a
+                non-2xx status or a response that isn't JSON.
+        """
+        payload = self.warmer.prepare(payload)
+        delay = self._hedge_delay(payload, False) if hedge else None
+        if delay is None:
+            json_data = await self._generate(self.router.route(payload.get("model")), payload, timeout)
+        else:
+            json_data = await self._generate_hedged(payload, timeout, delay)
+        self.warmer.observe(payload, json_data)
+        return json_data
+
+    async def _generate(self, route, payload: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        started = time.monotonic()
+        async with route as backend:
+            json_data = await self._request(
+                "POST",
+                self.config.llm_url_suffix,
+                dict(payload, stream=False),
+                timeout,
+                base_url=backend.url,
+            )
+        self.latency.record((payload.get("model"), False), time.monotonic() - started)
+        return json_data
+
+    async def _generate_hedged(
+        self, payload: Dict[str, Any], timeout: Optional[float], delay: float
+    ) -> Dict[str, Any]:
+        model = payload.get("model")
+        primary = self.router.route(model)
+        tasks = [asyncio.ensure_future(self._generate(primary, payload, timeout))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                backend = self._hedge_backend(model, primary.backend)
+                if backend is not None:
+                    tasks.append(
+                        asyncio.ensure_future(
+                            self._generate(self.router.route(model, backend), payload, timeout)
+                        )
+                    )
+            winner = await self._race(tasks)
+            return winner.result()
+        finally:
+            for task in tasks:
+                await self._cancel(task)
+
+    async def generate_stream(
+        self, payload: Dict[str, Any], timeout: Optional[float] = None, hedge: bool = False
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Run a streaming generation against the backend.
+
+        Ollama answers a streaming request with newline-delimited JSON objects, each
+        holding the next piece of the `response`. The last object has `done` set and
+        carries the timing statistics.
+
+        Args:
+            payload: The request body for the generate endpoint.
+
+            timeout: Total timeout in seconds. Defaults to `llm.llm_timeout`.
+
+            hedge: Whether the generation is latency-sensitive and may be hedged, see
+                `LatencyTracker`. A hedged stream goes on with the backend that sends
+                the first chunk.
+
+        Yields:
+            Each decoded chunk, as it arrives.
+
+        Raises:
+            BackendUnavailableError: If no backend takes requests right now.
+
+            LLMError: If the backend could not be reached, timed out, returned a
+                non-2xx status or reported an error mid-stream.
+        """
+        payload = self.warmer.prepare(payload)
+        delay = self._hedge_delay(payload, True) if hedge else None
+        if delay is None:
+            stream = self._routed_stream(self.router.route(payload.get("model")), payload, timeout)
+        else:
+            stream = self._hedged_stream(payload, timeout, delay)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            # Releases the connection right away if the caller stops early
+            await stream.aclose()
+
+    async def _routed_stream(
+        self, route, payload: Dict[str, Any], timeout: Optional[float]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        started = time.monotonic()
+        async with route as backend:
+            stream = self._stream(backend.url, payload, timeout)
+            try:
+                first = True
+                async for chunk in stream:
+                    if first:
+                        # Streams are hedged by the time to their first chunk
+                        self.latency.record((payload.get("model"), True), time.monotonic() - started)
+                        first = False
+                    yield chunk
+            finally:
+                await stream.aclose()
+
+    async def _hedged_stream(
+        self, payload: Dict[str, Any], timeout: Optional[float], delay: float
+    ) -> AsyncIterator[Dict[str, Any]]:
+        model = payload.get("model")
+        primary = self.router.route(model)
+        streams = [self._routed_stream(primary, payload, timeout)]
+        firsts = [asyncio.ensure_future(streams[0].__anext__())]
+        try:
+            done, _ = await asyncio.wait(firsts, timeout=delay)
+            if not done:
+                backend = self._hedge_backend(model, primary.backend)
+                if backend is not None:
+                    streams.append(self._routed_stream(self.router.route(model, backend), payload, timeout))
+                    firsts.append(asyncio.ensure_future(streams[1].__anext__()))
+
+            winner = await self._race(firsts)
+            for stream, first in zip(streams, firsts):
+                if first is not winner:
+                    await self._cancel(first)
+                    await stream.aclose()
+
+            if isinstance(winner.exception(), StopAsyncIteration):
+                return
+            yield winner.result()
+            async for chunk in streams[firsts.index(winner)]:
+                yield chunk
+        finally:
+            for stream, first in zip(streams, firsts):
+                await self._cancel(first)
+                await stream.aclose()
+
+    def _hedge_delay(self, payload: Dict[str, Any], streamed: bool) -> Optional[float]:
+        """Seconds after which to hedge a generation, or None not to hedge it"""
+        if not self.config.llm_hedge or len(self.router.backends) < 2:
+            return None
+        tokens = estimate_tokens(payload.get("prompt", "")) + len(payload.get("context") or [])
+        if tokens > self.config.llm_hedge_max_prompt_tokens:
+            return None
+        return self.latency.hedge_delay((payload.get("model"), streamed))
+
+    def _hedge_backend(self, model: Optional[str], primary: Optional[Backend]) -> Optional[Backend]:
+        """The backend to send the second request of a hedged generation to, if any"""
+        if primary is None:
+            return None
+        try:
+            backend = self.router.pick(model, exclude=[primary])
+        except BackendUnavailableError:
+            return None
+        if model is not None and backend.installed is not None and not has_model(model, backend.installed):
+            return None
+        self.hedged += 1
+        logger.debug(f"Hedging a generation with {model} on {backend.url}")
+        return backend
+
+    async def _race(self, tasks: List[asyncio.Future]) -> asyncio.Future:
+        """Wait for the first of the requests of a hedged generation to succeed.
+
+        Returns:
+            The task that succeeded.
+
+        Raises:
+            LLMError: The error of the first request that failed, if all of them
+                failed.
+        """
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in tasks:
+                if task not in done:
+                    continue
+                exception = task.exception()
+                # A stream that ended straight away succeeded as well
+                if exception is None or isinstance(exception, StopAsyncIteration):
+                    if task is not tasks[0]:
+                        self.hedges_won += 1
+                    return task
+                error = error or exception
+        raise error
+
+    @staticmethod
+    async def _cancel(task: asyncio.Future) -> None:
+        if not task.done():
+            task.cancel()
+            await asyncio.wait([task])
+
+    async def _stream(
+        self, base_url: str, payload: Dict[str, Any], timeout: Optional[float]
+    ) -> AsyncIterator[Dict[str, Any]]:
+        url = urljoin(base_url, self.config.llm_url_suffix)
+        try:
+            async with self.session.post(
+                url, json=dict(payload, stream=True), timeout=self._timeout(timeout)
+            ) as response:
+                if not 200 <= response.status < 300:
+                    text = await response.text()
+                    raise LLMError(
+                        f"An error occurred while fetching the API({response.status}): {text}",
+                        status=response.status,
+                    )
+
+                # Split lines ourselves: the final chunk carries the whole `context`
+                # array and easily exceeds aiohttp's readline limit
+                buffer = b""
+                async for data in response.content.iter_any():
+                    buffer += data
+                    *lines, buffer = buffer.split(b"\n")
+                    for line in lines:
+                        if not line.strip():
+                            continue
+                        chunk = json.loads(line)
+                        if "error" in chunk:
+                            raise LLMError(f"An unknown error: {chunk['error']}")
+                        if chunk.get("done"):
+                            self.warmer.observe(payload, chunk)
+                        yield chunk
+                if buffer.strip():
+                    chunk = json.loads(buffer)
+                    if chunk.get("done"):
+                        self.warmer.observe(payload, chunk)
+                    yield chunk
+        except ValueError as e:
+            raise LLMError(f"Invalid response from the LLM backend: {e}")
+        except asyncio.TimeoutError:
+            raise LLMError(f"The request to {url} timed out")
+        except aiohttp.ClientError as e:
+            raise LLMError(f"An unknown error: {e}")
+
+    async def load(self, model: str, keep_alive: int, timeout: Optional[float] = None) -> None:
+        """Load a model on the backend without generating anything.
+
+        Args:
+            model: The model to load.
+
+            keep_alive: Seconds the model should stay loaded. -1 keeps it loaded
+                indefinitely.
+
+            timeout: Total timeout in seconds. Defaults to `llm.llm_timeout`.
+
+        Raises:
+            LLMError: If the backend could not be reached or returned an error.
+        """
+        async with self.router.route(model) as backend:
+            await self._request(
+                "POST",
+                self.config.llm_url_suffix,
+                {"model": model, "keep_alive": keep_alive, "stream": False},
+                timeout,
+                base_url=backend.url,
+            )
+
+    async def list_models(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Fetch the list of models available on any of the backends.
+
+        Raises:
+            LLMError: If none of the backends could be reached.
+        """
+        backends = self.router.available()
+        if not backends:
+            raise self.router.unavailable()
+        results = await asyncio.gather(
+            *(
+                self._request("GET", self.config.llm_tags_suffix, timeout=timeout, base_url=backend.url)
+                for backend in backends
+            ),
+            return_exceptions=True,
+        )
+
+        models = {}  # type: Dict[str, Dict[str, Any]]
+        errors = []
+        for backend, result in zip(backends, results):
+            if isinstance(result, LLMError):
+                self.router.failure(backend, result)
+                errors.append(result)
+                continue
+            if isinstance(result, BaseException):
+                raise result
+            for model in result.get("models", []):
+                models.setdefault(model["name"], model)
+
+        if len(errors) == len(backends):
+            raise errors[0]
+        return {"models": list(models.values())}
+
+    async def run_health_checks(self) -> None:
+        """Check every backend each `llm_health_interval` seconds, until cancelled.
+
+        The router learns which models each backend has installed and loaded.
+        Backends that can't be reached count as failed.
+        """
+        while True:
+            await asyncio.gather(
+                *(self._check_backend(backend) for backend in self.router.backends)
+            )
+            await asyncio.sleep(self.config.llm_health_interval)
+
+    async def _check_backend(self, backend) -> None:
+        try:
+            tags = await self._request(
+                "GET", self.config.llm_tags_suffix, timeout=HEALTH_CHECK_TIMEOUT, base_url=backend.url
+            )
+        except LLMError as e:
+            logger.debug(f"Health check of {backend.url} failed: {e}")
+            self.router.failure(backend, e)
+            return
+
+        loaded = None
+        try:
+            ps = await self._request("GET", PS_SUFFIX, timeout=HEALTH_CHECK_TIMEOUT, base_url=backend.url)
+            loaded = [model["name"] for model in ps.get("models", [])]
+        except LLMError as e:
+            # Older versions of Ollama can't tell
+            logger.debug(f"Can't list the loaded models of {backend.url}: {e}")
+
+        self.router.update(backend, [model["name"] for model in tags.get("models", [])], loaded)
+
+    async def close(self) -> None:
+        """Close the connection pool"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
@@ -2,11 +2,10 @@
 import asyncio
 import logging
 import sys
-from time import sleep
+from time import sleep, time
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
-    AsyncClient,
     AsyncClientConfig,
     InviteMemberEvent,
     LocalProtocolError,
@@ -18,8 +17,14 @@ from nio import (
 # from llm_to_matrix.storage import Storage
 from llm_to_matrix.conversation_store import ConversationStore
 
+from llm_to_matrix.bot_commands import CODE_MODEL, SUMMARY_MODEL
 from llm_to_matrix.callbacks import Callbacks
 from llm_to_matrix.config import Config
+from llm_to_matrix.llm_client import LLMClient
+from llm_to_matrix.outbox import Outbox, get_outbox, set_outbox
+from llm_to_matrix.parser.fetcher import PageFetcher
+from llm_to_matrix.response_cache import ResponseCache
+from llm_to_matrix.sync import SyncClient
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +32,7 @@ logger = logging.getLogger(__name__)
 
 async def main():
     """The first function that is run when starting the bot"""
+    started = time()
 
     # Read user-configured options from a config file.
     # A different config file path can be specified as the first command line argument
@@ -39,7 +45,11 @@ async def main():
     config = Config(config_path)
 
     # Configure the database
-    store = ConversationStore(database_config=config.database)
+    store = ConversationStore(
+        database_config=config.database,
+        write_batch_size=config.database_write_batch_size,
+        write_batch_interval=config.database_write_batch_interval / 1000,
+    )
 
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
@@ -50,20 +60,41 @@ async def main():
     )
 
     # Initialize the matrix client
-    client = AsyncClient(
+    client = SyncClient(
         config.homeserver_url,
         config.user_id,
         device_id=config.device_id,
         store_path=config.store_path,
         config=client_config,
+        timeline_limit=config.sync_timeline_limit,
+        lean=config.lean_sync,
     )
 
+    # Everything sent to rooms goes through this, within the homeserver's rate limits
+    set_outbox(Outbox(client, config.send_rate, config.send_burst, config.send_retries))
+
     if config.user_token:
         client.access_token = config.user_token
         client.user_id = config.user_id
 
+    # Answers of deterministic generations are reused instead of run again
+    cache = None
+    if config.llm_cache_enabled:
+        cache = ResponseCache(
+            store,
+            max_entries=config.llm_cache_size,
+            ttl=config.llm_cache_ttl,
+            max_rows=config.llm_cache_max_rows,
+        )
+
+    # A single pooled client for the LLM backend, shared by every command
+    llm = LLMClient(config, cache)
+
+    # Fetches the pages summarized by the `li` command
+    fetcher = PageFetcher(config)
+
     # Set up event callbacks
-    callbacks = Callbacks(client, store, config)
+    callbacks = Callbacks(client, store, config, llm, fetcher, started=started)
     client.add_event_callback(callbacks.message, (RoomMessageText,))
     client.add_event_callback(
         callbacks.invite_event_filtered_callback, (InviteMemberEvent,)
@@ -71,52 +102,91 @@ async def main():
     client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
     client.add_event_callback(callbacks.unknown, (UnknownEvent,))
 
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
+    # Checkpoints, statistics and vacuuming for SQLite
+    maintenance = asyncio.ensure_future(store.run_maintenance())
+
+    # Keeps the list of installed models current
+    catalog_refresh = asyncio.ensure_future(llm.catalog.run())
+
+    # Ejects failing LLM backends and takes them back once they recover
+    health_checks = asyncio.ensure_future(llm.run_health_checks())
+
+    # Spare the first users of each model the wait for it to be loaded
+    preload = asyncio.ensure_future(
+        llm.warmer.preload([config.llm_model, CODE_MODEL, SUMMARY_MODEL] + config.llm_preload_models)
+    )
+
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
+            try:
+                if config.user_token:
+                    # Use token to log in
+                    client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                else:
+                    # Try to login with the configured username/password
+                    try:
+                        login_response = await client.login(
+                            password=config.user_password,
+                            device_name=config.device_name,
+                        )
+
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            logger.error("Failed to login: %s", login_response.message)
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the correct C
+                        # dependencies. In that case, a LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
                         return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
-                    )
-                    return False
-
-                # Login succeeded!
-
-            logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
-
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
-
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+
+                    # Login succeeded!
+
+                logger.info(f"Logged in as {config.user_id}")
+
+                # Without a sync token, the first sync replays the rooms' history
+                if config.skip_backlog and not (client.loaded_sync_token or client.next_batch):
+                    logger.info("No sync token stored, ignoring messages sent before the start")
+                    callbacks.skip_backlog()
+
+                await client.sync_forever(
+                    timeout=30000,
+                    sync_filter=await client.sync_filter(),
+                    full_state=client.needs_full_state(),
+                )
+
+            except (ClientConnectionError, ServerDisconnectedError):
+                logger.warning("Unable to connect to homeserver, retrying in 15s...")
+
+                # Sleep so we don't bombard the server with login requests
+                sleep(15)
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+    finally:
+        maintenance.cancel()
+        catalog_refresh.cancel()
+        health_checks.cancel()
+        preload.cancel()
+        logger.info(f"Model loads: {llm.warmer.stats()}")
+        get_outbox(client).indicators.close()
+        logger.info(f"Messages sent: {get_outbox(client).stats()}")
+        logger.info(f"Syncs: {client.sync_stats.stats()}")
+        if llm.hedged:
+            logger.info(f"Hedged {llm.hedged} generations, {llm.hedges_won} answered by the second backend")
+        await llm.close()
+        await fetcher.close()
+        await store.close()
 
 
 # Run the main function in an asyncio event loop
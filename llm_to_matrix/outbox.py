@@ -0,0 +1,320 @@
+import asyncio
+import logging
+import random
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Union
+from uuid import uuid4
+
+from aiohttp import ClientConnectionError
+from nio import (
+    AsyncClient,
+    ErrorResponse,
+    RoomSendError,
+    RoomSendResponse,
+    SendRetryError,
+)
+
+from llm_to_matrix.typing_indicators import TypingIndicators
+
+logger = logging.getLogger(__name__)
+
+# Errors of a send that may go through when tried again
+RETRYABLE_ERRORS = (SendRetryError, ClientConnectionError, asyncio.TimeoutError)
+
+# How long to wait when the homeserver rate limits us without saying for how long
+DEFAULT_RETRY_AFTER = 5.0
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        """Limits the rate of requests to the homeserver.
+
+        Up to `burst` requests go through straight away, after that `rate` per
+        second. When the homeserver says we are sending too much, nothing goes
+        through until it says we may send again.
+
+        Args:
+            rate: Requests per second in the long run.
+
+            burst: Requests that may be sent at once.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return now
+
+    def wait_time(self) -> float:
+        """Seconds until a request may be sent"""
+        now = self._refill()
+        if self._paused_until > now:
+            return self._paused_until - now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def try_acquire(self) -> bool:
+        """Take a token if one is available right away"""
+        if self.wait_time() > 0:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self) -> None:
+        """Wait for a token and take it"""
+        while not self.try_acquire():
+            await asyncio.sleep(self.wait_time())
+
+    def pause(self, seconds: float) -> None:
+        """Send nothing for the given time, e.g. as told by the homeserver"""
+        self._refill()
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+
+class _Pending:
+    def __init__(self, message_type: str, content: Dict[str, Any], merge: bool):
+        self.message_type = message_type
+        self.content = content
+        self.merge = merge
+        self.futures = []  # type: List[asyncio.Future]
+
+    @property
+    def replaces(self) -> Optional[str]:
+        """The event this message edits, if any"""
+        relation = self.content.get("m.relates_to") or {}
+        if relation.get("rel_type") == "m.replace":
+            return relation.get("event_id")
+        return None
+
+    def absorb(self, message_type: str, content: Dict[str, Any], merge: bool) -> bool:
+        """Fold a later message into this one, if they can be sent as one.
+
+        A newer edit of the same event supersedes this one, and text messages that
+        both allow it are joined.
+        """
+        if message_type != self.message_type or message_type != "m.room.message":
+            return False
+
+        replaces = self.replaces
+        if replaces is not None:
+            if (content.get("m.relates_to") or {}).get("event_id") != replaces:
+                return False
+            self.content = content
+            return True
+
+        if not (merge and self.merge) or "m.relates_to" in content:
+            return False
+        if content.get("msgtype") != self.content.get("msgtype"):
+            return False
+        if ("formatted_body" in content) != ("formatted_body" in self.content):
+            return False
+
+        merged = dict(self.content, body=f"{self.content['body']}\n\n{content['body']}")
+        if "formatted_body" in content:
+            merged["formatted_body"] = self.content["formatted_body"] + content["formatted_body"]
+        self.content = merged
+        return True
+
+
+class Outbox:
+    def __init__(
+        self,
+        client: AsyncClient,
+        rate: float = 10,
+        burst: int = 20,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+    ):
+        """Sends events to rooms, one room at a time in order, within the rate the
+        homeserver allows.
+
+        Messages wait in a queue per room. While one is being sent (or the homeserver
+        makes us wait), later edits of the same event replace the queued one, and
+        text messages sent with `merge` are joined into one event. Sends that fail
+        with `SendRetryError` or a connection error are tried again after a growing
+        delay, with the same transaction ID so the homeserver never shows them twice.
+
+        Args:
+            client: The client to communicate to matrix with.
+
+            rate: Events per second sent in the long run.
+
+            burst: Events that may be sent at once.
+
+            max_retries: Tries after the first one before a send is given up.
+
+            backoff: Seconds before the first retry, doubled with every further one.
+        """
+        self.client = client
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.typing_skipped = 0
+
+        self._queues = {}  # type: Dict[str, List[_Pending]]
+        self._workers = {}  # type: Dict[str, asyncio.Future]
+        # Until when each room shows that we are typing (monotonic time)
+        self._typing = {}  # type: Dict[str, float]
+        # Keeps the typing indicators up while requests are worked on
+        self.indicators = TypingIndicators(self)
+
+    async def send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        merge: bool = False,
+    ) -> Optional[Union[RoomSendResponse, ErrorResponse]]:
+        """Send an event to a room, after the ones queued before it.
+
+        Args:
+            room_id: The ID of the room to send the event to.
+
+            message_type: The type of the event, e.g. "m.room.message".
+
+            content: The content of the event.
+
+            merge: Whether the message may be joined with other queued messages that
+                allow it. Only for messages that are never edited later.
+
+        Returns:
+            The response to the event the message was sent in, or None if it
+            couldn't be sent.
+        """
+        future = asyncio.get_event_loop().create_future()
+        queue = self._queues.setdefault(room_id, [])
+        if queue and queue[-1].absorb(message_type, content, merge):
+            self.merged += 1
+        else:
+            queue.append(_Pending(message_type, content, merge))
+        queue[-1].futures.append(future)
+
+        if room_id not in self._workers:
+            self._workers[room_id] = asyncio.ensure_future(self._drain(room_id))
+        return await future
+
+    async def typing(self, room_id: str, typing: bool, timeout: int = 30000) -> None:
+        """Show or stop showing that we are typing in a room.
+
+        Typing notifications are only sent when they change something (or the shown
+        one is past half its time), and dropped rather than waited for when we are
+        sending too much.
+        """
+        now = time.monotonic()
+        shown_until = self._typing.get(room_id, 0.0)
+        if typing and shown_until - now > timeout / 2000:
+            return
+        if not typing and shown_until <= now:
+            return
+        if not self.bucket.try_acquire():
+            self.typing_skipped += 1
+            return
+
+        if typing:
+            self._typing[room_id] = now + timeout / 1000
+        else:
+            self._typing.pop(room_id, None)
+        try:
+            await self.client.room_typing(room_id, typing, timeout)
+        except RETRYABLE_ERRORS as e:
+            logger.warning(f"Unable to send typing notification to {room_id}: {e!r}")
+
+    async def _drain(self, room_id: str) -> None:
+        queue = self._queues[room_id]
+        try:
+            while queue:
+                # Taken off the queue, so nothing is merged into it while it is sent
+                pending = queue.pop(0)
+                try:
+                    response = await self._send(room_id, pending)
+                except Exception as e:
+                    for future in pending.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for future in pending.futures:
+                    if not future.done():
+                        future.set_result(response)
+        finally:
+            del self._workers[room_id]
+            del self._queues[room_id]
+
+    async def _send(
+        self, room_id: str, pending: _Pending
+    ) -> Optional[Union[RoomSendResponse, ErrorResponse]]:
+        tx_id = str(uuid4())
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                response = await self.client.room_send(
+                    room_id,
+                    pending.message_type,
+                    pending.content,
+                    tx_id=tx_id,
+                    ignore_unverified_devices=True,
+                )
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"Unable to send message to {room_id} after {attempt} tries: {e!r}")
+                    return None
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.8, 1.2)
+                logger.warning(f"Sending to {room_id} failed ({e!r}), trying again in {delay:.1f}s")
+                self.retries += 1
+                await asyncio.sleep(delay)
+                continue
+
+            if isinstance(response, RoomSendError) and response.status_code == "M_LIMIT_EXCEEDED":
+                attempt += 1
+                self.rate_limited += 1
+                retry_after = (response.retry_after_ms or DEFAULT_RETRY_AFTER * 1000) / 1000
+                if attempt > self.max_retries:
+                    logger.error(f"Unable to send message to {room_id}, still rate limited after {attempt} tries")
+                    return response
+                logger.warning(f"Rate limited by the homeserver, sending again in {retry_after:.1f}s")
+                self.bucket.pause(retry_after)
+                continue
+
+            self.sent += 1
+            return response
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sent": self.sent,
+            "merged": self.merged,
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "typing_skipped": self.typing_skipped,
+        }
+
+
+_outboxes = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[AsyncClient, Outbox]
+
+
+def get_outbox(client: AsyncClient) -> Outbox:
+    """The outbox all events of the client are sent through. Created with the default
+    settings, unless one was set up with `set_outbox`.
+    """
+    outbox = _outboxes.get(client)
+    if outbox is None:
+        outbox = _outboxes[client] = Outbox(client)
+    return outbox
+
+
+def set_outbox(outbox: Outbox) -> None:
+    """Send all events of the outbox's client through it"""
+    _outboxes[outbox.client] = outbox
@@ -0,0 +1,238 @@
+import codecs
+import logging
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Type
+
+logger = logging.getLogger(__name__)
+
+# Rough number of HTML bytes per character of readable text, used when a backend can
+# only judge its budget by the amount of markup it has seen
+HTML_BYTES_PER_CHAR = 10
+
+# Elements whose text is never part of the readable content
+SKIPPED_TAGS = {
+    "head",
+    "script",
+    "style",
+    "noscript",
+    "template",
+    "svg",
+    "nav",
+    "header",
+    "footer",
+    "aside",
+    "form",
+}
+
+# Elements that hold the main content of a page, if present
+CONTENT_TAGS = {"main", "article"}
+
+# Void elements never get an end tag, so they mustn't be tracked as open
+VOID_TAGS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "param",
+    "source",
+    "track",
+    "wbr",
+}
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class Extractor:
+    """Pulls the main readable text out of an HTML page.
+
+    The page is fed in pieces as it is downloaded. `feed` reports once enough text has
+    been gathered, so the download can stop early.
+    """
+
+    name = ""
+
+    def __init__(self, max_chars: Optional[int] = None):
+        """
+        Args:
+            max_chars: The amount of text that is enough. None means the whole page.
+        """
+        self.max_chars = max_chars
+        self.fed = False
+        self._decoder = None  # type: Optional[codecs.IncrementalDecoder]
+
+    def feed(self, data: bytes, encoding: str = "utf-8") -> bool:
+        """Feed the next piece of the page.
+
+        Returns:
+            Whether enough text has been gathered.
+        """
+        if self._decoder is None:
+            try:
+                self._decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+            except LookupError:
+                self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.fed = True
+        return self._feed_text(self._decoder.decode(data))
+
+    def close(self) -> str:
+        """Finish parsing and return the extracted text"""
+        if self._decoder is not None:
+            self._feed_text(self._decoder.decode(b"", final=True))
+        text = self._result()
+        return text[: self.max_chars] if self.max_chars else text
+
+    def _feed_text(self, text: str) -> bool:
+        raise NotImplementedError()
+
+    def _result(self) -> str:
+        raise NotImplementedError()
+
+
+class SoupExtractor(Extractor):
+    """Builds the full DOM with BeautifulSoup and takes the text of the first `main`,
+    `article` or `div` element. Slow and memory hungry on large pages, but forgiving.
+    """
+
+    name = "soup"
+
+    def __init__(self, max_chars: Optional[int] = None):
+        super().__init__(max_chars)
+        self._parts = []  # type: List[str]
+        self._length = 0
+
+    def _feed_text(self, text: str) -> bool:
+        self._parts.append(text)
+        self._length += len(text)
+        return bool(self.max_chars) and self._length >= self.max_chars * HTML_BYTES_PER_CHAR
+
+    def _result(self) -> str:
+        return extract_with_soup("".join(self._parts))
+
+
+class StreamingExtractor(Extractor, HTMLParser):
+    """Event based extraction that never builds a DOM.
+
+    Text inside `main`/`article` elements is preferred; without those, the text of the
+    whole body is used. Boilerplate elements (scripts, navigation, footers, ...) are
+    skipped. Parsing stops as soon as enough content text has been gathered.
+    """
+
+    name = "stream"
+
+    def __init__(self, max_chars: Optional[int] = None):
+        Extractor.__init__(self, max_chars)
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self._open = []  # type: List[str]
+        self._skipping = 0
+        self._in_content = 0
+        self._seen_content = False
+        self._content = []  # type: List[str]
+        self._content_length = 0
+        self._body = []  # type: List[str]
+        self._body_length = 0
+        self._done = False
+
+    def _feed_text(self, text: str) -> bool:
+        if not self._done and text:
+            HTMLParser.feed(self, text)
+        return self._done
+
+    def _result(self) -> str:
+        if not self._done:
+            HTMLParser.close(self)
+        parts = self._content if self._seen_content and self._content else self._body
+        return WHITESPACE.sub(" ", "".join(parts)).strip()
+
+    def handle_starttag(self, tag, attrs):
+        # Element boundaries separate words; text itself may arrive in several pieces
+        self._append(" ")
+        if tag in VOID_TAGS:
+            return
+        if tag == "body" and "head" in self._open:
+            # The end of the head is often left implicit
+            self.handle_endtag("head")
+        self._open.append(tag)
+        if tag in SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in CONTENT_TAGS:
+            self._in_content += 1
+            self._seen_content = True
+
+    def handle_endtag(self, tag):
+        self._append(" ")
+        if tag not in self._open:
+            # Stray end tag
+            return
+        # Implicitly close anything left open inside the element
+        while self._open:
+            open_tag = self._open.pop()
+            if open_tag in SKIPPED_TAGS:
+                self._skipping -= 1
+            elif open_tag in CONTENT_TAGS:
+                self._in_content -= 1
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self._append(data) and self.max_chars and (
+            self._content_length >= self.max_chars
+            # A page without main/article: the body text is all we will get
+            or (not self._seen_content and self._body_length >= 2 * self.max_chars)
+        ):
+            self._done = True
+
+    def _append(self, text: str) -> bool:
+        """Add text to the content or body text, unless it is in a skipped element.
+
+        Returns:
+            Whether the text was kept.
+        """
+        if self._skipping or self._done:
+            return False
+        # Only real text counts towards the budget, not indentation between tags
+        length = len(text) if text.strip() else 0
+        if self._in_content:
+            self._content.append(text)
+            self._content_length += length
+        elif not self._seen_content:
+            self._body.append(text)
+            self._body_length += length
+        else:
+            return False
+        return True
+
+
+EXTRACTORS = {
+    SoupExtractor.name: SoupExtractor,
+    StreamingExtractor.name: StreamingExtractor,
+}  # type: Dict[str, Type[Extractor]]
+
+
+def make_extractor(name: str, max_chars: Optional[int] = None) -> Extractor:
+    """Create the extraction backend with the given name"""
+    try:
+        return EXTRACTORS[name](max_chars)
+    except KeyError:
+        logger.warning(f"Unknown extractor '{name}', using '{SoupExtractor.name}'")
+        return SoupExtractor(max_chars)
+
+
+def extract_with_soup(html: str) -> str:
+    # Imported on first use, as importing it takes longer than the rest of startup
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    main_content = soup.find('main') or soup.find('article') or soup.find('div')
+
+    if main_content:
+        return main_content.get_text(strip=True)
+    else:
+        return ""
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Optional
+
+import aiohttp
+
+from llm_to_matrix.config import Config
+from llm_to_matrix.errors import FetchError
+from llm_to_matrix.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# Size of the pieces the body is read in
+CHUNK_SIZE = 16 * 1024
+
+
+class Page:
+    def __init__(
+        self,
+        url: str,
+        body: bytes,
+        encoding: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        truncated: bool = False,
+        from_cache: bool = False,
+    ):
+        """A fetched web page.
+
+        Args:
+            url: The URL the page was fetched from.
+
+            body: The (possibly truncated) body of the page.
+
+            encoding: The character encoding of the body.
+
+            etag: The ETag header the server sent with the page.
+
+            last_modified: The Last-Modified header the server sent with the page.
+
+            truncated: Whether reading stopped before the end of the body.
+
+            from_cache: Whether the body came from the on-disk cache.
+        """
+        self.url = url
+        self.body = body
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.truncated = truncated
+        self.from_cache = from_cache
+
+    @property
+    def text(self) -> str:
+        return self.body.decode(self.encoding, errors="replace")
+
+
+class PageFetcher:
+    def __init__(self, config: Config):
+        """Fetches web pages for the `li` command without blocking the event loop.
+
+        Every fetch has a strict time and size budget. Fetched pages are kept in an
+        on-disk cache and revalidated with conditional GETs (ETag/Last-Modified), so a
+        popular link is only downloaded again when it changed. Concurrent fetches of
+        the same URL are coalesced.
+
+        Args:
+            config: Bot configuration parameters.
+        """
+        self.config = config
+        self.cache_path = config.fetch_cache_path
+        self._session = None  # type: Optional[aiohttp.ClientSession]
+        self._inflight = SingleFlight()
+
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.fetch_pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.config.fetch_timeout),
+            )
+        return self._session
+
+    async def fetch(
+        self,
+        url: str,
+        max_bytes: Optional[int] = None,
+        on_chunk: Optional[Callable[[bytes, str], bool]] = None,
+    ) -> Page:
+        """Fetch a page, reusing the cached copy if it is still current.
+
+        Args:
+            url: The URL to fetch.
+
+            max_bytes: Stop reading after this many bytes. Capped by
+                `fetch.max_bytes`.
+
+            on_chunk: Called with each piece of the body and its encoding as it is
+                read. Reading stops early once it returns True.
+
+        Raises:
+            FetchError: If the page couldn't be fetched in time or the server
+                returned an error.
+        """
+        limit = self.config.fetch_max_bytes
+        if max_bytes is not None:
+            limit = min(limit, max_bytes)
+
+        page, _ = await self._inflight.do(
+            (url, limit), lambda: self._fetch(url, limit, on_chunk)
+        )
+        return page
+
+    async def _fetch(
+        self, url: str, limit: int, on_chunk: Optional[Callable[[bytes, str], bool]]
+    ) -> Page:
+        cached = await self._run(self._load, url)
+
+        headers = {}  # type: Dict[str, str]
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        try:
+            async with self.session.get(url, headers=headers) as response:
+                if response.status == 304 and cached is not None:
+                    logger.debug(f"Cached copy of {url} is still current")
+                    if on_chunk is not None:
+                        on_chunk(cached.body, cached.encoding)
+                    return cached
+
+                if not 200 <= response.status < 300:
+                    raise FetchError(f"{response.status} {response.reason} for url: {url}")
+
+                encoding = response.charset or "utf-8"
+                body = bytearray()
+                truncated = False
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    chunk = chunk[: limit - len(body)]
+                    body += chunk
+                    if on_chunk is not None and on_chunk(chunk, encoding):
+                        truncated = True
+                        break
+                    if len(body) >= limit:
+                        truncated = True
+                        break
+
+                page = Page(
+                    url,
+                    bytes(body),
+                    encoding,
+                    etag=response.headers.get("ETag"),
+                    last_modified=response.headers.get("Last-Modified"),
+                    truncated=truncated,
+                )
+        except asyncio.TimeoutError:
+            raise FetchError(f"Fetching {url} took too long")
+        except aiohttp.ClientError as e:
+            raise FetchError(str(e))
+
+        if page.etag or page.last_modified:
+            await self._run(self._save, page)
+        return page
+
+    async def _run(self, fn, *args):
+        """Run blocking file access on a worker thread"""
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def _paths(self, url: str):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.cache_path, name)
+        return base + ".json", base + ".html"
+
+    def _load(self, url: str) -> Optional[Page]:
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return Page(
+            url,
+            body,
+            meta["encoding"],
+            etag=meta.get("etag"),
+            last_modified=meta.get("last_modified"),
+            truncated=meta.get("truncated", False),
+            from_cache=True,
+        )
+
+    def _save(self, page: Page) -> None:
+        meta_path, body_path = self._paths(page.url)
+        with open(body_path, "wb") as f:
+            f.write(page.body)
+        with open(meta_path, "w") as f:
+            json.dump(
+                {
+                    "url": page.url,
+                    "encoding": page.encoding,
+                    "etag": page.etag,
+                    "last_modified": page.last_modified,
+                    "truncated": page.truncated,
+                    "fetched_at": int(time.time()),
+                },
+                f,
+            )
+        self._prune()
+
+    def _prune(self) -> None:
+        """Drop the least recently fetched pages beyond `fetch.cache_entries`"""
+        metas = [
+            os.path.join(self.cache_path, name)
+            for name in os.listdir(self.cache_path)
+            if name.endswith(".json")
+        ]
+        excess = len(metas) - self.config.fetch_cache_entries
+        if excess <= 0:
+            return
+        metas.sort(key=os.path.getmtime)
+        for meta_path in metas[:excess]:
+            for path in (meta_path, meta_path[: -len(".json")] + ".html"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    async def close(self) -> None:
+        """Close the connection pool"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
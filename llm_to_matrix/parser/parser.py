@@ -1,20 +1,44 @@
-import requests
-from bs4 import BeautifulSoup
+import logging
 
+from llm_to_matrix.errors import FetchError
+from llm_to_matrix.parser.extractors import SoupExtractor, extract_with_soup, make_extractor
+from llm_to_matrix.parser.fetcher import PageFetcher
+
+logger = logging.getLogger(__name__)
 
-def get_main_content(url):
-    try:
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
 
-        soup = BeautifulSoup(response.text, 'html.parser')
+async def get_main_content(url, fetcher: PageFetcher, max_chars=None):
+    """Fetch a page and extract its main readable text.
 
-        main_content = soup.find('main') or soup.find('article') or soup.find('div')
+    The page is handed to the configured extraction backend while it downloads, and the
+    download stops once the backend has gathered `max_chars` of text. If the backend
+    fails or finds nothing, the BeautifulSoup path is used instead.
 
-        if main_content:
-            return main_content.get_text(strip=True)
-        else:
-            return "Main content could not be identified."
+    Args:
+        url: The URL of the page.
 
-    except requests.RequestException as e:
+        fetcher: The fetcher used to download the page.
+
+        max_chars: Stop once about this much text has been gathered.
+    """
+    extractor = make_extractor(fetcher.config.fetch_extractor, max_chars)
+    try:
+        page = await fetcher.fetch(url, on_chunk=extractor.feed)
+    except FetchError as e:
         return f"Error: {e}"
+
+    content = ""
+    try:
+        if not extractor.fed:
+            # The page was fetched by a concurrent request for the same URL
+            extractor.feed(page.body, page.encoding)
+        content = extractor.close()
+    except Exception:
+        logger.exception(f"Extracting {url} with '{extractor.name}' failed")
+
+    if not content and not isinstance(extractor, SoupExtractor):
+        content = extract_with_soup(page.text)
+        if max_chars:
+            content = content[:max_chars]
+
+    return content or "Main content could not be identified."
@@ -0,0 +1,214 @@
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+# The markdown2 extras used for every message
+MARKDOWN_EXTRAS = {
+    "breaks": {"on_newline": True, "on_backslash": True},
+    "fenced-code-blocks": {},
+}
+
+# Documents of at least this many characters are rendered in a worker thread
+OFFLOAD_CHARS = 4096
+
+# Opens or closes a fenced code block
+FENCE = re.compile(r"^\s*(```|~~~)")
+
+# A line starting a block that doesn't change how the block before it renders. Lists,
+# indented lines and quotes may continue the block before them.
+BLOCK_START = re.compile(r"^(?![ \t<]|[-*+>][ \t]|\d+[.)][ \t])\S")
+
+# A link reference definition, which affects how the whole document renders
+LINK_DEFINITION = re.compile(r"^[ ]{0,3}\[[^\]]+\]:", re.MULTILINE)
+
+
+def split_blocks(text: str) -> List[int]:
+    """Find where the given markdown can be cut so that its parts render independently.
+
+    Returns:
+        The offsets of the blocks after the first one. Rendering the parts separately
+        and joining the results with a line break gives the same HTML as rendering
+        the whole text.
+    """
+    if LINK_DEFINITION.search(text):
+        return []
+
+    offsets = []  # type: List[int]
+    in_fence = False
+    after_blank = False
+    # Blank lines at the start (models often begin with a line break) belong to the
+    # first block, rather than rendering as an empty paragraph of their own
+    seen_text = False
+    position = 0
+    for line in text.splitlines(keepends=True):
+        # A line that is still being written may turn out to continue the block
+        complete = line.endswith("\n")
+        if not in_fence and (after_blank or not position) and line.startswith("<"):
+            # Raw HTML blocks may contain blank lines, so everything after one is
+            # rendered together
+            break
+        if not in_fence and after_blank and seen_text and complete and BLOCK_START.match(line):
+            offsets.append(position)
+        if FENCE.match(line):
+            in_fence = not in_fence
+        after_blank = not in_fence and not line.strip()
+        seen_text = seen_text or not after_blank
+        position += len(line)
+    return offsets
+
+
+def append_footer(text: str, footer: str) -> str:
+    """Add a paragraph (like the statistics of an answer) below markdown text, outside
+    any code block the text leaves open
+    """
+    if not footer:
+        return text
+    fence = None
+    for line in text.splitlines():
+        match = FENCE.match(line)
+        if match:
+            fence = None if fence else match.group(1)
+    if fence:
+        text += "\n" + fence
+    return f"{text}\n\n{footer}"
+
+
+class MarkdownRenderer:
+    def __init__(self, cache_size: int = 128, offload_chars: int = OFFLOAD_CHARS):
+        """Renders the markdown of messages into HTML.
+
+        The renderer is configured once and reused (one per thread, as markdown2 keeps
+        state while converting). Recently rendered texts are cached, as the same text
+        is often sent more than once (e.g. a streamed answer's final edit, or a
+        shared answer sent to several rooms).
+
+        Args:
+            cache_size: The number of rendered texts kept.
+
+            offload_chars: `render_async` renders texts of at least this many
+                characters in a worker thread, so the event loop isn't blocked
+                meanwhile.
+        """
+        self.cache_size = cache_size
+        self.offload_chars = offload_chars
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # type: OrderedDict[str, str]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def render(self, text: str, cache: bool = True) -> str:
+        """Render markdown into HTML.
+
+        Args:
+            text: The markdown to render.
+
+            cache: Whether to keep the result. Texts that won't be rendered again,
+                like the intermediate states of a streamed answer, would only push
+                others out of the cache.
+        """
+        with self._lock:
+            html = self._cache.get(text)
+            if html is not None:
+                self._cache.move_to_end(text)
+                self.hits += 1
+                return html
+            self.misses += 1
+
+        markdown = getattr(self._local, "markdown", None)
+        if markdown is None:
+            # Imported on first use, to keep it out of the startup time
+            import markdown2
+
+            markdown = self._local.markdown = markdown2.Markdown(extras=MARKDOWN_EXTRAS)
+        html = str(markdown.convert(text))
+
+        if cache:
+            with self._lock:
+                self._cache[text] = html
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return html
+
+    async def render_async(self, text: str, cache: bool = True) -> str:
+        """Render markdown into HTML, in a worker thread if the text is large"""
+        if len(text) < self.offload_chars:
+            return self.render(text, cache)
+        return await asyncio.get_event_loop().run_in_executor(None, self.render, text, cache)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+class IncrementalRenderer:
+    def __init__(self, renderer: MarkdownRenderer):
+        """Renders a message that is built up piece by piece, like a streamed answer.
+
+        Blocks that are complete are rendered once and kept, so each update only
+        renders the blocks that changed instead of the whole message again.
+
+        Args:
+            renderer: Renders the individual blocks.
+        """
+        self.renderer = renderer
+        # The complete blocks rendered so far, and their HTML
+        self._done = ""
+        self._done_html = []  # type: List[str]
+
+    def render(self, text: str) -> str:
+        """Render the message as it is now"""
+        blocks, tail = self._split(text)
+        self._commit(blocks, [self._render(block) for block in blocks])
+        return self._join(self._done_html + [self._render(tail)])
+
+    async def render_async(self, text: str) -> str:
+        """Render the message as it is now, in a worker thread if the new part is large"""
+        blocks, tail = self._split(text)
+        html = [await self._render_async(block) for block in blocks]
+        self._commit(blocks, html)
+        return self._join(self._done_html + [await self._render_async(tail)])
+
+    def _render(self, block: str) -> str:
+        # Markdown renders nothing but whitespace as an empty paragraph
+        if not block.strip():
+            return ""
+        return self.renderer.render(block, cache=False)
+
+    async def _render_async(self, block: str) -> str:
+        if not block.strip():
+            return ""
+        return await self.renderer.render_async(block, cache=False)
+
+    def _split(self, text: str) -> Tuple[List[str], str]:
+        """Split off the blocks of the text that were completed since the last update.
+
+        Returns:
+            The newly completed blocks, and the rest of the text.
+        """
+        if not text.startswith(self._done) or LINK_DEFINITION.search(text):
+            # The message was rewritten rather than extended, or links in blocks that
+            # are done may now resolve
+            self._done = ""
+            self._done_html = []
+
+        rest = text[len(self._done) :]
+        blocks = []  # type: List[str]
+        start = 0
+        for offset in split_blocks(rest):
+            blocks.append(rest[start:offset])
+            start = offset
+        return blocks, rest[start:]
+
+    def _commit(self, blocks: List[str], html: List[str]) -> None:
+        self._done += "".join(blocks)
+        self._done_html.extend(html)
+
+    @staticmethod
+    def _join(parts: List[str]) -> str:
+        return "\n".join(part for part in parts if part)
+
+
+# Shared by everything that sends messages
+default_renderer = MarkdownRenderer()
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from llm_to_matrix.conversation_store import ConversationStore
+
+logger = logging.getLogger(__name__)
+
+# Evict expired and surplus rows from the database every this many writes
+EVICT_EVERY = 100
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        store: ConversationStore,
+        max_entries: int = 512,
+        ttl: int = 86400,
+        max_rows: int = 10000,
+    ):
+        """A cache for the answers of deterministic generations.
+
+        With a fixed seed (or a temperature of 0) the backend returns the same answer
+        for the same model, prompt and options, so there is no need to run the model
+        again. Entries are kept in an in-memory LRU, backed by the `response_cache`
+        table of the conversation store so they survive restarts.
+
+        Args:
+            store: The database holding the persistent tier.
+
+            max_entries: Number of entries kept in memory.
+
+            ttl: Seconds after which an entry expires.
+
+            max_rows: Number of entries kept in the database.
+        """
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_rows = max_rows
+
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, str]]
+        self._writes = 0
+
+    @staticmethod
+    def is_cacheable(payload: Dict[str, Any]) -> bool:
+        """Whether the generation described by the payload is deterministic"""
+        if "context" in payload:
+            # Continues a conversation, which isn't part of the key
+            return False
+        options = payload.get("options", {})
+        seed = options.get("seed")
+        return (seed is not None and seed >= 0) or options.get("temperature") == 0
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """Derive the cache key from the model, the rendered prompt and all options"""
+        key = json.dumps(
+            {
+                "model": payload.get("model"),
+                "prompt": payload.get("prompt"),
+                "options": payload.get("options"),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[str]:
+        """Look up a cached answer.
+
+        Returns:
+            The answer, or None if there is no (unexpired) entry for the key.
+        """
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            created_at, response = entry
+            if created_at >= now - self.ttl:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return response
+            del self._entries[key]
+
+        row = await self.store.get_cached_response(key, int(now - self.ttl))
+        if row is not None:
+            self._remember(key, now, row)
+            self.store_hits += 1
+            return row
+
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, model: str, response: str) -> None:
+        """Cache the answer of a generation"""
+        now = time.time()
+        self._remember(key, now, response)
+        await self.store.put_cached_response(key, model, response, int(now))
+
+        self._writes += 1
+        if self._writes % EVICT_EVERY == 0:
+            await self.store.evict_cached_responses(int(now - self.ttl), self.max_rows)
+
+    def stats(self) -> Dict[str, int]:
+        """Hit and miss counters since startup"""
+        return {
+            "memory_hits": self.memory_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+        }
+
+    def _remember(self, key: str, created_at: float, response: str) -> None:
+        self._entries[key] = (created_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,208 @@
+import logging
+import math
+from typing import Iterable, List, Optional, Sequence, Set
+
+from llm_to_matrix.breaker import BreakerState, CircuitBreaker
+from llm_to_matrix.errors import BackendUnavailableError, LLMError
+
+logger = logging.getLogger(__name__)
+
+# Loading a model takes about as long as this many requests ahead in the queue, so a
+# backend that has the model loaded is preferred unless it is this much busier
+COLD_PENALTY = 2
+
+# The tag Ollama assumes when a model name has none
+DEFAULT_TAG = ":latest"
+
+
+def has_model(model: str, names: Iterable[str]) -> bool:
+    """Whether a model is among the given names, with or without its default tag"""
+    names = set(names)
+    return model in names or model + DEFAULT_TAG in names
+
+
+class Backend:
+    def __init__(self, url: str, breaker: CircuitBreaker):
+        """An LLM backend (Ollama host) and what the router knows about it.
+
+        Args:
+            url: The base URL of the backend.
+
+            breaker: Stops requests to the backend while it keeps failing.
+        """
+        self.url = url
+        self.breaker = breaker
+        # Requests sent to the backend that haven't finished yet
+        self.outstanding = 0
+        # The models installed on the backend, None until its first health check
+        self.installed = None  # type: Optional[Set[str]]
+        # The models loaded into memory on the backend, as far as we know
+        self.loaded = set()  # type: Set[str]
+
+    @property
+    def ejected(self) -> bool:
+        return self.breaker.state == BreakerState.OPEN
+
+    def __repr__(self) -> str:
+        return f"Backend({self.url!r})"
+
+
+class _Route:
+    def __init__(self, router: "BackendRouter", model: Optional[str], backend: Optional[Backend]):
+        self.router = router
+        self.model = model
+        self.backend = backend
+
+    async def __aenter__(self) -> Backend:
+        if self.backend is None:
+            self.backend = self.router.pick(self.model)
+        self.backend.outstanding += 1
+        self.backend.breaker.acquire()
+        return self.backend
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.backend.outstanding -= 1
+        if exc is None:
+            self.router.success(self.backend, self.model)
+        elif isinstance(exc, LLMError):
+            self.router.failure(self.backend, exc)
+        else:
+            # Cancelled (e.g. the losing half of a hedged request)
+            self.backend.breaker.release()
+
+
+class BackendRouter:
+    def __init__(self, urls: List[str], max_failures: int = 3, eject_time: float = 30):
+        """Spreads requests over several LLM backends.
+
+        Each request goes to the backend with the fewest outstanding requests, among
+        those that have the model installed. Backends that already have the model
+        loaded are preferred. Every backend has a `CircuitBreaker`: one that fails
+        `max_failures` times in a row is ejected for `eject_time` seconds (requests
+        already sent to it are left to finish). After that a single trial request
+        goes to it, and it is taken back once that passes. Only generations take a
+        backend back: health checks only ask for the model list, which an overloaded
+        backend can still answer. While all backends are ejected, requests fail
+        straight away.
+
+        Args:
+            urls: The base URLs of the backends.
+
+            max_failures: Failures in a row after which a backend is ejected.
+
+            eject_time: Seconds an ejected backend gets no new requests.
+        """
+        if not urls:
+            raise ValueError("At least one backend is required")
+        self.backends = [Backend(url, CircuitBreaker(max_failures, eject_time)) for url in urls]
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self._turn = 0
+
+    def route(self, model: Optional[str] = None, backend: Optional[Backend] = None) -> _Route:
+        """Send a request through the best backend for the model.
+
+        Used as `async with router.route(model) as backend:`. The outcome of the
+        block counts towards the health of the backend.
+
+        Args:
+            model: The model of the request, if any.
+
+            backend: Send the request to this backend (see `pick`) instead of
+                choosing one when the block is entered.
+
+        Raises:
+            BackendUnavailableError: If no backend takes requests.
+        """
+        return _Route(self, model, backend)
+
+    def available(self) -> List[Backend]:
+        """The backends that take new requests"""
+        return [b for b in self.backends if b.breaker.available]
+
+    def pick(self, model: Optional[str] = None, exclude: Sequence[Backend] = ()) -> Backend:
+        """Choose the backend for a request.
+
+        Args:
+            model: The model of the request, if any.
+
+            exclude: Backends not to choose, e.g. because the request is already
+                running there.
+
+        Raises:
+            BackendUnavailableError: If no backend (apart from the excluded ones)
+                takes requests.
+        """
+        candidates = [b for b in self.available() if b not in exclude]
+        if not candidates:
+            raise self.unavailable(exclude)
+        if model is not None:
+            # Backends that haven't been checked yet might have the model
+            candidates = [
+                b for b in candidates if b.installed is None or has_model(model, b.installed)
+            ] or candidates
+
+        def cost(backend: Backend) -> int:
+            if model is None or has_model(model, backend.loaded):
+                return backend.outstanding
+            return backend.outstanding + COLD_PENALTY
+
+        lowest = min(cost(b) for b in candidates)
+        best = [b for b in candidates if cost(b) == lowest]
+
+        # Take turns between equally good backends
+        self._turn += 1
+        return best[self._turn % len(best)]
+
+    def unavailable(self, exclude: Sequence[Backend] = ()) -> BackendUnavailableError:
+        """The error to fail requests with while no backend takes them"""
+        retry_after = min(
+            (b.breaker.retry_after for b in self.backends if b not in exclude), default=0.0
+        )
+        return BackendUnavailableError(
+            "The LLM backend is busy or unavailable right now, please try again in "
+            f"{max(math.ceil(retry_after), 1)} seconds.",
+            retry_after,
+        )
+
+    def success(self, backend: Backend, model: Optional[str] = None) -> None:
+        if backend.breaker.state != BreakerState.CLOSED:
+            logger.info(f"LLM backend {backend.url} is healthy again")
+        backend.breaker.success()
+        if model is not None:
+            backend.loaded.add(model)
+
+    def failure(self, backend: Backend, error: LLMError) -> None:
+        if error.status is not None and error.status < 500:
+            # The request was at fault (e.g. an unknown model), and the backend
+            # answered, so it is up
+            backend.breaker.success()
+            return
+
+        if backend.breaker.failure():
+            logger.warning(
+                f"Ejecting LLM backend {backend.url} for {self.eject_time}s after "
+                f"{backend.breaker.failures} failures: {error}"
+            )
+
+    def update(
+        self,
+        backend: Backend,
+        installed: Iterable[str],
+        loaded: Optional[Iterable[str]] = None,
+    ) -> None:
+        """Record a passed health check of a backend.
+
+        This only updates the models of the backend. It doesn't take an ejected
+        backend back, as one that fails to generate can still list its models.
+
+        Args:
+            backend: The checked backend.
+
+            installed: The models installed on the backend.
+
+            loaded: The models loaded into memory on the backend, if known.
+        """
+        backend.installed = set(installed)
+        if loaded is not None:
+            backend.loaded = set(loaded)
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Called with the (estimated) queue position when a request has to wait
+QueuedCallback = Callable[[int], Awaitable[None]]
+
+
+class _Waiter:
+    def __init__(self, model: str, room_id: str, user: str):
+        self.model = model
+        self.room_id = room_id
+        self.user = user
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class _Slot:
+    """Async context manager returned by `GenerationScheduler.slot`"""
+
+    def __init__(
+        self,
+        scheduler: "GenerationScheduler",
+        model: str,
+        room_id: str,
+        user: str,
+        on_queued: Optional[QueuedCallback],
+    ):
+        self.scheduler = scheduler
+        self.model = model
+        self.room_id = room_id
+        self.user = user
+        self.on_queued = on_queued
+
+    async def __aenter__(self) -> None:
+        await self.scheduler.acquire(self.model, self.room_id, self.user, self.on_queued)
+
+    async def __aexit__(self, *exc) -> None:
+        self.scheduler.release(self.model)
+
+
+class GenerationScheduler:
+    def __init__(
+        self,
+        max_concurrent: int,
+        model_limits: Optional[Dict[str, int]] = None,
+        default_model_limit: int = 0,
+    ):
+        """Admission control for generations sent to the LLM backend.
+
+        At most `max_concurrent` generations run at once, and at most the configured
+        limit per model. Requests over the limit wait in a queue that is served
+        round-robin: first across rooms, then across the users within a room. One busy
+        room (or one busy user) therefore can't starve everyone else.
+
+        Args:
+            max_concurrent: Maximum number of generations running at the same time.
+
+            model_limits: Maximum number of concurrent generations per model name.
+
+            default_model_limit: Limit for models not listed in `model_limits`.
+                0 means the model is only bound by `max_concurrent`.
+        """
+        self.max_concurrent = max_concurrent
+        self.model_limits = model_limits or {}
+        self.default_model_limit = default_model_limit
+
+        self.active = 0
+        self.active_per_model = {}  # type: Dict[str, int]
+
+        # room_id -> user -> waiters, each level kept in round-robin order
+        self._queues = OrderedDict()  # type: OrderedDict[str, OrderedDict[str, Deque[_Waiter]]]
+
+    def slot(
+        self,
+        model: str,
+        room_id: str,
+        user: str,
+        on_queued: Optional[QueuedCallback] = None,
+    ) -> _Slot:
+        """Reserve a generation slot for the duration of an `async with` block.
+
+        Args:
+            model: The model the generation will run on.
+
+            room_id: The room the request came from.
+
+            user: The user that made the request.
+
+            on_queued: Awaited with the estimated queue position if the request can't
+                start right away.
+        """
+        return _Slot(self, model, room_id, user, on_queued)
+
+    @property
+    def queued(self) -> int:
+        """The number of requests currently waiting for a slot"""
+        return sum(
+            len(waiters) for users in self._queues.values() for waiters in users.values()
+        )
+
+    def _model_limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.default_model_limit)
+
+    def _has_capacity(self, model: str) -> bool:
+        if self.active >= self.max_concurrent:
+            return False
+        limit = self._model_limit(model)
+        return limit <= 0 or self.active_per_model.get(model, 0) < limit
+
+    def _start(self, model: str) -> None:
+        self.active += 1
+        self.active_per_model[model] = self.active_per_model.get(model, 0) + 1
+
+    async def acquire(
+        self,
+        model: str,
+        room_id: str,
+        user: str,
+        on_queued: Optional[QueuedCallback] = None,
+    ) -> None:
+        """Wait for a generation slot. Every call must be paired with `release`."""
+        if self.queued == 0 and self._has_capacity(model):
+            self._start(model)
+            return
+
+        waiter = _Waiter(model, room_id, user)
+        users = self._queues.setdefault(room_id, OrderedDict())
+        waiters = users.setdefault(user, deque())
+        position = self._position(len(waiters))
+        waiters.append(waiter)
+        logger.debug(f"Queued a generation for {user} in {room_id} at position {position}")
+
+        # Something may have been released in the meantime
+        self._dispatch()
+
+        try:
+            if on_queued is not None and not waiter.future.done():
+                try:
+                    await on_queued(position)
+                except Exception:
+                    logger.exception("Unable to announce the queue position")
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # We were granted a slot but won't use it
+                self.release(model)
+            else:
+                self._remove(waiter)
+            raise
+
+    def release(self, model: str) -> None:
+        """Give back a slot obtained through `acquire`"""
+        self.active -= 1
+        self.active_per_model[model] -= 1
+        if not self.active_per_model[model]:
+            del self.active_per_model[model]
+        self._dispatch()
+
+    def _position(self, ahead_in_flow: int) -> int:
+        """Estimate where a new request lands in the round-robin order"""
+        # Everything queued before us in our own flow, and up to one more request
+        # from each other flow for every round we have to wait
+        position = 1
+        for users in self._queues.values():
+            for waiters in users.values():
+                position += min(len(waiters), ahead_in_flow + 1)
+        return position
+
+    def _remove(self, waiter: _Waiter) -> None:
+        users = self._queues.get(waiter.room_id)
+        if users is None:
+            return
+        waiters = users.get(waiter.user)
+        if waiters is not None and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del users[waiter.user]
+        if not users:
+            del self._queues[waiter.room_id]
+
+    def _dispatch(self) -> None:
+        """Hand out free slots to waiters, round-robin across rooms and users"""
+        while self.active < self.max_concurrent and self._queues:
+            waiter = self._next_waiter()
+            if waiter is None:
+                # Only waiters for saturated models are left
+                return
+            self._start(waiter.model)
+            waiter.future.set_result(None)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for room_id in list(self._queues):
+            users = self._queues[room_id]
+            for user in list(users):
+                waiters = users[user]
+                # Skip waiters that were cancelled while queued
+                while waiters and waiters[0].future.done():
+                    waiters.popleft()
+                if not waiters or not self._has_capacity(waiters[0].model):
+                    if not waiters:
+                        del users[user]
+                    continue
+
+                waiter = waiters.popleft()
+                if waiters:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                if users:
+                    self._queues.move_to_end(room_id)
+                else:
+                    del self._queues[room_id]
+                return waiter
+
+            if not users:
+                del self._queues[room_id]
+        return None
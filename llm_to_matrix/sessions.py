@@ -0,0 +1,78 @@
+import hashlib
+import json
+import logging
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    def __init__(self, max_sessions: int = 256, ttl: int = 3600):
+        """Keeps the `context` the backend returns after a generation, per session
+        (room, user and model).
+
+        The context encodes the conversation so far. Sending it with the next request
+        of the session lets the backend continue from there, instead of evaluating the
+        whole history again. Contexts are kept in memory as packed 32-bit integers.
+
+        Args:
+            max_sessions: Number of sessions kept. The least recently used ones are
+                dropped first. 0 disables sessions.
+
+            ttl: Seconds after which an unused session expires.
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()  # type: OrderedDict[Hashable, Tuple[str, float, array]]
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        """Derive a fingerprint of everything a context depends on (model, prompt
+        template, context size, ...). A session is dropped once its fingerprint
+        changes.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: Hashable, fingerprint: str) -> Optional[List[int]]:
+        """Look up the context of a session.
+
+        Returns:
+            The context, or None if there is no current one for the session.
+        """
+        entry = self._sessions.get(key)
+        if entry is None:
+            return None
+
+        session_fingerprint, used_at, context = entry
+        if session_fingerprint != fingerprint or used_at < time.time() - self.ttl:
+            del self._sessions[key]
+            return None
+
+        self._sessions.move_to_end(key)
+        return context.tolist()
+
+    def put(self, key: Hashable, fingerprint: str, context: List[int]) -> None:
+        """Keep the context returned by the latest generation of a session"""
+        if not self.max_sessions:
+            return
+        try:
+            packed = array("i", context)
+        except (OverflowError, TypeError):
+            logger.warning("Not keeping a context the backend returned, it is malformed")
+            self.discard(key)
+            return
+
+        self._sessions[key] = (fingerprint, time.time(), packed)
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def discard(self, key: Hashable) -> None:
+        """Forget a session, e.g. because its context was rejected"""
+        self._sessions.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._sessions)
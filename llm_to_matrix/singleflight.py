@@ -0,0 +1,52 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    def __init__(self):
+        """Coalesces concurrent calls that share a key into a single call.
+
+        While a call for a key is in flight, further calls with the same key don't
+        start their own work but wait for the first one and get the same result (or
+        the same exception).
+        """
+        self._calls = {}  # type: Dict[Hashable, asyncio.Future]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(
+        self, key: Hashable, fn: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """Run `fn`, unless a call with the same key is already in flight.
+
+        Args:
+            key: Identifies calls that are interchangeable.
+
+            fn: Called to do the work if no call for `key` is in flight.
+
+        Returns:
+            The result and whether it was shared from another caller's call (in which
+            case `fn` was not called).
+        """
+        future = self._calls.get(key)
+        shared = future is not None
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            logger.debug(f"Joining the call in flight for {key!r}")
+
+        # One caller giving up must not cancel the call for everyone else
+        return await asyncio.shield(future), shared
+
+    def _done(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved, it is re-raised to every caller
+            future.exception()
@@ -1,5 +1,16 @@
+import asyncio
+import functools
+import hashlib
 import logging
-from typing import Any, Dict
+import re
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from llm_to_matrix.helper import CHARS_PER_TOKEN
 
 # The latest migration version of the database.
 #
@@ -8,13 +19,39 @@ from typing import Any, Dict
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 0
+latest_migration_version = 3
 
 logger = logging.getLogger(__name__)
 
+PLACEHOLDER = re.compile(r"\?")
+
+
+@functools.lru_cache(maxsize=256)
+def postgres_query(query: str) -> str:
+    """Translate the ? placeholders of a query to the %s that psycopg2 expects"""
+    return query.replace("?", "%s")
+
+
+@functools.lru_cache(maxsize=64)
+def prepared_statement(query: str) -> Tuple[str, str, str]:
+    """Derive a postgres prepared statement from a query with ? placeholders.
+
+    Returns:
+        The name of the statement, the query preparing it and the query executing it.
+    """
+    count = len(PLACEHOLDER.findall(query))
+    numbers = iter(range(1, count + 1))
+    body = PLACEHOLDER.sub(lambda _: f"${next(numbers)}", query)
+
+    name = "stmt_" + hashlib.sha1(query.encode()).hexdigest()[:16]
+    execute = f"EXECUTE {name}"
+    if count:
+        execute += " (" + ", ".join(["%s"] * count) + ")"
+    return name, f"PREPARE {name} AS {body}", execute
+
 
 class Storage:
-    def __init__(self, database_config: Dict[str, str]):
+    def __init__(self, database_config: Dict[str, Any]):
         """Setup the database.
 
         Runs an initial setup or migrations depending on whether a database file has already
@@ -25,18 +62,63 @@ class Storage:
                 * type: A string, one of "sqlite" or "postgres".
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
+                * pool_min_size: Postgres only. The number of connections kept open
+                    while idle. Defaults to 1.
+                * pool_max_size: Postgres only. The maximum number of connections
+                    used at the same time. Defaults to 4.
+                * pool_check_idle: Postgres only. Connections that have been idle
+                    for this many seconds are checked before they are used.
+                    Defaults to 30.
+                * pragmas: SQLite only. A dictionary of pragmas to set on the
+                    connection, e.g. {"journal_mode": "WAL"}.
+                * maintenance_interval: SQLite only. Seconds between runs of
+                    `maintain` by `run_maintenance`. 0 disables maintenance.
+                * vacuum_pages: SQLite only. The maximum number of free pages
+                    handed back to the file system per maintenance run. 0 for all.
         """
-        self.conn = self._get_database_connection(
-            database_config["type"], database_config["connection_string"]
-        )
-        self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
 
+        # SQLite has a single connection, postgres a pool of them
+        self.conn = None
+        self._pool = None
+        self.pool_max_size = 1
+        if self.db_type == "postgres":
+            self.pool_max_size = database_config.get("pool_max_size", 4)
+            self._pool = self._get_connection_pool(
+                database_config["connection_string"],
+                database_config.get("pool_min_size", 1),
+                self.pool_max_size,
+            )
+        else:
+            self.conn = self._get_database_connection(
+                self.db_type, database_config["connection_string"]
+            )
+            for name, value in database_config.get("pragmas", {}).items():
+                self.conn.execute(f"PRAGMA {name} = {value}")
+        self.pool_check_idle = database_config.get("pool_check_idle", 30)
+        self.maintenance_interval = database_config.get("maintenance_interval", 0)
+        self.vacuum_pages = database_config.get("vacuum_pages", 0)
+
+        # Pool bookkeeping, shared by the storage threads
+        self._pool_lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._reconnects = 0
+        # Per connection: when it was last returned and which statements it prepared
+        self._last_used = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+        self._prepared = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary
+
+        # Once set up, the database is only accessed from these threads, one request
+        # per connection at a time, so queries never block the event loop
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.pool_max_size, thread_name_prefix="storage"
+        )
+
         # Try to check the current migration version
         migration_level = 0
         try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
+            row = self._fetchone("SELECT version FROM migration_version")
             migration_level = row[0]
         except Exception:
             self._initial_setup()
@@ -53,8 +135,11 @@ class Storage:
         if database_type == "sqlite":
             import sqlite3
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
+            # Initialize a connection to the database, with autocommit on. It is set up
+            # on the calling thread but then used from the storage thread.
+            return sqlite3.connect(
+                connection_string, isolation_level=None, check_same_thread=False
+            )
         elif database_type == "postgres":
             import psycopg2
 
@@ -65,6 +150,16 @@ class Storage:
 
             return conn
 
+    def _get_connection_pool(
+        self, connection_string: str, min_size: int, max_size: int
+    ) -> Any:
+        """Creates and returns a pool of connections to a postgres database"""
+        import psycopg2.pool
+
+        return psycopg2.pool.ThreadedConnectionPool(
+            min_size, max_size, connection_string
+        )
+
     def _initial_setup(self) -> None:
         """Initial setup of the database"""
         logger.info("Performing initial database setup...")
@@ -102,25 +197,259 @@ class Storage:
         """
         logger.debug("Checking for necessary database migrations...")
 
-        # if current_migration_version < 1:
-        #    logger.info("Migrating the database from v0 to v1...")
-        #
-        #    # Add new table, delete old ones, etc.
-        #
-        #    # Update the stored migration version
-        #    self._execute("UPDATE migration_version SET version = 1")
-        #
-        #    logger.info("Database migrated to v1")
-
-    def _execute(self, *args) -> None:
+        if current_migration_version < 1:
+            logger.info("Migrating the database from v0 to v1...")
+
+            # Index the history lookups, which otherwise scan the whole messages table
+            self._execute(
+                """
+                CREATE INDEX IF NOT EXISTS messages_user_type_id
+                ON messages ("user", messageType, id)
+            """
+            )
+            self._execute(
+                """
+                CREATE INDEX IF NOT EXISTS messages_event_id ON messages (event_id)
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 1")
+
+            logger.info("Database migrated to v1")
+
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            if self.db_type == "sqlite":
+                # Free pages can only be handed back bit by bit (see `maintain`) with
+                # incremental auto vacuum, which takes a rebuild to switch on
+                self._execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self._execute("VACUUM")
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # Token counts are stored with each message, so history can be fitted into
+            # the context without tokenizing it again. Older messages get an estimate.
+            self._execute("ALTER TABLE messages ADD COLUMN token_count INTEGER")
+            self._execute(
+                f"""
+                UPDATE messages
+                SET token_count = (COALESCE(LENGTH(content), 0) + {CHARS_PER_TOKEN - 1}) / {CHARS_PER_TOKEN}
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+
+    @contextmanager
+    def _connection(self) -> Iterator[Any]:
+        """Borrow a database connection for the duration of the block"""
+        if self._pool is None:
+            conn = self.conn
+        else:
+            conn = self._checkout()
+
+        with self._pool_lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+        try:
+            yield conn
+        finally:
+            with self._pool_lock:
+                self._in_use -= 1
+            if self._pool is not None:
+                with self._pool_lock:
+                    self._last_used[conn] = time.monotonic()
+                self._pool.putconn(conn, close=bool(conn.closed))
+
+    def _checkout(self) -> Any:
+        """Take a working connection from the pool.
+
+        Connections that have been idle for a while are checked first, as the server
+        (or something in between) may have dropped them.
+        """
+        for _ in range(self.pool_max_size + 1):
+            conn = self._pool.getconn()
+            with self._pool_lock:
+                idle_since = self._last_used.get(conn)
+            if not conn.closed and (
+                idle_since is None
+                or time.monotonic() - idle_since < self.pool_check_idle
+                or self._ping(conn)
+            ):
+                if not conn.autocommit:
+                    conn.autocommit = True
+                return conn
+
+            logger.info("Replacing a broken database connection")
+            with self._pool_lock:
+                self._reconnects += 1
+            self._pool.putconn(conn, close=True)
+
+        raise RuntimeError("Unable to get a working database connection")
+
+    @staticmethod
+    def _ping(conn: Any) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def _prepare(self, conn: Any, cursor: Any, query: str) -> str:
+        """Prepare a statement on the connection, once.
+
+        Returns:
+            The query executing the statement.
+        """
+        name, prepare, execute = prepared_statement(query)
+        with self._pool_lock:
+            prepared = self._prepared.setdefault(conn, set())
+        if name not in prepared:
+            cursor.execute(prepare)
+            prepared.add(name)
+        return execute
+
+    def _execute(self, query: str, params: Any = (), prepare: bool = False) -> Any:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
 
         This allows for the support of queries that are compatible with both postgres and sqlite.
 
+        Every call uses a fresh cursor, so concurrent requests can't clobber each
+        other's results. Both database drivers hold the results in the cursor, so it
+        can still be read once the connection went back to the pool.
+
         Args:
-            args: Arguments passed to cursor.execute.
+            query: The query to execute.
+
+            params: The parameters of the query.
+
+            prepare: Whether to execute the query as a prepared statement on postgres.
+                Meant for hot queries, which are then only parsed and planned once per
+                connection.
+
+        Returns:
+            The cursor the query was executed on.
         """
-        if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self.db_type == "postgres":
+                if prepare:
+                    query = self._prepare(conn, cursor, query)
+                else:
+                    query = postgres_query(query)
+            cursor.execute(query, params)
+            return cursor
+
+    def _execute_batch(self, query: str, rows: List[Any], prepare: bool = False) -> None:
+        """Execute a query once for every set of parameters, in a single transaction.
+
+        Args:
+            query: The query to execute, with ? placeholders.
+
+            rows: The parameters for each execution.
+
+            prepare: See `_execute`.
+        """
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            if self.db_type == "postgres":
+                if prepare:
+                    query = self._prepare(conn, cursor, query)
+                else:
+                    query = postgres_query(query)
+            cursor.execute("BEGIN")
+            try:
+                cursor.executemany(query, rows)
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def _fetchall(self, query: str, params: Any = (), prepare: bool = False) -> List[Any]:
+        """Execute a query and return all resulting rows"""
+        return self._execute(query, params, prepare).fetchall()
+
+    def _fetchone(self, query: str, params: Any = (), prepare: bool = False) -> Any:
+        """Execute a query and return the first resulting row"""
+        return self._execute(query, params, prepare).fetchone()
+
+    async def _run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a (blocking) database function on a storage thread.
+
+        Args:
+            fn: The function to run, e.g. `self._execute`.
+
+            args: Arguments passed to `fn`.
+
+            kwargs: Keyword arguments passed to `fn`.
+
+        Returns:
+            Whatever `fn` returns.
+        """
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def maintain(self) -> None:
+        """Keep a SQLite database in shape. Postgres takes care of this by itself.
+
+        Moves the WAL into the database file and truncates it, refreshes the
+        statistics the query planner relies on and hands free pages back to the file
+        system.
+        """
+        if self.db_type != "sqlite":
+            return
+
+        started = time.monotonic()
+        self._execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        # Statistics are sampled, so this stays cheap on a large database
+        self._execute("PRAGMA analysis_limit = 1000")
+        self._execute("ANALYZE")
+        with self._connection() as conn:
+            # Frees a page per step, but execute() only takes the first step
+            conn.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+        logger.debug(f"Database maintenance took {time.monotonic() - started:.3f}s")
+
+    async def run_maintenance(self) -> None:
+        """Run `maintain` every `maintenance_interval` seconds, until cancelled"""
+        if self.db_type != "sqlite" or not self.maintenance_interval:
+            return
+
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                await self._run(self.maintain)
+            except Exception:
+                logger.exception("Database maintenance failed")
+
+    def pool_stats(self) -> Dict[str, int]:
+        """Connection usage since startup, to size `storage.pool_max_size` by"""
+        with self._pool_lock:
+            return {
+                "max_size": self.pool_max_size,
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "checkouts": self._checkouts,
+                "reconnects": self._reconnects,
+            }
+
+    def close(self) -> None:
+        """Wait for outstanding requests, then close the database connections"""
+        self._executor.shutdown(wait=True)
+        logger.info(f"Database connection usage: {self.pool_stats()}")
+        if self._pool is not None:
+            self._pool.closeall()
         else:
-            self.cursor.execute(*args)
+            self.conn.close()
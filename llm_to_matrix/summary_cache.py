@@ -0,0 +1,63 @@
+import hashlib
+import json
+from collections import OrderedDict
+from typing import Optional
+
+
+class SummaryCache:
+    def __init__(self, max_entries: int = 256):
+        """Keeps the summaries of the parts of long pages in memory.
+
+        Summaries are found by the model, the prompt template and a hash of the part,
+        so summarizing a page again (or a slightly changed version of it) only
+        generates the summaries of the parts that changed. This is independent of the
+        answer cache (`ResponseCache`), which only holds deterministic generations.
+
+        Args:
+            max_entries: Number of summaries kept. The least recently used ones are
+                dropped first. 0 disables the cache.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # type: OrderedDict[str, str]
+
+    @staticmethod
+    def make_key(model: str, prompt: str, content: str) -> str:
+        """Derive the key of a summary from the model, the prompt template and the
+        content hash of the part
+        """
+        key = json.dumps(
+            {
+                "model": model,
+                "prompt": prompt,
+                "content": hashlib.sha256(content.encode()).hexdigest(),
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Look up a summary.
+
+        Returns:
+            The summary, or None if there is no entry for the key.
+        """
+        summary = self._entries.get(key)
+        if summary is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return summary
+
+    def put(self, key: str, summary: str) -> None:
+        if not self.max_entries:
+            return
+        self._entries[key] = summary
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,155 @@
+import logging
+import time
+from typing import Any, Dict, Optional, Union
+
+from aiohttp import ClientResponse
+from nio import AsyncClient, Response, SyncResponse, UploadFilterResponse
+
+logger = logging.getLogger(__name__)
+
+# Timeline events the callbacks handle. Reactions are not known to nio, and arrive
+# as unknown events.
+MESSAGE_TYPES = ["m.room.message", "m.room.encrypted", "m.reaction"]
+
+# State the bot relies on: members (to share room keys with and to tell DMs from
+# group rooms), whether a room is encrypted, and what it is called
+STATE_TYPES = [
+    "m.room.create",
+    "m.room.member",
+    "m.room.encryption",
+    "m.room.name",
+    "m.room.canonical_alias",
+]
+
+
+def build_sync_filter(timeline_limit: int = 20) -> Dict[str, Any]:
+    """The filter for syncs that only asks for what the bot uses.
+
+    Presence, typing notifications, read receipts and account data are left out,
+    as are timeline and state events of other types. Members are lazy-loaded: only
+    the members that sent the events in a sync are included, along with a summary
+    of the member counts, instead of the full member list of every room.
+
+    Args:
+        timeline_limit: The most events per room in each sync.
+    """
+    return {
+        "presence": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+        "room": {
+            "timeline": {
+                "types": MESSAGE_TYPES + STATE_TYPES,
+                "limit": timeline_limit,
+                "lazy_load_members": True,
+            },
+            "state": {"types": STATE_TYPES, "lazy_load_members": True},
+            "ephemeral": {"not_types": ["*"]},
+            "account_data": {"not_types": ["*"]},
+        },
+    }
+
+
+class SyncStats:
+    def __init__(self):
+        """The size of the sync responses, and the time spent processing them"""
+        self.syncs = 0
+        self.bytes = 0
+        self.largest = 0
+        self.parse_seconds = 0.0
+        self.handle_seconds = 0.0
+
+    def record(self, size: int, parse_seconds: float) -> None:
+        self.syncs += 1
+        self.bytes += size
+        self.largest = max(self.largest, size)
+        self.parse_seconds += parse_seconds
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            "syncs": self.syncs,
+            "bytes": self.bytes,
+            "largest_bytes": self.largest,
+            "average_bytes": self.bytes // self.syncs if self.syncs else 0,
+            "parse_ms": round(self.parse_seconds * 1000, 1),
+            "handle_ms": round(self.handle_seconds * 1000, 1),
+        }
+
+
+class SyncClient(AsyncClient):
+    """An `AsyncClient` that syncs with a filter for just the events the bot handles,
+    and measures the sync responses.
+
+    Use `sync_filter` and `needs_full_state` for the arguments of `sync_forever`.
+    """
+
+    def __init__(self, *args, timeline_limit: int = 20, lean: bool = True, **kwargs):
+        """
+        Args:
+            timeline_limit: The most events per room in each sync.
+
+            lean: Whether to filter syncs. Without, every event is synced.
+
+            The other arguments are those of `AsyncClient`.
+        """
+        super().__init__(*args, **kwargs)
+        self.timeline_limit = timeline_limit
+        self.lean = lean
+        self.sync_stats = SyncStats()
+        self._filter_id = None  # type: Optional[str]
+
+    async def sync_filter(self) -> Optional[Union[str, Dict[str, Any]]]:
+        """The filter to sync with.
+
+        The filter is uploaded to the homeserver once, so that syncs only need to
+        send its ID. Should that fail, it is sent along with every sync instead.
+        """
+        if not self.lean:
+            return None
+        if self._filter_id is not None:
+            return self._filter_id
+
+        sync_filter = build_sync_filter(self.timeline_limit)
+        response = await self.upload_filter(**sync_filter)
+        if isinstance(response, UploadFilterResponse):
+            self._filter_id = response.filter_id
+            return self._filter_id
+        logger.warning(f"Unable to upload the sync filter, sending it with every sync instead: {response}")
+        return sync_filter
+
+    def needs_full_state(self) -> bool:
+        """Whether the next sync has to ask for the full state of every room.
+
+        The state of rooms only lives in memory. After a restart, syncing continues
+        from the stored sync token, which would only bring the state changes since
+        then. On a reconnect, the rooms are still known, and the changes are enough.
+        """
+        return not self.rooms
+
+    async def create_matrix_response(
+        self,
+        response_class: type,
+        transport_response: ClientResponse,
+        data: Optional[tuple] = None,
+        save_to: Any = None,
+    ) -> Response:
+        if response_class is not SyncResponse:
+            return await super().create_matrix_response(response_class, transport_response, data, save_to)
+
+        # The body is kept by the transport response, so it is only read once
+        size = len(await transport_response.read())
+        start = time.perf_counter()
+        response = await super().create_matrix_response(response_class, transport_response, data, save_to)
+        elapsed = time.perf_counter() - start
+        self.sync_stats.record(size, elapsed)
+        # The first sync is the large one, the others only bring what is new
+        log = logger.info if self.sync_stats.syncs == 1 else logger.debug
+        log(f"Synced {size} bytes, parsed in {elapsed * 1000:.1f}ms")
+        return response
+
+    async def receive_response(self, response: Response) -> None:
+        if not isinstance(response, SyncResponse):
+            return await super().receive_response(response)
+
+        start = time.perf_counter()
+        await super().receive_response(response)
+        self.sync_stats.handle_seconds += time.perf_counter() - start
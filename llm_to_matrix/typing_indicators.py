@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from typing import TYPE_CHECKING, Dict, Set
+
+if TYPE_CHECKING:
+    from llm_to_matrix.outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+# The indicator is sent again once this share of its timeout has passed
+REFRESH_AFTER = 0.6
+
+
+class TypingHold:
+    def __init__(self, indicators: "TypingIndicators", room_id: str):
+        """Keeps the typing indicator of a room shown until released. Can be used as
+        a context manager.
+        """
+        self.indicators = indicators
+        self.room_id = room_id
+        self.released = False
+
+    def release(self) -> None:
+        """Stop holding the indicator. It is cleared once nobody holds it any more.
+        Releasing again does nothing.
+        """
+        if not self.released:
+            self.released = True
+            self.indicators._release(self.room_id)
+
+    def __enter__(self) -> "TypingHold":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class TypingIndicators:
+    def __init__(self, outbox: "Outbox", timeout: int = 30000):
+        """Shows that we are typing in rooms while requests are being worked on.
+
+        Every request being worked on in a room holds the room's indicator (see
+        `hold`). The indicator is shown when the first request starts, refreshed in
+        the background before it expires, and cleared when the last request is done.
+        Nothing waits for the homeserver: holding and releasing return straight away.
+
+        Args:
+            outbox: Sends the typing notifications.
+
+            timeout: Milliseconds each typing notification lasts.
+        """
+        self.outbox = outbox
+        self.timeout = timeout
+        self._holds = {}  # type: Dict[str, int]
+        self._keep_alive = {}  # type: Dict[str, asyncio.Future]
+        self._tasks = set()  # type: Set[asyncio.Future]
+
+    def hold(self, room_id: str) -> TypingHold:
+        """Show the indicator in a room until the returned hold is released"""
+        count = self._holds.get(room_id, 0)
+        self._holds[room_id] = count + 1
+        if count == 0:
+            self._keep_alive[room_id] = asyncio.ensure_future(self._show(room_id))
+        return TypingHold(self, room_id)
+
+    def holds(self, room_id: str) -> int:
+        """The number of requests holding the indicator of a room"""
+        return self._holds.get(room_id, 0)
+
+    def _release(self, room_id: str) -> None:
+        self._holds[room_id] -= 1
+        if self._holds[room_id] > 0:
+            return
+        del self._holds[room_id]
+        self._keep_alive.pop(room_id).cancel()
+
+        task = asyncio.ensure_future(self._clear(room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _show(self, room_id: str) -> None:
+        while True:
+            await self.outbox.typing(room_id, True, self.timeout)
+            await asyncio.sleep(self.timeout / 1000 * REFRESH_AFTER)
+
+    async def _clear(self, room_id: str) -> None:
+        # Another request may have started in the meantime
+        if room_id not in self._holds:
+            await self.outbox.typing(room_id, False)
+
+    def close(self) -> None:
+        """Stop refreshing all indicators"""
+        for task in list(self._keep_alive.values()) + list(self._tasks):
+            task.cancel()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Optional, Set
+
+from llm_to_matrix.errors import LLMError
+from llm_to_matrix.singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from llm_to_matrix.llm_client import LLMClient
+
+logger = logging.getLogger(__name__)
+
+# A generation whose model took longer than this to load (in seconds) had to wait
+# for the model to be loaded from disk
+COLD_LOAD_SECONDS = 0.5
+
+# Uses of a model count half as much after this many seconds
+USAGE_HALF_LIFE = 3600
+
+
+class ModelWarmer:
+    def __init__(
+        self,
+        llm: "LLMClient",
+        keep_alive: int = 300,
+        hot_keep_alive: int = 3600,
+        hot_models: int = 2,
+    ):
+        """Keeps the models in use loaded on the backend, so users don't wait for them
+        to be loaded from disk.
+
+        Every generation asks the backend to keep its model loaded for a while
+        (`keep_alive`). The most used models are kept for longer. Models can also
+        be loaded ahead of time, at startup or as soon as a command is recognised.
+
+        Args:
+            llm: The client for the LLM backend.
+
+            keep_alive: Seconds a model stays loaded after it was last used.
+
+            hot_keep_alive: Seconds the most used models stay loaded after they were
+                last used. -1 keeps them loaded indefinitely.
+
+            hot_models: The number of most used models that are kept loaded for
+                `hot_keep_alive`.
+        """
+        self.llm = llm
+        self.keep_alive_seconds = keep_alive
+        self.hot_keep_alive_seconds = hot_keep_alive
+        self.hot_models = hot_models
+
+        self.cold_starts = 0
+        self.warm_starts = 0
+        self.preloads = 0
+
+        # Decayed number of uses and the time of the last one, per model
+        self._usage = {}  # type: Dict[str, float]
+        self._used_at = {}  # type: Dict[str, float]
+        # Until when each model should still be loaded, as far as we know
+        self._loaded_until = {}  # type: Dict[str, float]
+
+        self._inflight = SingleFlight()
+        self._tasks = set()  # type: Set[asyncio.Future]
+
+    def keep_alive(self, model: str) -> int:
+        """How long (in seconds) the backend should keep the model loaded after a
+        request
+        """
+        now = time.time()
+        scores = {name: self._score(name, now) for name in self._usage}
+        hot = sorted(scores, key=scores.get, reverse=True)[: self.hot_models]
+        return self.hot_keep_alive_seconds if model in hot else self.keep_alive_seconds
+
+    def prepare(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Add the keep-alive of the payload's model to a generate request"""
+        if "keep_alive" in payload or "model" not in payload:
+            return payload
+        return dict(payload, keep_alive=self.keep_alive(payload["model"]))
+
+    def observe(self, payload: Dict[str, Any], response: Dict[str, Any]) -> None:
+        """Account for a finished generation.
+
+        Args:
+            payload: The request body of the generation.
+
+            response: The (final) response of the backend, with its timings.
+        """
+        model = payload.get("model")
+        if model is None:
+            return
+
+        now = time.time()
+        self._usage[model] = self._score(model, now) + 1
+        self._used_at[model] = now
+        self._mark_loaded(model, payload.get("keep_alive", self.keep_alive_seconds), now)
+
+        load_seconds = response.get("load_duration", 0) / 1e9
+        if load_seconds >= COLD_LOAD_SECONDS:
+            self.cold_starts += 1
+            logger.info(
+                f"Cold start of {model}, loading took {load_seconds:.1f}s "
+                f"({self.cold_starts} cold starts, {self.warm_starts} warm since startup)"
+            )
+        else:
+            self.warm_starts += 1
+
+    def warm(self, model: Optional[str]) -> None:
+        """Start loading a model in the background, unless it should still be loaded.
+
+        Meant to be called as soon as it is known which model a command will use, so
+        that loading overlaps with preparing the prompt.
+        """
+        if not model or self._loaded_until.get(model, 0) > time.time():
+            return
+        task = asyncio.ensure_future(self._warm(model))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def preload(self, models: Iterable[Optional[str]]) -> None:
+        """Load models one after another, e.g. at startup"""
+        seen = set()  # type: Set[str]
+        for model in models:
+            if model and model not in seen:
+                seen.add(model)
+                await self._warm(model)
+
+    async def _warm(self, model: str) -> None:
+        try:
+            await self._inflight.do(model, lambda: self._load(model))
+        except LLMError as e:
+            logger.warning(f"Loading {model} ahead of time failed: {e}")
+
+    async def _load(self, model: str) -> None:
+        keep_alive = self.keep_alive(model)
+        started = time.time()
+        await self.llm.load(model, keep_alive)
+        self.preloads += 1
+        self._mark_loaded(model, keep_alive, time.time())
+        logger.debug(f"Loaded {model} ahead of time in {time.time() - started:.1f}s")
+
+    def _mark_loaded(self, model: str, keep_alive: int, now: float) -> None:
+        self._loaded_until[model] = float("inf") if keep_alive < 0 else now + keep_alive
+
+    def _score(self, model: str, now: float) -> float:
+        if model not in self._usage:
+            return 0.0
+        age = now - self._used_at[model]
+        return self._usage[model] * 0.5 ** (age / USAGE_HALF_LIFE)
+
+    def stats(self) -> Dict[str, int]:
+        """Cold and warm starts of generations since startup"""
+        return {
+            "cold_starts": self.cold_starts,
+            "warm_starts": self.warm_starts,
+            "preloads": self.preloads,
+        }
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Compare the throughput and peak memory of the page extraction backends.
+
+Runs every backend over the saved pages in `bench_corpus/`, both on the page as is and
+on a large page made by repeating it, with and without a text budget. Pages are fed in
+the same pieces the fetcher reads them in.
+
+Usage:
+    python scripts-dev/bench_extractors.py [--scale 40] [--budget 32768] [--runs 3]
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from llm_to_matrix.parser.extractors import EXTRACTORS  # noqa: E402
+from llm_to_matrix.parser.fetcher import CHUNK_SIZE  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_corpus")
+
+
+def extract(name, html, budget):
+    extractor = EXTRACTORS[name](budget)
+    for i in range(0, len(html), CHUNK_SIZE):
+        if extractor.feed(html[i : i + CHUNK_SIZE]):
+            break
+    return extractor.close()
+
+
+def measure(name, html, budget, runs):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        text = extract(name, html, budget)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    extract(name, html, budget)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, len(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=40, help="repetitions for the large page")
+    parser.add_argument("--budget", type=int, default=8192 * 4, help="text budget in characters")
+    parser.add_argument("--runs", type=int, default=3, help="timed runs per case (best is kept)")
+    args = parser.parse_args()
+
+    print(f"{'page':<22}{'backend':<9}{'budget':>8}{'time ms':>10}{'MB/s':>9}{'peak MB':>9}{'chars':>9}")
+    for filename in sorted(os.listdir(CORPUS)):
+        with open(os.path.join(CORPUS, filename), "rb") as f:
+            page = f.read()
+        for label, html in ((filename, page), (f"{filename} x{args.scale}", page * args.scale)):
+            for budget in (None, args.budget):
+                for name in sorted(EXTRACTORS):
+                    elapsed, peak, chars = measure(name, html, budget, args.runs)
+                    print(
+                        f"{label:<22}{name:<9}{budget or '-':>8}{elapsed * 1000:>10.1f}"
+                        f"{len(html) / elapsed / 1e6:>9.1f}{peak / 1e6:>9.1f}{chars:>9}"
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Measure the cost of rendering typical LLM answers from markdown into HTML.
+
+For a code-heavy, a list-heavy and a plain answer, times
+- rendering with a fresh `markdown2.markdown` call (how messages used to be rendered),
+- rendering with the shared `MarkdownRenderer`, with and without a cache hit,
+- a streamed answer that is edited every `--edit-chars` characters, rendered in full
+  on every edit versus with `IncrementalRenderer`.
+
+Usage:
+    python scripts-dev/bench_markdown.py [--scale 4] [--runs 20] [--edit-chars 80]
+"""
+import argparse
+import os
+import sys
+import time
+
+import markdown2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from llm_to_matrix.rendering import MARKDOWN_EXTRAS, IncrementalRenderer, MarkdownRenderer  # noqa: E402
+
+CODE = (
+    "Here is an implementation of a small LRU cache:\n\n"
+    "```python\n"
+    "from collections import OrderedDict\n\n\n"
+    "class LRUCache:\n"
+    "    def __init__(self, capacity: int):\n"
+    "        self.capacity = capacity\n"
+    "        self.items = OrderedDict()\n\n"
+    "    def get(self, key):\n"
+    "        if key not in self.items:\n"
+    "            return None\n"
+    "        self.items.move_to_end(key)\n"
+    "        return self.items[key]\n\n"
+    "    def put(self, key, value):\n"
+    "        self.items[key] = value\n"
+    "        self.items.move_to_end(key)\n"
+    "        if len(self.items) > self.capacity:\n"
+    "            self.items.popitem(last=False)\n"
+    "```\n\n"
+    "`get` moves the key to the end, so the least recently used item is always first.\n\n"
+)
+
+LIST = (
+    "To set up the project:\n\n"
+    "1. Install the **dependencies** with `pip install -r requirements.txt`.\n"
+    "2. Copy `sample.config.yaml` to `config.yaml` and fill in the *homeserver*.\n"
+    "3. Create the database:\n"
+    "   - SQLite needs nothing else\n"
+    "   - Postgres needs an empty database and `psycopg2`\n"
+    "4. Start the bot and invite it to a room.\n\n"
+    "Things to keep in mind:\n\n"
+    "- The bot only answers commands with its prefix.\n"
+    "- Direct messages don't need the prefix.\n"
+    "- Answers are cached unless you add `--fresh`.\n\n"
+)
+
+PLAIN = (
+    "The French Revolution was a period of political and societal change in France that "
+    "began with the Estates General of 1789 and ended with the coup of 18 Brumaire in "
+    "November 1799. Many of its ideas are considered fundamental principles of liberal "
+    "democracy, while its values and institutions remain central to modern French "
+    "political discourse.\n\n"
+    "Its causes were a combination of social, political and economic factors which the "
+    "existing regime proved unable to manage.\n\n"
+)
+
+
+def best_of(runs, fn):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def stream_full(text, edit_chars):
+    for end in range(edit_chars, len(text) + edit_chars, edit_chars):
+        markdown2.markdown(text[:end], extras=MARKDOWN_EXTRAS)
+
+
+def stream_incremental(text, edit_chars):
+    renderer = IncrementalRenderer(MarkdownRenderer())
+    for end in range(edit_chars, len(text) + edit_chars, edit_chars):
+        renderer.render(text[:end])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=4, help="repetitions of each sample answer")
+    parser.add_argument("--runs", type=int, default=20, help="runs per measurement, the best counts")
+    parser.add_argument("--edit-chars", type=int, default=80, help="characters between two edits of a streamed answer")
+    args = parser.parse_args()
+
+    print(f"{'answer':<8}{'chars':>8}{'fresh ms':>10}{'reused ms':>11}{'cached ms':>11}{'stream full ms':>16}{'incremental ms':>16}")
+    for name, sample in (("code", CODE), ("list", LIST), ("plain", PLAIN)):
+        text = sample * args.scale
+        renderer = MarkdownRenderer(cache_size=0)
+        cached = MarkdownRenderer()
+        cached.render(text)
+
+        fresh = best_of(args.runs, lambda: markdown2.markdown(text, extras=MARKDOWN_EXTRAS))
+        reused = best_of(args.runs, lambda: renderer.render(text))
+        hit = best_of(args.runs, lambda: cached.render(text))
+        full = best_of(max(args.runs // 10, 1), lambda: stream_full(text, args.edit_chars))
+        incremental = best_of(max(args.runs // 10, 1), lambda: stream_incremental(text, args.edit_chars))
+        print(
+            f"{name:<8}{len(text):>8}{fresh * 1000:>10.3f}{reused * 1000:>11.3f}{hit * 1000:>11.4f}"
+            f"{full * 1000:>16.1f}{incremental * 1000:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Measure the time from launching the bot to handling its first message.
+
+Each run starts a fresh interpreter that imports the bot, sets it up like `main.py`
+does (from `sample.config.yaml`, with a scratch store), and hands it a first sync
+as it arrives without a stored sync token: the recent history of a room
+(`--backlog` old commands), followed by one new command. Reported per run are
+- the time spent importing the bot's modules,
+- the time from launch until the new command is handed to its lane,
+- the commands that were handed to a lane, and the old events ignored.
+
+With --replay, the backlog is not skipped, and every old command is handled before
+the new one. Commands are only handed to their lanes, not run, so no homeserver or
+LLM backend is needed.
+
+Usage:
+    python scripts-dev/bench_startup.py [--runs 5] [--backlog 50] [--replay]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+ROOM_ID = "!bench:example.com"
+
+
+def message(event_id, timestamp, body):
+    return {
+        "type": "m.room.message",
+        "event_id": event_id,
+        "sender": "@user:example.com",
+        "origin_server_ts": timestamp,
+        "content": {"msgtype": "m.text", "body": body},
+    }
+
+
+def first_sync(backlog, now_ms):
+    """The first sync of a bot without a sync token: old commands, then a new one"""
+    events = [message(f"$old{i}", now_ms - 3600 * 1000 + i, f"!c question {i}") for i in range(backlog)]
+    events.append(message("$new", now_ms + 1000, "!c new question"))
+    return {
+        "next_batch": "s1",
+        "rooms": {
+            "join": {
+                ROOM_ID: {
+                    "summary": {"m.joined_member_count": 3, "m.invited_member_count": 0},
+                    "timeline": {"events": events, "limited": True, "prev_batch": "s0"},
+                    "state": {"events": []},
+                }
+            }
+        },
+    }
+
+
+class SyncBody:
+    """The transport response of a sync, as nio reads it"""
+
+    def __init__(self, body):
+        self.body = json.dumps(body).encode()
+        self.status = 200
+        self.content_type = "application/json"
+        self.content_disposition = None
+
+    async def read(self):
+        return self.body
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+def child(args):
+    launched = args.launched
+    start = time.time()
+
+    import asyncio
+    import tempfile
+
+    import yaml
+
+    sys.path.insert(0, ROOT)
+    from nio import AsyncClientConfig, RoomMessageText, SyncResponse
+
+    from llm_to_matrix.callbacks import Callbacks
+    from llm_to_matrix.config import Config
+    from llm_to_matrix.conversation_store import ConversationStore
+    from llm_to_matrix.llm_client import LLMClient
+    from llm_to_matrix.parser.fetcher import PageFetcher
+    from llm_to_matrix.sync import SyncClient
+
+    imported = time.time()
+
+    scratch = tempfile.mkdtemp()
+    with open(os.path.join(ROOT, "sample.config.yaml")) as f:
+        config_dict = yaml.safe_load(f)
+    config_dict["storage"]["store_path"] = os.path.join(scratch, "store")
+    config_dict["storage"]["database"] = f"sqlite://{os.path.join(scratch, 'bot.db')}"
+    config_dict["matrix"]["user_password"] = "bench"
+    config_dict["logging"]["level"] = "WARNING"
+    config_dict["logging"]["console_logging"]["enabled"] = False
+    config_path = os.path.join(scratch, "config.yaml")
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config_dict, f)
+
+    async def run():
+        config = Config(config_path)
+        store = ConversationStore(database_config=config.database)
+        client = SyncClient(
+            config.homeserver_url,
+            config.user_id,
+            device_id=config.device_id,
+            store_path=config.store_path,
+            config=AsyncClientConfig(encryption_enabled=False),
+        )
+        llm = LLMClient(config)
+        fetcher = PageFetcher(config)
+        callbacks = Callbacks(client, store, config, llm, fetcher, started=start)
+        client.add_event_callback(callbacks.message, (RoomMessageText,))
+
+        # Note when each command would start, instead of running it
+        handled = []
+        callbacks.lanes.submit = lambda lane, process: handled.append(time.time())
+        if not args.replay:
+            callbacks.skip_backlog()
+
+        now_ms = int(time.time() * 1000)
+        response = await client.create_matrix_response(SyncResponse, SyncBody(first_sync(args.backlog, now_ms)))
+        await client.receive_response(response)
+
+        await llm.close()
+        await fetcher.close()
+        await store.close()
+        return handled, callbacks.skipped
+
+    handled, skipped = asyncio.get_event_loop().run_until_complete(run())
+    print(
+        json.dumps(
+            {
+                "imports": imported - start,
+                "first": handled[-1] - launched if handled else None,
+                "handled": len(handled),
+                "skipped": skipped,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5, help="fresh starts to measure")
+    parser.add_argument("--backlog", type=int, default=50, help="old commands in the first sync")
+    parser.add_argument("--replay", action="store_true", help="handle the backlog instead of skipping it")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--launched", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    print(f"{'run':<5}{'imports ms':>12}{'new command ms':>16}{'handled':>9}{'ignored':>9}")
+    for run in range(args.runs):
+        command = [sys.executable, os.path.abspath(__file__), "--child", "--backlog", str(args.backlog)]
+        if args.replay:
+            command.append("--replay")
+        command += ["--launched", repr(time.time())]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{run + 1:<5}{result['imports'] * 1000:>12.1f}{result['first'] * 1000:>16.1f}"
+            f"{result['handled']:>9}{result['skipped']:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
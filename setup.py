@@ -35,6 +35,7 @@ setup(
         "Markdown2[all]>=2.4.11",
         "PyYAML>=5.1.2",
         "beautifulsoup4",
+        "aiohttp>=3.6.2",
     ],
     extras_require={
         "postgres": ["psycopg2>=2.8.5"],
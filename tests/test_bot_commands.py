@@ -0,0 +1,393 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from llm_to_matrix.bot_commands import COMBINE_PROMPT, SUMMARY_PROMPT, Command
+from llm_to_matrix.conversation_store import ConversationStore
+from llm_to_matrix.errors import LLMError
+from llm_to_matrix.lanes import CommandLanes, Lane
+from llm_to_matrix.llm_client import LLMClient
+from llm_to_matrix.parser.fetcher import PageFetcher
+
+from tests.test_llm_client import make_config
+from tests.utils import run_coroutine
+
+
+class CommandTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = ConversationStore(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+            }
+        )
+
+        self.config = make_config("http://localhost:11434")
+        self.config.llm_model = "mistral"
+        self.config.llm_msg_template = ""
+        self.config.llm_param_stop = ""
+        self.config.llm_param_num_ctx = 2048
+        self.config.llm_param_num_predict = 256
+        self.config.llm_param_seed = 42
+        self.config.llm_param_top_k = 40
+        self.config.llm_param_top_p = 0.9
+        self.config.llm_param_repeat_last_n = 64
+        self.config.llm_param_temp = 0.8
+        self.config.llm_param_repeat_penalty = 1.1
+        self.config.llm_history_turns = 0
+        self.config.llm_stream = False
+        self.config.llm_queue_notice = False
+        self.config.llm_max_concurrent = 8
+        self.config.llm_model_concurrency = {}
+        self.config.llm_default_model_concurrency = 0
+        self.llm = LLMClient(self.config)
+
+        # Every generation sleeps a little, so that concurrent ones overlap
+        self.generated = []
+
+        async def generate(payload, timeout=None, hedge=False):
+            self.generated.append(payload)
+            answer = f"answer {len(self.generated)}"
+            await asyncio.sleep(0.01)
+            return {"response": answer, "done": True}
+
+        self.llm.generate = generate
+
+        # Everything sent to rooms, as (room ID, content)
+        self.sent = []
+        self.client = Mock(spec=nio.AsyncClient)
+        self.client.user_id = "@bot:example.com"
+
+        async def room_send(
+            room_id, message_type, content, tx_id=None, ignore_unverified_devices=False
+        ):
+            self.sent.append((room_id, content))
+            return nio.RoomSendResponse(f"$sent{len(self.sent)}", room_id)
+
+        async def room_typing(room_id, typing, timeout=30000):
+            return None
+
+        self.client.room_send.side_effect = room_send
+        self.client.room_typing.side_effect = room_typing
+
+    def tearDown(self) -> None:
+        run_coroutine(self.store.close())
+        self.tmpdir.cleanup()
+
+    def make_command(
+        self,
+        text,
+        room_id="!room:example.com",
+        sender="@alice:example.com",
+        event_id="$command",
+    ):
+        room = Mock(spec=nio.MatrixRoom)
+        room.room_id = room_id
+        event = Mock(spec=nio.RoomMessageText)
+        event.sender = sender
+        event.event_id = event_id
+        return Command(
+            self.client,
+            self.store,
+            self.config,
+            self.llm,
+            Mock(spec=PageFetcher),
+            text,
+            room,
+            event,
+        )
+
+    def bodies(self):
+        return [content["body"] for _, content in self.sent]
+
+    def test_identical_requests_share_a_generation(self):
+        """Tests that identical requests in flight at the same time make a single backend call"""
+        commands = [
+            self.make_command(
+                "what is matrix?",
+                room_id=f"!room{i}:example.com",
+                event_id=f"$command{i}",
+            )
+            for i in range(4)
+        ]
+
+        async def run():
+            await asyncio.gather(
+                *(
+                    command.send_llm_message(message="what is matrix?")
+                    for command in commands
+                )
+            )
+
+        run_coroutine(run())
+
+        self.assertEqual(len(self.generated), 1)
+        # Every room gets the answer
+        self.assertEqual(
+            sorted(room_id for room_id, _ in self.sent),
+            [f"!room{i}:example.com" for i in range(4)],
+        )
+        self.assertEqual(self.bodies(), ["answer 1"] * 4)
+        self.assertEqual(len(self.llm.inflight), 0)
+
+    def test_prompt_with_history(self):
+        """Tests that a request gets the two turns before it, once, inside the message
+        template
+        """
+        self.config.llm_history_turns = 2
+        self.config.llm_msg_template = "[INST] {message} [/INST]"
+        for i in range(4):
+            # Like echo, the first word of the message is taken as the command
+            command = self.make_command(f"ask question {i}", event_id=f"$command{i}")
+            run_coroutine(command._query_llm())
+
+        self.assertEqual(
+            self.generated[-1]["prompt"],
+            "[INST] The conversation so far:\n\n"
+            "User: question 1\n\n"
+            "Assistant: answer 2\n\n"
+            "User: question 2\n\n"
+            "Assistant: answer 3\n\n"
+            "---\n\n"
+            "question 3 [/INST]",
+        )
+
+    def test_shared_generation_fails_for_everyone(self):
+        """Tests that every request sharing a failed generation gets the error"""
+
+        async def generate(payload, timeout=None, hedge=False):
+            self.generated.append(payload)
+            await asyncio.sleep(0.01)
+            raise LLMError("The LLM backend failed")
+
+        self.llm.generate = generate
+        commands = [
+            self.make_command(
+                "what is matrix?",
+                room_id=f"!room{i}:example.com",
+                event_id=f"$command{i}",
+            )
+            for i in range(3)
+        ]
+
+        async def run():
+            await asyncio.gather(
+                *(
+                    command.send_llm_message(message="what is matrix?")
+                    for command in commands
+                )
+            )
+
+        with self.assertLogs(level="WARNING"):
+            run_coroutine(run())
+
+        self.assertEqual(len(self.generated), 1)
+        self.assertEqual(self.bodies(), ["The LLM backend failed"] * 3)
+        self.assertEqual(len(self.llm.inflight), 0)
+
+    def test_summarize_chunks(self):
+        """Tests that the parts of a long page are summarized, and the summaries reduced until they fit"""
+        prompts = []
+
+        async def generate(payload, timeout=None, hedge=False):
+            prompts.append(payload["prompt"])
+            return {
+                "response": f"Summary {len(prompts)} says what the part is about in a few words."
+            }
+
+        self.llm.generate = generate
+        chunks = [f"Part {i} of the page." for i in range(6)]
+
+        summary = run_coroutine(
+            self.make_command("li https://example.com")._summarize_chunks(
+                "mistral", chunks, 200
+            )
+        )
+
+        self.assertLessEqual(len(summary), 200)
+        # Six parts, then the summaries of those reduced in fewer groups
+        self.assertGreater(len(prompts), 6)
+        self.assertLess(len(prompts), 12)
+        self.assertTrue(
+            all(prompt.startswith(SUMMARY_PROMPT[:40]) for prompt in prompts[:6])
+        )
+        self.assertTrue(
+            all(prompt.startswith(COMBINE_PROMPT[:40]) for prompt in prompts[6:])
+        )
+        self.assertNotIn("Summary 1 ", summary)
+
+    def test_summarize_chunks_not_shrinking(self):
+        """Tests that the result is capped when the summaries don't get any shorter"""
+
+        async def generate(payload, timeout=None, hedge=False):
+            return {
+                "response": "This summary is every bit as long as the part it summarizes. "
+                * 5
+            }
+
+        self.llm.generate = generate
+        chunks = [f"Part {i} of the page." for i in range(3)]
+
+        with self.assertLogs(level="WARNING"):
+            summary = run_coroutine(
+                self.make_command("li https://example.com")._summarize_chunks(
+                    "mistral", chunks, 200
+                )
+            )
+
+        self.assertGreater(len(summary), 0)
+        self.assertLessEqual(len(summary), 200)
+
+    def test_summarize_chunks_failure_cancels_the_rest(self):
+        """Tests that the other parts stop being summarized once one of them failed"""
+        cancelled = []
+
+        async def generate(payload, timeout=None, hedge=False):
+            if "Part 0" in payload["prompt"]:
+                await asyncio.sleep(0.01)
+                raise LLMError("The LLM backend failed")
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(payload["prompt"])
+                raise
+            return {"response": "Summary."}
+
+        self.llm.generate = generate
+        chunks = [f"Part {i} of the page." for i in range(3)]
+        command = self.make_command("li https://example.com")
+
+        async def run():
+            with self.assertRaises(LLMError):
+                await command._summarize_chunks("mistral", chunks, 200)
+            # Let the cancellations go through
+            await asyncio.sleep(0)
+
+        run_coroutine(run())
+
+        self.assertEqual(len(cancelled), 2)
+
+    def test_summarize_chunk_cache(self):
+        """Tests that summarizing a page again generates each part once, even without
+        the answer cache, and again with --fresh
+        """
+        self.assertIsNone(self.llm.cache)
+        chunks = ["Part 0 of the page.", "Part 1 of the page."]
+
+        run_coroutine(
+            self.make_command("li https://example.com")._summarize_chunks(
+                "mistral", chunks, 200
+            )
+        )
+        self.assertEqual(len(self.generated), 2)
+
+        summary = run_coroutine(
+            self.make_command("li https://example.com")._summarize_chunks(
+                "mistral", chunks, 200
+            )
+        )
+        self.assertEqual(len(self.generated), 2)
+        self.assertEqual(sorted(summary.split("\n\n")), ["answer 1", "answer 2"])
+
+        command = self.make_command("li https://example.com --fresh")
+        summary = run_coroutine(command._summarize_chunks("mistral", chunks, 200))
+        self.assertEqual(len(self.generated), 4)
+        self.assertEqual(sorted(summary.split("\n\n")), ["answer 3", "answer 4"])
+
+        # Only the part that changed is summarized again
+        chunks[1] = "Part 1 of the changed page."
+        summary = run_coroutine(
+            self.make_command("li https://example.com")._summarize_chunks(
+                "mistral", chunks, 200
+            )
+        )
+        self.assertEqual(len(self.generated), 5)
+        self.assertEqual(summary.split("\n\n"), ["answer 3", "answer 5"])
+
+    def test_commands_answered_while_generations_are_busy(self):
+        """Tests that help, echo and ls are answered while the generation lane is full"""
+        release = asyncio.Event()
+
+        async def generate(payload, timeout=None, hedge=False):
+            await release.wait()
+            return {"response": "generated", "done": True}
+
+        async def models():
+            return []
+
+        self.llm.generate = generate
+        self.llm.catalog.models = models
+        lanes = CommandLanes({"instant": 2, "metadata": 1, "generation": 1})
+
+        async def run():
+            generations = [
+                self.make_command(f"question {i}", event_id=f"$question{i}")
+                for i in range(2)
+            ]
+            quick = [self.make_command(text) for text in ("help", "echo echo hi", "ls")]
+            generation_tasks = [
+                lanes.submit(command.lane, command.process) for command in generations
+            ]
+            quick_tasks = [
+                lanes.submit(command.lane, command.process) for command in quick
+            ]
+            await asyncio.wait_for(asyncio.gather(*quick_tasks), 1)
+            answered = self.bodies()
+
+            release.set()
+            await asyncio.gather(*generation_tasks)
+            return [command.lane for command in quick], answered
+
+        quick_lanes, answered = run_coroutine(run())
+
+        self.assertEqual(quick_lanes, [Lane.INSTANT, Lane.INSTANT, Lane.METADATA])
+        self.assertEqual(len(answered), 3)
+        self.assertIn("hi", answered)
+        self.assertNotIn("generated", answered)
+        self.assertEqual(self.bodies().count("generated"), 2)
+
+    def test_streamed_answer_finished_when_the_stream_breaks(self):
+        """Tests that the text streamed so far is sent in full when the stream fails"""
+
+        async def generate_stream(payload, timeout=None, hedge=False):
+            yield {"response": "The first ", "done": False}
+            yield {"response": "words", "done": False}
+            raise LLMError("The connection to the LLM backend broke off")
+
+        self.llm.generate_stream = generate_stream
+        self.config.llm_stream_edit_interval = 60000
+        self.config.llm_stream_edit_tokens = 0
+        command = self.make_command("question")
+
+        async def run():
+            with self.assertRaises(LLMError):
+                await command._generate_streamed(
+                    {"model": "mistral", "prompt": "question"}
+                )
+
+        run_coroutine(run())
+
+        self.assertEqual(self.bodies()[0], "The first ")
+        final = self.sent[-1][1]
+        self.assertEqual(final["m.relates_to"]["rel_type"], "m.replace")
+        self.assertEqual(final["m.new_content"]["body"], "The first words")
+
+    def test_fresh_flag(self):
+        """Tests that --fresh is only taken out of the arguments of generation commands"""
+        command = self.make_command("cm mistral what is --fresh matrix?")
+        self.assertTrue(command.bypass_cache)
+        self.assertEqual(command.args, ["mistral", "what", "is", "matrix?"])
+
+        command = self.make_command("echo echo hi --fresh")
+        self.assertFalse(command.bypass_cache)
+        run_coroutine(command.process())
+        self.assertEqual(self.bodies(), ["hi --fresh"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,6 +4,8 @@ from unittest.mock import Mock
 import nio
 
 from llm_to_matrix.callbacks import Callbacks
+from llm_to_matrix.llm_client import LLMClient
+from llm_to_matrix.parser.fetcher import PageFetcher
 from llm_to_matrix.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -16,12 +18,18 @@ class CallbacksTestCase(unittest.TestCase):
         self.fake_client.user = "@fake_user:example.com"
 
         self.fake_storage = Mock(spec=Storage)
+        self.fake_llm = Mock(spec=LLMClient)
+        self.fake_fetcher = Mock(spec=PageFetcher)
 
         # We don't spec config, as it doesn't currently have well defined attributes
         self.fake_config = Mock()
 
         self.callbacks = Callbacks(
-            self.fake_client, self.fake_storage, self.fake_config
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            self.fake_llm,
+            self.fake_fetcher,
         )
 
     def test_invite(self):
@@ -45,6 +53,53 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    def test_skip_backlog(self):
+        """Tests that events sent before the start are ignored once the backlog is skipped"""
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        self.callbacks.lanes = Mock()
+
+        def make_event(spec, timestamp, **source):
+            event = Mock(spec=spec)
+            event.event_id = "$event"
+            event.sender = "@some_other_fake_user:example.com"
+            event.server_timestamp = timestamp
+            event.body = "!c hello"
+            event.type = "m.reaction"
+            event.source = source
+            return event
+
+        old_events = [
+            make_event(nio.RoomMessageText, 999_000),
+            make_event(nio.MegolmEvent, 999_000),
+            make_event(
+                nio.UnknownEvent,
+                999_000,
+                content={
+                    "m.relates_to": {
+                        "event_id": "$answer",
+                        "rel_type": "m.annotation",
+                        "key": "👍",
+                    }
+                },
+            ),
+        ]
+        self.assertFalse(self.callbacks._is_backlog(old_events[0]))
+
+        self.callbacks.skip_backlog(before=1000.0)
+        run_coroutine(self.callbacks.message(fake_room, old_events[0]))
+        run_coroutine(self.callbacks.decryption_failure(fake_room, old_events[1]))
+        run_coroutine(self.callbacks.unknown(fake_room, old_events[2]))
+
+        self.assertEqual(self.callbacks.skipped, 3)
+        self.assertIsNone(self.callbacks.first_handled)
+        self.callbacks.lanes.submit.assert_not_called()
+        self.fake_client.room_get_event.assert_not_called()
+        self.fake_client.room_send.assert_not_called()
+        self.assertFalse(
+            self.callbacks._is_backlog(make_event(nio.RoomMessageText, 1_000_000))
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
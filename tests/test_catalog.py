@@ -0,0 +1,82 @@
+import unittest
+from unittest.mock import Mock
+
+from llm_to_matrix.catalog import ModelCatalog
+from llm_to_matrix.errors import LLMError
+
+from tests.utils import make_awaitable, run_coroutine
+
+TAGS = {
+    "models": [
+        {
+            "name": "mistral-7b-instruct:latest",
+            "size": 4109865159,
+            "digest": "61e88e884507",
+            "details": {
+                "family": "llama",
+                "parameter_size": "7B",
+                "quantization_level": "Q4_0",
+            },
+        },
+        {"name": "deepseek-coder-6.7b-instruct:latest", "size": 3827834503},
+        {"name": "stablelm-zephyr-3b:q8_0"},
+    ]
+}
+
+
+def make_catalog() -> ModelCatalog:
+    llm = Mock()
+    llm.list_models = Mock(side_effect=lambda: make_awaitable(TAGS))
+    return ModelCatalog(llm)
+
+
+class ModelCatalogTestCase(unittest.TestCase):
+    def test_models(self):
+        """Tests that the list is loaded once and kept in memory"""
+        catalog = make_catalog()
+        self.assertIsNone(catalog.get("mistral-7b-instruct"))
+
+        models = run_coroutine(catalog.models())
+        run_coroutine(catalog.models())
+        self.assertEqual(catalog.llm.list_models.call_count, 1)
+
+        self.assertEqual(
+            [model.name for model in models],
+            [
+                "deepseek-coder-6.7b-instruct:latest",
+                "mistral-7b-instruct:latest",
+                "stablelm-zephyr-3b:q8_0",
+            ],
+        )
+        mistral = catalog.get("mistral-7b-instruct")
+        self.assertEqual(mistral.quantization_level, "Q4_0")
+        self.assertEqual(mistral.describe(), "7B, Q4_0, 4.1 GB")
+
+    def test_resolve(self):
+        """Tests that model names are checked, with suggestions for near misses"""
+        catalog = make_catalog()
+
+        self.assertEqual(
+            run_coroutine(catalog.resolve("mistral-7b-instruct")),
+            ("mistral-7b-instruct:latest", []),
+        )
+        self.assertEqual(
+            run_coroutine(catalog.resolve("Stablelm-Zephyr-3b:Q8_0")),
+            ("stablelm-zephyr-3b:q8_0", []),
+        )
+        self.assertEqual(
+            run_coroutine(catalog.resolve("mistral-7b-instuct")),
+            (None, ["mistral-7b-instruct:latest"]),
+        )
+        self.assertEqual(run_coroutine(catalog.resolve("gpt-4")), (None, []))
+
+    def test_backend_unavailable(self):
+        """Tests that names aren't rejected when the list can't be loaded"""
+        catalog = ModelCatalog(Mock(list_models=Mock(side_effect=LLMError("down"))))
+        self.assertEqual(run_coroutine(catalog.resolve("mistral")), ("mistral", []))
+        with self.assertRaises(LLMError):
+            run_coroutine(catalog.models())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from llm_to_matrix.chat_functions import StreamingReply
+
+from tests.utils import run_coroutine
+
+
+class StreamingReplyTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        # Everything sent, as event contents
+        self.sent = []
+        self.client = Mock(spec=nio.AsyncClient)
+
+        async def room_send(
+            room_id, message_type, content, tx_id=None, ignore_unverified_devices=False
+        ):
+            self.sent.append(content)
+            return nio.RoomSendResponse(f"$event{len(self.sent)}", room_id)
+
+        self.client.room_send.side_effect = room_send
+
+    def edits(self):
+        """The text of every m.replace edit"""
+        return [
+            content["m.new_content"]["body"]
+            for content in self.sent
+            if content.get("m.relates_to", {}).get("rel_type") == "m.replace"
+        ]
+
+    def stream(self, reply, pieces, pause=0.0):
+        async def run():
+            for piece in pieces:
+                await reply.append(piece)
+                if pause:
+                    await asyncio.sleep(pause)
+            await reply.finish()
+
+        run_coroutine(run())
+
+    def test_first_piece_then_final_edit(self):
+        """Tests that within the interval only the first piece and the final text are sent"""
+        reply = StreamingReply(self.client, "!room:example.com", edit_interval=60)
+        self.stream(reply, [f"word{i} " for i in range(20)])
+
+        self.assertEqual(self.sent[0]["body"], "word0 ")
+        self.assertEqual(self.edits(), ["".join(f"word{i} " for i in range(20))])
+        self.assertEqual(reply.event_id, "$event1")
+
+    def test_edit_interval(self):
+        """Tests that an edit is sent once the interval has passed"""
+        reply = StreamingReply(self.client, "!room:example.com", edit_interval=0.01)
+        self.stream(reply, ["a", "b", "c"], pause=0.02)
+
+        # The first piece is a message, every later one an edit. Finishing has
+        # nothing left to send.
+        self.assertEqual(self.sent[0]["body"], "a")
+        self.assertEqual(self.edits(), ["ab", "abc"])
+
+    def test_edit_tokens(self):
+        """Tests that an edit is sent sooner once enough pieces have arrived"""
+        reply = StreamingReply(
+            self.client, "!room:example.com", edit_interval=60, edit_tokens=5
+        )
+        self.stream(reply, [str(i % 10) for i in range(20)])
+
+        # After the first piece, every fifth one, and the rest when finishing
+        self.assertEqual(
+            self.edits(),
+            ["012345", "01234567890", "0123456789012345", "01234567890123456789"],
+        )
+
+    def test_finish_with_text(self):
+        """Tests that finishing replaces the shown text, and sends nothing if it is already shown"""
+        reply = StreamingReply(self.client, "!room:example.com", edit_interval=60)
+        self.stream(reply, ["Hel", "lo"])
+        self.assertEqual(self.edits(), ["Hello"])
+
+        run_coroutine(reply.finish("Hello\n\n>stats"))
+        run_coroutine(reply.finish("Hello\n\n>stats"))
+        self.assertEqual(self.edits(), ["Hello", "Hello\n\n>stats"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,10 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import Mock
 
+import yaml
+
 from llm_to_matrix.config import Config
 from llm_to_matrix.errors import ConfigError
 
@@ -74,6 +78,23 @@ class ConfigTestCase(unittest.TestCase):
             "something",
         )
 
+    def test_optional_flags(self):
+        """Tests that options defaulting to false may be left out of the config file"""
+        with open("sample.config.yaml") as f:
+            config_dict = yaml.safe_load(f)
+        scratch = tempfile.mkdtemp()
+        config_dict["matrix"]["user_password"] = "password"
+        config_dict["storage"]["store_path"] = os.path.join(scratch, "store")
+        config_dict["logging"]["console_logging"]["enabled"] = False
+        del config_dict["llm"]["llm_hedge"]
+        config_path = os.path.join(scratch, "config.yaml")
+        with open(config_path, "w") as f:
+            yaml.safe_dump(config_dict, f)
+
+        config = Config(config_path)
+
+        self.assertFalse(config.llm_hedge)
+
     # TODO: Test creating a test yaml file, passing the path to Config and _parse_config_values is called correctly
 
 
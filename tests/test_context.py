@@ -0,0 +1,182 @@
+import os
+import tempfile
+import unittest
+
+from llm_to_matrix.context import ContextBuilder
+from llm_to_matrix.conversation_store import ConversationStore, MessageType, Role
+
+from tests.utils import run_coroutine
+
+USER = "@alice:example.com"
+BOT = "@bot:example.com"
+
+
+class ContextBuilderTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = ConversationStore(
+            {
+                "type": "sqlite",
+                "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+            }
+        )
+
+    def tearDown(self) -> None:
+        run_coroutine(self.store.close())
+        self.tmpdir.cleanup()
+
+    def add_turn(self, i, answer_tokens=None):
+        event_id = f"$event{i}"
+        run_coroutine(
+            self.store.add_message(
+                f"question {i}", USER, Role.USER, MessageType.DEFAULT, event_id=event_id
+            )
+        )
+        run_coroutine(
+            self.store.add_message(
+                f"answer {i}",
+                BOT,
+                Role.ASSISTANT,
+                MessageType.DEFAULT,
+                event_id=event_id,
+                token_count=answer_tokens,
+            )
+        )
+
+    def test_conversation(self):
+        """Tests that requests are returned along with their answers"""
+        for i in range(3):
+            self.add_turn(i)
+        rows = run_coroutine(self.store.get_conversation(USER, MessageType.DEFAULT, 2))
+        self.assertEqual(
+            [row[1] for row in rows],
+            ["question 1", "answer 1", "question 2", "answer 2"],
+        )
+        # Token counts are stored with the messages
+        self.assertEqual(rows[0][7], 3)
+
+    def test_build(self):
+        """Tests that the latest turns that fit are put in front of the prompt"""
+        for i in range(3):
+            self.add_turn(i)
+
+        context = run_coroutine(
+            ContextBuilder(self.store, 1000).build(
+                "question 3", USER, MessageType.DEFAULT
+            )
+        )
+        self.assertEqual(context.messages, 6)
+        self.assertTrue(context.fits)
+        self.assertLess(
+            context.prompt.index("question 0"), context.prompt.index("answer 2")
+        )
+        self.assertTrue(context.prompt.endswith("question 3"))
+
+        # The oldest answer takes up most of a small context
+        self.add_turn(3, answer_tokens=150)
+        context = run_coroutine(
+            ContextBuilder(self.store, 200).build(
+                "question 4", USER, MessageType.DEFAULT
+            )
+        )
+        self.assertEqual(context.messages, 0)
+
+        self.add_turn(4)
+        context = run_coroutine(
+            ContextBuilder(self.store, 200).build(
+                "question 5", USER, MessageType.DEFAULT
+            )
+        )
+        self.assertEqual(context.messages, 2)
+        self.assertIn("answer 4", context.prompt)
+        self.assertLessEqual(context.tokens, context.budget)
+
+    def test_request_itself_is_excluded(self):
+        """Tests that the stored request isn't repeated as history"""
+        self.add_turn(0)
+        run_coroutine(
+            self.store.add_message(
+                "question 1", USER, Role.USER, MessageType.DEFAULT, event_id="$event1"
+            )
+        )
+
+        builder = ContextBuilder(self.store, 1000)
+        context = run_coroutine(
+            builder.build(
+                "question 1", USER, MessageType.DEFAULT, exclude_event_id="$event1"
+            )
+        )
+        self.assertEqual(context.messages, 2)
+        self.assertEqual(context.prompt.count("question 1"), 1)
+
+        context = run_coroutine(
+            builder.build("question 1", USER, MessageType.DEFAULT, with_history=False)
+        )
+        self.assertEqual(context.prompt, "question 1")
+
+    def test_exact_prompt(self):
+        """Tests the prompt of a request with two earlier turns, when the request itself
+        is already stored
+        """
+        for i in range(3):
+            self.add_turn(i)
+        run_coroutine(
+            self.store.add_message(
+                "question 3", USER, Role.USER, MessageType.DEFAULT, event_id="$event3"
+            )
+        )
+
+        context = run_coroutine(
+            ContextBuilder(self.store, 1000, turns=2).build(
+                "question 3",
+                USER,
+                MessageType.DEFAULT,
+                exclude_event_id="$event3",
+                template="[INST] {message} [/INST]",
+            )
+        )
+        self.assertEqual(
+            context.prompt,
+            "[INST] The conversation so far:\n\n"
+            "User: question 1\n\n"
+            "Assistant: answer 1\n\n"
+            "User: question 2\n\n"
+            "Assistant: answer 2\n\n"
+            "---\n\n"
+            "question 3 [/INST]",
+        )
+        self.assertEqual(context.messages, 4)
+
+        # Without history, the template is applied to the request alone
+        context = run_coroutine(
+            ContextBuilder(self.store, 1000, turns=2).build(
+                "question 3",
+                USER,
+                MessageType.DEFAULT,
+                with_history=False,
+                template="[INST] {message} [/INST]",
+            )
+        )
+        self.assertEqual(context.prompt, "[INST] question 3 [/INST]")
+
+    def test_session(self):
+        """Tests that the backend's context is used instead of the history if it fits"""
+        self.add_turn(0)
+        builder = ContextBuilder(self.store, 200)
+
+        context = run_coroutine(
+            builder.build("question 1", USER, MessageType.DEFAULT, session=[1] * 100)
+        )
+        self.assertEqual(context.prompt, "question 1")
+        self.assertEqual(context.session, [1] * 100)
+        self.assertEqual(context.tokens, 103)
+
+        context = run_coroutine(
+            builder.build("question 1", USER, MessageType.DEFAULT, session=[1] * 150)
+        )
+        self.assertIsNone(context.session)
+        self.assertEqual(context.messages, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
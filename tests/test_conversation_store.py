@@ -0,0 +1,185 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_to_matrix.conversation_store import ConversationStore, MessageType, Role
+
+from tests.utils import run_coroutine
+
+
+class ConversationStoreTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database_config = {
+            "type": "sqlite",
+            "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+        }
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def add(self, store, content, user="@alice:example.com"):
+        run_coroutine(store.add_message(content, user, Role.USER, MessageType.DEFAULT))
+
+    def written(self):
+        """The contents of all messages that reached the database"""
+        store = ConversationStore(self.database_config)
+        rows = store._fetchall("SELECT content FROM messages ORDER BY id")
+        run_coroutine(store.close())
+        return [row[0] for row in rows]
+
+    def test_history(self):
+        """Tests that the latest messages are returned oldest first"""
+        store = ConversationStore(self.database_config)
+        for i in range(4):
+            self.add(store, str(i))
+        self.add(store, "other", user="@bob:example.com")
+
+        history = run_coroutine(
+            store.get_last_five_messages("@alice:example.com", MessageType.DEFAULT, 3)
+        )
+        self.assertEqual([row[1] for row in history], ["1", "2", "3"])
+
+        with self.assertRaises(ValueError):
+            run_coroutine(store.get_last_five_messages())
+        run_coroutine(store.close())
+
+    def test_write_batches(self):
+        """Tests that messages are written once a batch is full"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=3, write_batch_interval=60
+        )
+        self.add(store, "1")
+        self.add(store, "2")
+        self.assertEqual(self.written(), [])
+
+        self.add(store, "3")
+        self.assertEqual(self.written(), ["1", "2", "3"])
+        run_coroutine(store.close())
+
+    def test_pending_writes_are_read(self):
+        """Tests that history lookups include messages that are not written yet"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=3, write_batch_interval=60
+        )
+        for i in range(4):
+            self.add(store, str(i))
+        self.add(store, "other", user="@bob:example.com")
+
+        history = run_coroutine(
+            store.get_last_five_messages("@alice:example.com", MessageType.DEFAULT, 2)
+        )
+        self.assertEqual([row[1] for row in history], ["2", "3"])
+        run_coroutine(store.close())
+
+    def test_write_interval(self):
+        """Tests that an incomplete batch is written after the interval"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=10, write_batch_interval=0.01
+        )
+
+        async def add_and_wait():
+            await store.add_message(
+                "1", "@alice:example.com", Role.USER, MessageType.DEFAULT
+            )
+            await asyncio.sleep(0.1)
+
+        run_coroutine(add_and_wait())
+        self.assertEqual(self.written(), ["1"])
+        run_coroutine(store.close())
+
+    def test_read_during_flushes(self):
+        """Tests that a lookup sees every message exactly once while batches are being written"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=10, write_batch_interval=60
+        )
+        # Several storage threads, like the postgres pool, with slow batch writes. The
+        # second batch takes longer than the first. SQLite shares one connection, so
+        # the writes themselves still take turns.
+        store._executor.shutdown()
+        store._executor = ThreadPoolExecutor(max_workers=2)
+        execute_batch = store._execute_batch
+        delays = [0.02, 0.1]
+        lock = threading.Lock()
+
+        def slow_execute_batch(*args, **kwargs):
+            time.sleep(delays.pop(0))
+            with lock:
+                return execute_batch(*args, **kwargs)
+
+        store._execute_batch = slow_execute_batch
+        alice = "@alice:example.com"
+
+        async def run():
+            await store.add_message("0", alice, Role.USER, MessageType.DEFAULT)
+            await store.add_message("1", alice, Role.USER, MessageType.DEFAULT)
+            first = asyncio.ensure_future(store.flush())
+            await asyncio.sleep(0)
+            await store.add_message("2", alice, Role.USER, MessageType.DEFAULT)
+
+            # The lookup waits for the first batch, and the second one starts meanwhile
+            read = asyncio.ensure_future(
+                store.get_last_five_messages(alice, MessageType.DEFAULT)
+            )
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(store.flush())
+            history = await read
+            await asyncio.gather(first, second)
+            return history
+
+        history = run_coroutine(run())
+        self.assertEqual([row[1] for row in history], ["0", "1", "2"])
+        run_coroutine(store.close())
+
+    def test_close_writes_pending(self):
+        """Tests that pending messages are written on shutdown"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=10, write_batch_interval=60
+        )
+        self.add(store, "1")
+        run_coroutine(store.close())
+        self.assertEqual(self.written(), ["1"])
+
+    def test_close_during_read(self):
+        """Tests that batches waiting for a lookup are written on shutdown"""
+        store = ConversationStore(
+            self.database_config, write_batch_size=10, write_batch_interval=60
+        )
+        fetchall = store._fetchall
+
+        def slow_fetchall(*args, **kwargs):
+            time.sleep(0.05)
+            return fetchall(*args, **kwargs)
+
+        store._fetchall = slow_fetchall
+        alice = "@alice:example.com"
+
+        async def run():
+            await store.add_message("0", alice, Role.USER, MessageType.DEFAULT)
+            await store.add_message("1", alice, Role.USER, MessageType.DEFAULT)
+            read = asyncio.ensure_future(
+                store.get_last_five_messages(alice, MessageType.DEFAULT)
+            )
+            await asyncio.sleep(0)
+            # The batch waits for the lookup before it goes to the storage thread
+            flush = asyncio.ensure_future(store.flush())
+            await asyncio.sleep(0)
+            self.assertEqual(len(store._reads), 1)
+            self.assertEqual(len(store._writes), 1)
+            await store.add_message("2", alice, Role.USER, MessageType.DEFAULT)
+
+            await store.close()
+            await flush
+            return await read
+
+        history = run_coroutine(run())
+        self.assertEqual([row[1] for row in history], ["0", "1"])
+        self.assertEqual(self.written(), ["0", "1", "2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
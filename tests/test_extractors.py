@@ -0,0 +1,40 @@
+import unittest
+
+from llm_to_matrix.parser.extractors import StreamingExtractor
+
+PAGE = (
+    b"<html><head><title>Title<script>var s = '<p>';</script>"
+    b"<body><nav><a href='/'>Home</a></nav><p>Intro"
+    b"<main><h1>Heading</h1><p>Caf\xc3\xa9 &amp; more<script>track()</script>"
+    b"<p>Second paragraph</main><footer>Footer</footer></body></html>"
+)
+
+
+class StreamingExtractorTestCase(unittest.TestCase):
+    def test_main_content(self):
+        """Tests that only the readable text of the main element is kept"""
+        extractor = StreamingExtractor()
+        # Feed byte by byte to make sure nothing depends on how the page is split
+        for i in range(len(PAGE)):
+            extractor.feed(PAGE[i : i + 1])
+
+        self.assertEqual(extractor.close(), "Heading Café & more Second paragraph")
+
+    def test_body_without_main(self):
+        """Tests that the body text is used if there is no main/article element"""
+        extractor = StreamingExtractor()
+        extractor.feed(b"<body><div>One<div>Two</div></div><script>x</script></body>")
+
+        self.assertEqual(extractor.close(), "One Two")
+
+    def test_budget(self):
+        """Tests that feeding reports once enough text has been gathered"""
+        extractor = StreamingExtractor(max_chars=10)
+
+        self.assertFalse(extractor.feed(b"<main><p>Short"))
+        self.assertTrue(extractor.feed(b"<p>Some more text</p><p>Ignored"))
+        self.assertEqual(extractor.close(), "Short Some")
+
+
+if __name__ == "__main__":
+    unittest.main()
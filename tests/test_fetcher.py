@@ -0,0 +1,89 @@
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from llm_to_matrix.parser.fetcher import PageFetcher
+
+from tests.utils import run_coroutine
+
+PAGE = b"<html><body><main>" + b"Some text. " * 1000 + b"</main></body></html>"
+
+
+class PageFetcherTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        self.fake_config = Mock()
+        self.fake_config.fetch_cache_path = self.tmpdir.name
+        self.fake_config.fetch_timeout = 5
+        self.fake_config.fetch_max_bytes = 1024 * 1024
+        self.fake_config.fetch_pool_size = 4
+        self.fake_config.fetch_cache_entries = 10
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_conditional_get(self):
+        """Tests that a cached page is revalidated instead of downloaded again"""
+        requests = []
+
+        async def page(request):
+            requests.append(request.headers.get("If-None-Match"))
+            if request.headers.get("If-None-Match") == '"v1"':
+                return web.Response(status=304)
+            return web.Response(
+                body=PAGE, content_type="text/html", headers={"ETag": '"v1"'}
+            )
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/page", page)
+            server = TestServer(app)
+            await server.start_server()
+            fetcher = PageFetcher(self.fake_config)
+            url = str(server.make_url("/page"))
+            try:
+                first = await fetcher.fetch(url)
+                second = await fetcher.fetch(url)
+            finally:
+                await fetcher.close()
+                await server.close()
+            return first, second
+
+        first, second = run_coroutine(run())
+
+        self.assertEqual(requests, [None, '"v1"'])
+        self.assertEqual(first.body, PAGE)
+        self.assertFalse(first.from_cache)
+        self.assertEqual(second.body, PAGE)
+        self.assertTrue(second.from_cache)
+
+    def test_size_budget(self):
+        """Tests that reading stops once the byte budget is used up"""
+
+        async def page(request):
+            return web.Response(body=PAGE, content_type="text/html")
+
+        async def run():
+            app = web.Application()
+            app.router.add_get("/page", page)
+            server = TestServer(app)
+            await server.start_server()
+            fetcher = PageFetcher(self.fake_config)
+            try:
+                return await fetcher.fetch(str(server.make_url("/page")), max_bytes=100)
+            finally:
+                await fetcher.close()
+                await server.close()
+
+        fetched = run_coroutine(run())
+
+        self.assertEqual(fetched.body, PAGE[:100])
+        self.assertTrue(fetched.truncated)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from llm_to_matrix.hedging import LatencyTracker
+
+
+class LatencyTrackerTestCase(unittest.TestCase):
+    def test_hedge_delay(self):
+        """Tests that requests are hedged after the given percentile of recent latencies"""
+        tracker = LatencyTracker(percentile=90, window=10, min_samples=5)
+        for seconds in (1, 2, 3, 4):
+            tracker.record("mistral", seconds)
+        self.assertIsNone(tracker.hedge_delay("mistral"))
+
+        tracker.record("mistral", 100)
+        self.assertEqual(tracker.hedge_delay("mistral"), 100)
+
+        # Only the latest requests count
+        for _ in range(10):
+            tracker.record("mistral", 0.5)
+        self.assertEqual(tracker.hedge_delay("mistral"), 0.5)
+        self.assertIsNone(tracker.hedge_delay("llama"))
+
+
+if __name__ == "__main__":
+    unittest.main()
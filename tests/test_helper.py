@@ -0,0 +1,45 @@
+import unittest
+
+from llm_to_matrix.helper import split_into_chunks
+
+SENTENCES = [
+    f"Sentence number {i} talks about topic {i % 7} at some length." for i in range(200)
+]
+TEXT = " ".join(SENTENCES)
+
+
+class HelperTestCase(unittest.TestCase):
+    def test_split_into_chunks(self):
+        """Tests that chunks fit, end on sentence boundaries and keep all of the text"""
+        chunks = split_into_chunks(TEXT, 500)
+
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertLessEqual(len(chunk), 500)
+            self.assertTrue(chunk.endswith("."))
+        self.assertEqual(" ".join(chunks), TEXT)
+
+    def test_split_short_text(self):
+        """Tests that text that fits stays a single chunk, and empty text gives none"""
+        self.assertEqual(split_into_chunks("Short. Text.", 500), ["Short. Text."])
+        self.assertEqual(split_into_chunks("", 500), [])
+
+    def test_split_long_sentence(self):
+        """Tests that a sentence longer than a chunk is cut into pieces"""
+        chunks = split_into_chunks("x" * 1200, 500)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [500, 500, 200])
+
+    def test_split_is_stable(self):
+        """Tests that an edit only changes the chunks around it"""
+        edited = SENTENCES[:100] + ["An inserted sentence."] + SENTENCES[100:]
+        before = split_into_chunks(TEXT, 500)
+        after = split_into_chunks(" ".join(edited), 500)
+
+        changed = set(after) - set(before)
+        self.assertLessEqual(len(changed), 2)
+        self.assertGreater(len(set(after) & set(before)), len(before) // 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
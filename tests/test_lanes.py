@@ -0,0 +1,84 @@
+import asyncio
+import unittest
+
+from llm_to_matrix.lanes import CommandLanes, Lane
+
+from tests.utils import run_coroutine
+
+
+class CommandLanesTestCase(unittest.TestCase):
+    def test_full_generation_lane(self):
+        """Tests that instant and metadata commands run while every generation worker is busy"""
+        lanes = CommandLanes({"instant": 2, "metadata": 1, "generation": 1})
+        release = asyncio.Event()
+        done = []
+
+        async def generation(name):
+            await release.wait()
+            done.append(name)
+
+        async def quick(name):
+            done.append(name)
+
+        async def run():
+            first = lanes.submit(Lane.GENERATION, lambda: generation("generation 1"))
+            second = lanes.submit(Lane.GENERATION, lambda: generation("generation 2"))
+            quick_tasks = [
+                lanes.submit(Lane.INSTANT, lambda: quick("help")),
+                lanes.submit(Lane.INSTANT, lambda: quick("echo")),
+                lanes.submit(Lane.METADATA, lambda: quick("ls")),
+            ]
+            await asyncio.wait_for(asyncio.gather(*quick_tasks), 1)
+            state = (list(done), dict(lanes.running), dict(lanes.waiting))
+
+            release.set()
+            await asyncio.gather(first, second)
+            return state
+
+        (finished, running, waiting) = run_coroutine(run())
+
+        self.assertEqual(finished, ["help", "echo", "ls"])
+        self.assertEqual(running[Lane.GENERATION], 1)
+        self.assertEqual(waiting[Lane.GENERATION], 1)
+        self.assertEqual(done, ["help", "echo", "ls", "generation 1", "generation 2"])
+
+    def test_lane_limit(self):
+        """Tests that a lane runs at most its number of workers at once, and that a
+        failing command gives its worker back
+        """
+        lanes = CommandLanes({"instant": 1, "metadata": 1, "generation": 2})
+        running = 0
+        most_running = 0
+        done = []
+
+        async def generation(name):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+            if name == 0:
+                raise RuntimeError("The LLM backend failed")
+            done.append(name)
+
+        async def run():
+            tasks = [
+                lanes.submit(Lane.GENERATION, lambda name=name: generation(name))
+                for name in range(5)
+            ]
+            await asyncio.sleep(0)
+            self.assertEqual(lanes.running[Lane.GENERATION], 2)
+            self.assertEqual(lanes.waiting[Lane.GENERATION], 3)
+            await asyncio.wait(tasks)
+
+        with self.assertLogs("llm_to_matrix.lanes", level="ERROR"):
+            run_coroutine(run())
+
+        self.assertEqual(most_running, 2)
+        self.assertEqual(done, [1, 2, 3, 4])
+        self.assertEqual(lanes.running[Lane.GENERATION], 0)
+        self.assertEqual(lanes.waiting[Lane.GENERATION], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,333 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import Mock
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from llm_to_matrix.errors import BackendUnavailableError, LLMError
+from llm_to_matrix.llm_client import LLMClient
+
+from tests.utils import run_coroutine
+
+
+def make_config(base_url: str) -> Mock:
+    fake_config = Mock()
+    fake_config.llm_base_url = base_url
+    fake_config.llm_url_suffix = "/api/generate"
+    fake_config.llm_tags_suffix = "/api/tags"
+    fake_config.llm_timeout = 5
+    fake_config.llm_connect_timeout = 5
+    fake_config.llm_pool_size = 4
+    fake_config.llm_keepalive_timeout = 30
+    fake_config.llm_keep_alive = 300
+    fake_config.llm_hot_keep_alive = 3600
+    fake_config.llm_hot_models = 2
+    fake_config.llm_backends = [base_url]
+    fake_config.llm_backend_max_failures = 3
+    fake_config.llm_backend_eject_time = 30
+    fake_config.llm_hedge = False
+    fake_config.llm_hedge_max_prompt_tokens = 256
+    fake_config.llm_hedge_percentile = 95
+    fake_config.llm_summary_cache_size = 64
+    return fake_config
+
+
+class LLMClientTestCase(unittest.TestCase):
+    def test_generate_and_list_models(self):
+        """Tests that requests are sent to the configured endpoints"""
+        received = []
+
+        async def generate(request):
+            received.append(await request.json())
+            return web.json_response({"response": "hi"})
+
+        async def tags(request):
+            return web.json_response({"models": [{"name": "mistral"}]})
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            app.router.add_get("/api/tags", tags)
+            server = TestServer(app)
+            await server.start_server()
+            llm = LLMClient(make_config(str(server.make_url("/"))))
+            try:
+                result = await llm.generate({"model": "mistral", "prompt": "hello"})
+                models = await llm.list_models()
+            finally:
+                await llm.close()
+                await server.close()
+            return result, models
+
+        result, models = run_coroutine(run())
+
+        self.assertEqual(result, {"response": "hi"})
+        self.assertEqual(models["models"][0]["name"], "mistral")
+        self.assertEqual(received[0]["prompt"], "hello")
+        self.assertFalse(received[0]["stream"])
+
+    def test_generate_stream(self):
+        """Tests that NDJSON chunks are decoded, even when split across reads"""
+        chunks = [
+            {"response": "Hel", "done": False},
+            {"response": "lo", "done": False},
+            {"response": "", "done": True, "context": list(range(20000))},
+        ]
+
+        async def generate(request):
+            response = web.StreamResponse()
+            response.content_type = "application/x-ndjson"
+            await response.prepare(request)
+            body = "".join(json.dumps(chunk) + "\n" for chunk in chunks).encode()
+            for i in range(0, len(body), 7):
+                await response.write(body[i : i + 7])
+            await response.write_eof()
+            return response
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            server = TestServer(app)
+            await server.start_server()
+            llm = LLMClient(make_config(str(server.make_url("/"))))
+            try:
+                return [
+                    chunk
+                    async for chunk in llm.generate_stream(
+                        {"model": "mistral", "prompt": "hello"}
+                    )
+                ]
+            finally:
+                await llm.close()
+                await server.close()
+
+        received = run_coroutine(run())
+
+        self.assertEqual(received, chunks)
+
+    def test_error_status(self):
+        """Tests that a non-2xx response is raised as an LLMError"""
+
+        async def generate(request):
+            return web.Response(status=500, text="model not found")
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            server = TestServer(app)
+            await server.start_server()
+            llm = LLMClient(make_config(str(server.make_url("/"))))
+            try:
+                await llm.generate({"model": "nope", "prompt": "hello"})
+            finally:
+                await llm.close()
+                await server.close()
+
+        with self.assertRaises(LLMError) as cm:
+            run_coroutine(run())
+        self.assertEqual(cm.exception.status, 500)
+
+    def test_invalid_json(self):
+        """Tests that a response that isn't JSON is raised as an LLMError"""
+
+        async def generate(request):
+            return web.Response(status=200, text="<html>proxy error</html>")
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            server = TestServer(app)
+            await server.start_server()
+            llm = LLMClient(make_config(str(server.make_url("/"))))
+            try:
+                await llm.generate({"model": "mistral", "prompt": "hello"})
+            finally:
+                await llm.close()
+                await server.close()
+
+        with self.assertRaises(LLMError) as cm:
+            run_coroutine(run())
+        self.assertIn("Invalid response", str(cm.exception))
+
+    def test_routing(self):
+        """Tests that requests go to the backends that have the model"""
+        received = {"a": [], "b": []}
+
+        def make_app(name, models):
+            async def generate(request):
+                received[name].append((await request.json())["model"])
+                return web.json_response({"response": name})
+
+            async def tags(request):
+                return web.json_response(
+                    {"models": [{"name": model} for model in models]}
+                )
+
+            async def ps(request):
+                return web.json_response({"models": []})
+
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            app.router.add_get("/api/tags", tags)
+            app.router.add_get("/api/ps", ps)
+            return app
+
+        async def run():
+            server_a = TestServer(make_app("a", ["codellama:latest"]))
+            server_b = TestServer(make_app("b", ["mistral:latest", "codellama:latest"]))
+            await server_a.start_server()
+            await server_b.start_server()
+
+            config = make_config(str(server_a.make_url("/")))
+            # Nothing listens on the last one
+            config.llm_backends = [
+                str(server_a.make_url("/")),
+                str(server_b.make_url("/")),
+                "http://127.0.0.1:1/",
+            ]
+            config.llm_backend_max_failures = 1
+            llm = LLMClient(config)
+            try:
+                await asyncio.gather(
+                    *(llm._check_backend(b) for b in llm.router.backends)
+                )
+                dead = llm.router.backends[2]
+                self.assertTrue(dead.ejected)
+
+                await llm.generate({"model": "mistral", "prompt": "hello"})
+                await llm.generate({"model": "codellama", "prompt": "hello"})
+                await llm.generate({"model": "codellama", "prompt": "hello"})
+                return await llm.list_models()
+            finally:
+                await llm.close()
+                await server_a.close()
+                await server_b.close()
+
+        models = run_coroutine(run())
+
+        self.assertEqual(received["b"].count("mistral"), 1)
+        # codellama stays on the backend that loaded it first
+        self.assertEqual(
+            sorted(
+                [received["a"].count("codellama"), received["b"].count("codellama")]
+            ),
+            [0, 2],
+        )
+        self.assertEqual(
+            sorted(model["name"] for model in models["models"]),
+            ["codellama:latest", "mistral:latest"],
+        )
+
+    def test_unavailable(self):
+        """Tests that requests fail straight away while the backend is ejected"""
+
+        async def run():
+            config = make_config("http://127.0.0.1:1/")
+            config.llm_backend_max_failures = 1
+            llm = LLMClient(config)
+            try:
+                with self.assertRaises(LLMError) as first:
+                    await llm.generate({"model": "mistral", "prompt": "hello"})
+                with self.assertRaises(BackendUnavailableError) as second:
+                    await llm.generate({"model": "mistral", "prompt": "hello"})
+                return first.exception, second.exception
+            finally:
+                await llm.close()
+
+        first, second = run_coroutine(run())
+
+        self.assertNotIsInstance(first, BackendUnavailableError)
+        self.assertIn("busy", str(second))
+        self.assertGreater(second.retry_after, 25)
+
+    def test_hedging(self):
+        """Tests that slow requests are sent to a second backend, which then wins"""
+        release = asyncio.Event()
+        received = {"slow": 0, "fast": 0}
+
+        def make_app(name):
+            async def generate(request):
+                received[name] += 1
+                if name == "slow":
+                    await release.wait()
+                if not (await request.json())["stream"]:
+                    return web.json_response({"response": name})
+                response = web.StreamResponse()
+                await response.prepare(request)
+                for chunk in (
+                    {"response": name, "done": False},
+                    {"response": "", "done": True},
+                ):
+                    await response.write(json.dumps(chunk).encode() + b"\n")
+                await response.write_eof()
+                return response
+
+            app = web.Application()
+            app.router.add_post("/api/generate", generate)
+            return app
+
+        async def run():
+            slow = TestServer(make_app("slow"))
+            fast = TestServer(make_app("fast"))
+            await slow.start_server()
+            await fast.start_server()
+
+            config = make_config(str(slow.make_url("/")))
+            config.llm_backends = [str(slow.make_url("/")), str(fast.make_url("/"))]
+            config.llm_hedge = True
+            llm = LLMClient(config)
+            slow_backend, fast_backend = llm.router.backends
+            # Prefer the slow backend for the first request
+            llm.router.update(
+                slow_backend, ["mistral:latest"], loaded=["mistral:latest"]
+            )
+            llm.router.update(fast_backend, ["mistral:latest"])
+            for _ in range(llm.latency.min_samples):
+                llm.latency.record(("mistral", False), 0.05)
+                llm.latency.record(("mistral", True), 0.05)
+            try:
+                result = await llm.generate(
+                    {"model": "mistral", "prompt": "hello"}, hedge=True
+                )
+                llm.router.update(fast_backend, ["mistral:latest"], loaded=[])
+                chunks = [
+                    chunk
+                    async for chunk in llm.generate_stream(
+                        {"model": "mistral", "prompt": "hello"}, hedge=True
+                    )
+                ]
+                long_prompt = {"model": "mistral", "prompt": "hello " * 1000}
+                llm.router.update(fast_backend, ["mistral:latest"], loaded=[])
+                unhedged = asyncio.ensure_future(llm.generate(long_prompt, hedge=True))
+                await asyncio.sleep(0.2)
+                release.set()
+                unhedged = await unhedged
+                return (
+                    result,
+                    chunks,
+                    unhedged,
+                    llm.hedged,
+                    llm.hedges_won,
+                    slow_backend,
+                )
+            finally:
+                release.set()
+                await llm.close()
+                await slow.close()
+                await fast.close()
+
+        result, chunks, unhedged, hedged, won, slow_backend = run_coroutine(run())
+
+        self.assertEqual(result["response"], "fast")
+        self.assertEqual([chunk["response"] for chunk in chunks], ["fast", ""])
+        self.assertEqual(unhedged["response"], "slow")
+        self.assertEqual((hedged, won), (2, 2))
+        # The cancelled requests don't count against the slow backend
+        self.assertEqual(slow_backend.outstanding, 0)
+        self.assertEqual(slow_backend.breaker.failures, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from llm_to_matrix.outbox import Outbox, TokenBucket
+
+from tests.utils import run_coroutine
+
+
+def make_client(responses):
+    """A client whose sends return (or raise) the given responses in turn, then succeed"""
+    client = Mock(spec=nio.AsyncClient)
+    sent = []
+
+    async def room_send(
+        room_id, message_type, content, tx_id=None, ignore_unverified_devices=False
+    ):
+        sent.append((room_id, content, tx_id))
+        # Give other sends the chance to queue up behind this one
+        await asyncio.sleep(0.01)
+        response = (
+            responses.pop(0)
+            if responses
+            else nio.RoomSendResponse(f"$event{len(sent)}", room_id)
+        )
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def room_typing(room_id, typing, timeout):
+        sent.append((room_id, "typing" if typing else "stopped typing", None))
+
+    client.room_send.side_effect = room_send
+    client.room_typing.side_effect = room_typing
+    return client, sent
+
+
+def notice(body):
+    return {
+        "msgtype": "m.notice",
+        "body": body,
+        "format": "org.matrix.custom.html",
+        "formatted_body": f"<p>{body}</p>",
+    }
+
+
+class OutboxTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        """Tests that the bucket allows bursts, then the rate, and pauses when told to"""
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertAlmostEqual(bucket.wait_time(), 0.1, delta=0.02)
+
+        bucket.pause(5)
+        self.assertGreater(bucket.wait_time(), 4.9)
+
+    def test_merging(self):
+        """Tests that queued notices are merged and queued edits superseded"""
+        client, sent = make_client([])
+        outbox = Outbox(client)
+        edit = {
+            "msgtype": "m.notice",
+            "body": "* b",
+            "m.relates_to": {"rel_type": "m.replace", "event_id": "$1"},
+        }
+
+        async def run():
+            first = asyncio.ensure_future(
+                outbox.send("!room", "m.room.message", notice("first"), merge=True)
+            )
+            # Wait for the first one to be in flight, so nothing is merged into it
+            await asyncio.sleep(0.005)
+            return [await first] + await asyncio.gather(
+                outbox.send("!room", "m.room.message", notice("second"), merge=True),
+                outbox.send("!room", "m.room.message", notice("third"), merge=True),
+                outbox.send("!room", "m.room.message", edit),
+                outbox.send("!room", "m.room.message", dict(edit, body="* bc")),
+                outbox.send(
+                    "!other", "m.room.message", notice("elsewhere"), merge=True
+                ),
+            )
+
+        responses = run_coroutine(run())
+
+        # Rooms don't wait for each other, but each room gets its messages in order
+        in_room = [content for room_id, content, _ in sent if room_id == "!room"]
+        self.assertEqual(
+            [content["body"] for content in in_room],
+            ["first", "second\n\nthird", "* bc"],
+        )
+        self.assertEqual(in_room[1]["formatted_body"], "<p>second</p><p>third</p>")
+        self.assertEqual(len(sent), 4)
+        self.assertIs(responses[1], responses[2])
+        self.assertIs(responses[3], responses[4])
+        self.assertEqual(outbox.stats()["merged"], 2)
+
+    def test_retries(self):
+        """Tests that rate limits and failed sends are waited out and tried again"""
+        client, sent = make_client(
+            [
+                nio.RoomSendError(
+                    "slow down", "M_LIMIT_EXCEEDED", retry_after_ms=50, room_id="!room"
+                ),
+                nio.SendRetryError("keys not shared"),
+            ]
+        )
+        outbox = Outbox(client, backoff=0.01)
+
+        response = run_coroutine(
+            outbox.send("!room", "m.room.message", notice("hello"))
+        )
+
+        self.assertIsInstance(response, nio.RoomSendResponse)
+        self.assertEqual(len(sent), 3)
+        # The same transaction, so the homeserver shows it once at most
+        self.assertEqual(len({tx_id for _, _, tx_id in sent}), 1)
+        self.assertEqual(outbox.stats()["rate_limited"], 1)
+        self.assertEqual(outbox.stats()["retries"], 1)
+
+        # Giving up eventually
+        client, sent = make_client([nio.SendRetryError("no")] * 3)
+        outbox = Outbox(client, max_retries=2, backoff=0.01)
+        self.assertIsNone(
+            run_coroutine(outbox.send("!room", "m.room.message", notice("hello")))
+        )
+
+    def test_typing(self):
+        """Tests that typing notifications are only sent when they change something"""
+        client, sent = make_client([])
+        outbox = Outbox(client)
+
+        async def run():
+            await outbox.typing("!room", False)
+            await outbox.typing("!room", True)
+            await outbox.typing("!room", True)
+            await outbox.typing("!room", False)
+            await outbox.typing("!room", False)
+
+        run_coroutine(run())
+
+        self.assertEqual(
+            [content for _, content, _ in sent], ["typing", "stopped typing"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+
+import markdown2
+
+from llm_to_matrix.rendering import (
+    MARKDOWN_EXTRAS,
+    IncrementalRenderer,
+    MarkdownRenderer,
+    append_footer,
+    split_blocks,
+)
+
+from tests.utils import run_coroutine
+
+ANSWER = (
+    "Here is a function:\n\n"
+    "```python\ndef double(x):\n\n    return x * 2\n```\n\n"
+    "It works like this:\n\n"
+    "1. Take **x**\n2. Double it\n\n   with `*`\n\n"
+    "- loose\n\n- list\n\n"
+    "> A quote\n\n"
+    "That's all.\n"
+)
+
+
+class RenderingTestCase(unittest.TestCase):
+    def test_split_blocks(self):
+        """Tests that markdown is only cut where the parts render independently"""
+        text = "One\n\nTwo\n\n```\ncode\n\nThree\n```\n\n- a\n\nFour\n\nFive"
+        parts = [
+            text[start:end]
+            for start, end in zip(
+                [0] + split_blocks(text), split_blocks(text) + [len(text)]
+            )
+        ]
+        self.assertEqual(
+            parts,
+            [
+                "One\n\n",
+                "Two\n\n",
+                "```\ncode\n\nThree\n```\n\n- a\n\n",
+                "Four\n\nFive",
+            ],
+        )
+
+        # Raw HTML and link definitions may tie blocks together
+        self.assertEqual(split_blocks("A\n\nB\n\n<div>\n\nC\n\n</div>\n\nD\n"), [3])
+        self.assertEqual(split_blocks("A [b][1]\n\nC\n\n[1]: http://example.com\n"), [])
+
+    def test_cache(self):
+        """Tests that rendered texts are cached, and only as many as configured"""
+        renderer = MarkdownRenderer(cache_size=2)
+        html = renderer.render("**hi**")
+        self.assertEqual(html, markdown2.markdown("**hi**", extras=MARKDOWN_EXTRAS))
+        self.assertEqual(renderer.render("**hi**"), html)
+        renderer.render("a", cache=False)
+        renderer.render("b")
+        renderer.render("c")
+        self.assertEqual(renderer.stats(), {"hits": 1, "misses": 4, "size": 2})
+
+        # Large texts are rendered in a worker thread, with the same result
+        renderer = MarkdownRenderer(offload_chars=10)
+        self.assertEqual(
+            run_coroutine(renderer.render_async(ANSWER)),
+            markdown2.markdown(ANSWER, extras=MARKDOWN_EXTRAS),
+        )
+
+    def test_incremental(self):
+        """Tests that a message rendered piece by piece matches rendering it at once"""
+        renderer = IncrementalRenderer(MarkdownRenderer())
+        for end in range(1, len(ANSWER) + 1, 3):
+            text = ANSWER[:end]
+            self.assertEqual(
+                renderer.render(text), markdown2.markdown(text, extras=MARKDOWN_EXTRAS)
+            )
+        self.assertEqual(
+            run_coroutine(renderer.render_async(ANSWER)),
+            markdown2.markdown(ANSWER, extras=MARKDOWN_EXTRAS),
+        )
+
+        # Rewritten messages are rendered again from scratch
+        self.assertEqual(
+            renderer.render("Other"),
+            markdown2.markdown("Other", extras=MARKDOWN_EXTRAS),
+        )
+
+    def test_leading_line_break(self):
+        """Tests that an answer starting with a line break doesn't start with an empty
+        paragraph
+        """
+        answer = "\n" + ANSWER
+        self.assertNotIn(0, split_blocks(answer))
+        self.assertNotIn(1, split_blocks(answer))
+
+        renderer = IncrementalRenderer(MarkdownRenderer())
+        for end in range(1, len(answer) + 1, 3):
+            html = renderer.render(answer[:end])
+            self.assertFalse(html.startswith("<p></p>"))
+        self.assertEqual(html, markdown2.markdown(answer, extras=MARKDOWN_EXTRAS))
+        self.assertTrue(html.startswith("<p>Here is a function:</p>"))
+
+        renderer = IncrementalRenderer(MarkdownRenderer())
+        self.assertEqual(renderer.render("\n"), "")
+        self.assertEqual(run_coroutine(renderer.render_async("\n \n")), "")
+
+    def test_append_footer(self):
+        """Tests that footers end up below the text, outside of open code blocks"""
+        self.assertEqual(append_footer("Answer", ">stats"), "Answer\n\n>stats")
+        self.assertEqual(append_footer("Answer", ""), "Answer")
+        self.assertEqual(
+            append_footer("```py\ncut off", ">stats"), "```py\ncut off\n```\n\n>stats"
+        )
+        self.assertEqual(
+            append_footer("```\nx\n```", ">stats"), "```\nx\n```\n\n>stats"
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from llm_to_matrix.conversation_store import ConversationStore
+from llm_to_matrix.response_cache import ResponseCache
+
+from tests.utils import run_coroutine
+
+
+def make_payload(prompt: str, seed: int = 42) -> dict:
+    return {
+        "model": "mistral",
+        "prompt": prompt,
+        "options": {"seed": seed, "temperature": 0.6},
+    }
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database_config = {
+            "type": "sqlite",
+            "connection_string": os.path.join(self.tmpdir.name, "bot.db"),
+        }
+        self.store = ConversationStore(self.database_config)
+
+    def tearDown(self) -> None:
+        run_coroutine(self.store.close())
+        self.tmpdir.cleanup()
+
+    def test_is_cacheable(self):
+        """Tests that only deterministic generations are cached"""
+        self.assertTrue(ResponseCache.is_cacheable(make_payload("hi")))
+        self.assertFalse(ResponseCache.is_cacheable(make_payload("hi", seed=-1)))
+        self.assertFalse(
+            ResponseCache.is_cacheable(dict(make_payload("hi"), context=[1, 2]))
+        )
+
+    def test_get_and_put(self):
+        """Tests lookups in the memory and database tiers"""
+        cache = ResponseCache(self.store, max_entries=1)
+        key = cache.make_key(make_payload("hi"))
+        other_key = cache.make_key(make_payload("bye"))
+        self.assertNotEqual(key, other_key)
+
+        self.assertIsNone(run_coroutine(cache.get(key)))
+        run_coroutine(cache.put(key, "mistral", "hello"))
+        self.assertEqual(run_coroutine(cache.get(key)), "hello")
+
+        # Pushes the first entry out of memory, so it has to come from the database
+        run_coroutine(cache.put(other_key, "mistral", "goodbye"))
+        self.assertEqual(run_coroutine(cache.get(key)), "hello")
+
+        self.assertEqual(
+            cache.stats(),
+            {"memory_hits": 1, "store_hits": 1, "misses": 1, "entries": 1},
+        )
+
+        # Entries survive a restart
+        restarted_store = ConversationStore(self.database_config)
+        restarted = ResponseCache(restarted_store)
+        self.assertEqual(run_coroutine(restarted.get(other_key)), "goodbye")
+        run_coroutine(restarted_store.close())
+
+    def test_eviction(self):
+        """Tests that the database tier is bounded"""
+        cache = ResponseCache(self.store, max_rows=1)
+        for i in range(3):
+            run_coroutine(
+                self.store.put_cached_response(str(i), "mistral", "answer", i + 100)
+            )
+        run_coroutine(self.store.evict_cached_responses(101, cache.max_rows))
+
+        rows = self.store._fetchall("SELECT cache_key FROM response_cache")
+        self.assertEqual(sorted(row[0] for row in rows), ["2"])
+
+    def test_concurrent_requests(self):
+        """Tests that queries run off the event loop without interfering"""
+
+        async def roundtrip(i):
+            await self.store.put_cached_response(str(i), "mistral", f"answer {i}", 100)
+            return await self.store.get_cached_response(str(i), 0)
+
+        async def run_all():
+            return await asyncio.gather(*(roundtrip(i) for i in range(20)))
+
+        self.assertEqual(run_coroutine(run_all()), [f"answer {i}" for i in range(20)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+import unittest
+
+from llm_to_matrix.breaker import BreakerState
+from llm_to_matrix.errors import BackendUnavailableError, LLMError
+from llm_to_matrix.router import BackendRouter
+
+from tests.utils import run_coroutine
+
+
+class BackendRouterTestCase(unittest.TestCase):
+    def test_least_outstanding(self):
+        """Tests that requests go to the least busy backend"""
+        router = BackendRouter(["http://a/", "http://b/"])
+        a, b = router.backends
+
+        async def run():
+            async with router.route() as first:
+                async with router.route() as second:
+                    return first, second
+
+        first, second = run_coroutine(run())
+        self.assertNotEqual(first, second)
+        self.assertEqual(a.outstanding + b.outstanding, 0)
+
+        a.outstanding = 1
+        self.assertIs(router.pick(), b)
+
+    def test_model_affinity(self):
+        """Tests that backends with the model installed and loaded are preferred"""
+        router = BackendRouter(["http://a/", "http://b/", "http://c/"])
+        a, b, c = router.backends
+        router.update(a, ["llama:latest"])
+        router.update(b, ["mistral:latest"], loaded=["mistral:latest"])
+        router.update(c, ["mistral:latest"])
+
+        self.assertIs(router.pick("mistral"), b)
+        self.assertIs(router.pick("llama"), a)
+
+        # Loading the model elsewhere beats waiting behind many requests
+        b.outstanding = 3
+        self.assertIs(router.pick("mistral"), c)
+
+        # Nobody has it: any backend will do
+        self.assertIn(router.pick("phi"), [a, c])
+
+    def test_ejection(self):
+        """Tests that failing backends are ejected until they are healthy again"""
+        router = BackendRouter(["http://a/", "http://b/"], max_failures=2)
+        a, b = router.backends
+
+        router.failure(a, LLMError("connection refused"))
+        router.failure(a, LLMError("model not found", status=404))
+        router.failure(a, LLMError("connection refused"))
+        self.assertFalse(a.ejected)
+
+        async def fail():
+            async with router.route():
+                raise LLMError("timed out")
+
+        while not a.ejected:
+            with self.assertRaises(LLMError):
+                run_coroutine(fail())
+        self.assertEqual([router.pick() for _ in range(3)], [b, b, b])
+
+        # Everything is down: fail straight away
+        for _ in range(2):
+            router.failure(b, LLMError("timed out", status=502))
+        self.assertTrue(b.ejected)
+        self.assertEqual(router.available(), [])
+        with self.assertRaises(BackendUnavailableError) as raised:
+            router.pick()
+        self.assertGreater(raised.exception.retry_after, 25)
+
+        # Only a passed trial request takes a backend back
+        a.breaker.opened_at -= 30
+        self.assertEqual(router.available(), [a])
+
+    def test_half_open(self):
+        """Tests that an ejected backend gets a single trial request after a while"""
+        router = BackendRouter(["http://a/"], max_failures=1, eject_time=30)
+        (a,) = router.backends
+        router.failure(a, LLMError("timed out"))
+        self.assertEqual(a.breaker.state, BreakerState.OPEN)
+
+        # Let the eject time pass
+        a.breaker.opened_at -= 30
+        self.assertEqual(a.breaker.state, BreakerState.HALF_OPEN)
+
+        async def trial(fail):
+            async with router.route():
+                # Nothing else goes to the backend while the trial is in flight
+                with self.assertRaises(BackendUnavailableError):
+                    router.pick()
+                if fail:
+                    raise LLMError("timed out")
+
+        with self.assertRaises(LLMError):
+            run_coroutine(trial(True))
+        self.assertEqual(a.breaker.state, BreakerState.OPEN)
+
+        a.breaker.opened_at -= 30
+        run_coroutine(trial(False))
+        self.assertEqual(a.breaker.state, BreakerState.CLOSED)
+        self.assertEqual(router.available(), [a])
+
+    def test_health_check_while_ejected(self):
+        """Tests that a passed health check doesn't take an ejected backend back"""
+        router = BackendRouter(
+            ["http://a/", "http://b/"], max_failures=1, eject_time=30
+        )
+        a, b = router.backends
+        router.failure(a, LLMError("internal server error", status=500))
+        self.assertTrue(a.ejected)
+
+        # The model list still loads while generations fail
+        router.update(a, ["mistral:latest"], ["mistral:latest"])
+        self.assertTrue(a.ejected)
+        self.assertEqual(a.installed, {"mistral:latest"})
+        self.assertEqual(router.available(), [b])
+        self.assertIs(router.pick("mistral"), b)
+
+        # Once the eject time passed, it still only gets a single trial request
+        a.breaker.opened_at -= 30
+        router.update(a, ["mistral:latest"])
+        self.assertEqual(a.breaker.state, BreakerState.HALF_OPEN)
+        a.breaker.acquire()
+        self.assertEqual(router.available(), [b])
+        router.failure(a, LLMError("internal server error", status=500))
+        self.assertTrue(a.ejected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+import asyncio
+import unittest
+
+from llm_to_matrix.scheduler import GenerationScheduler
+
+from tests.utils import run_coroutine
+
+
+class GenerationSchedulerTestCase(unittest.TestCase):
+    def test_round_robin_across_rooms(self):
+        """Tests that a busy room doesn't starve a quieter one"""
+        scheduler = GenerationScheduler(max_concurrent=1)
+        order = []
+        positions = {}
+
+        async def request(room_id, name, release):
+            async def on_queued(position):
+                positions[name] = position
+
+            async with scheduler.slot("model", room_id, "@user:example.com", on_queued):
+                order.append(name)
+                await release.wait()
+
+        async def run():
+            release = asyncio.Event()
+            tasks = [
+                asyncio.ensure_future(request("!a", name, release))
+                for name in ("a1", "a2", "a3")
+            ]
+            await asyncio.sleep(0)
+            tasks.append(asyncio.ensure_future(request("!b", "b1", release)))
+            await asyncio.sleep(0)
+            release.set()
+            await asyncio.gather(*tasks)
+
+        run_coroutine(run())
+
+        self.assertEqual(order, ["a1", "a2", "b1", "a3"])
+        self.assertEqual(positions, {"a2": 1, "a3": 2, "b1": 2})
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_model_limit(self):
+        """Tests that a saturated model doesn't block other models"""
+        scheduler = GenerationScheduler(max_concurrent=2, model_limits={"big": 1})
+        running = []
+
+        async def request(model, name, release):
+            async with scheduler.slot(model, "!room", name):
+                running.append(name)
+                await release.wait()
+
+        async def run():
+            release = asyncio.Event()
+            tasks = [
+                asyncio.ensure_future(request(model, name, release))
+                for model, name in (
+                    ("big", "big1"),
+                    ("big", "big2"),
+                    ("small", "small1"),
+                )
+            ]
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            started = list(running)
+            release.set()
+            await asyncio.gather(*tasks)
+            return started
+
+        self.assertEqual(run_coroutine(run()), ["big1", "small1"])
+
+    def test_cancelled_while_queued(self):
+        """Tests that a request cancelled while queued doesn't hold on to a slot or
+        its turn
+        """
+        scheduler = GenerationScheduler(max_concurrent=1)
+        order = []
+
+        async def request(room_id, user, name):
+            async with scheduler.slot("model", room_id, user):
+                order.append(name)
+
+        async def run():
+            await scheduler.acquire("model", "!a", "@holder:example.com")
+            tasks = {
+                name: asyncio.ensure_future(request(room_id, user, name))
+                for room_id, user, name in (
+                    ("!a", "@alice:example.com", "a1"),
+                    ("!b", "@bob:example.com", "b1"),
+                    ("!a", "@alice:example.com", "a2"),
+                )
+            }
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queued, 3)
+
+            tasks["a1"].cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(scheduler.queued, 2)
+            self.assertEqual(scheduler.active, 1)
+
+            scheduler.release("model")
+            await asyncio.gather(tasks["b1"], tasks["a2"])
+            self.assertTrue(tasks["a1"].cancelled())
+
+        run_coroutine(run())
+
+        self.assertEqual(order, ["a2", "b1"])
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.active_per_model, {})
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_cancelled_after_granted(self):
+        """Tests that a slot granted to a request that is then cancelled goes to the
+        next one in line
+        """
+        scheduler = GenerationScheduler(max_concurrent=1)
+
+        async def run():
+            await scheduler.acquire("model", "!a", "@holder:example.com")
+            first = asyncio.ensure_future(
+                scheduler.acquire("model", "!a", "@alice:example.com")
+            )
+            second = asyncio.ensure_future(
+                scheduler.acquire("model", "!b", "@bob:example.com")
+            )
+            await asyncio.sleep(0)
+
+            # The slot is handed to the first request, which is cancelled before it
+            # gets to run
+            scheduler.release("model")
+            self.assertEqual(scheduler.active, 1)
+            first.cancel()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+
+            self.assertTrue(first.cancelled())
+            self.assertTrue(second.done())
+            self.assertEqual(scheduler.active, 1)
+            scheduler.release("model")
+
+        run_coroutine(run())
+
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.active_per_model, {})
+        self.assertEqual(scheduler.queued, 0)
+
+    def test_failing_queue_notice(self):
+        """Tests that a request still gets its slot when announcing its position fails"""
+        scheduler = GenerationScheduler(max_concurrent=1)
+        started = []
+
+        async def on_queued(position):
+            raise RuntimeError("Unable to send the notice")
+
+        async def request():
+            async with scheduler.slot("model", "!a", "@alice:example.com", on_queued):
+                started.append(scheduler.active)
+
+        async def run():
+            await scheduler.acquire("model", "!a", "@holder:example.com")
+            task = asyncio.ensure_future(request())
+            with self.assertLogs("llm_to_matrix.scheduler", level="ERROR"):
+                await asyncio.sleep(0)
+            self.assertEqual(scheduler.queued, 1)
+
+            scheduler.release("model")
+            await task
+
+        run_coroutine(run())
+
+        self.assertEqual(started, [1])
+        self.assertEqual(scheduler.active, 0)
+        self.assertEqual(scheduler.queued, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
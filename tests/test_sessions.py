@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from llm_to_matrix.sessions import SessionCache
+
+
+class SessionCacheTestCase(unittest.TestCase):
+    def test_get_and_put(self):
+        """Tests that the latest context of a session is returned"""
+        sessions = SessionCache()
+        fingerprint = sessions.fingerprint("mistral", "{message}", 8192)
+        key = ("!room:example.com", "@alice:example.com", "mistral")
+
+        self.assertIsNone(sessions.get(key, fingerprint))
+        sessions.put(key, fingerprint, [1, 2, 3])
+        sessions.put(key, fingerprint, [1, 2, 3, 4])
+        self.assertEqual(sessions.get(key, fingerprint), [1, 2, 3, 4])
+
+        sessions.discard(key)
+        self.assertIsNone(sessions.get(key, fingerprint))
+
+    def test_invalidation(self):
+        """Tests that sessions are dropped when what they depend on changes"""
+        sessions = SessionCache(ttl=60)
+        key = ("!room:example.com", "@alice:example.com", "mistral")
+        sessions.put(key, sessions.fingerprint("mistral", "{message}"), [1, 2])
+
+        self.assertIsNone(
+            sessions.get(key, sessions.fingerprint("mistral", "Q: {message}"))
+        )
+        self.assertEqual(len(sessions), 0)
+
+        fingerprint = sessions.fingerprint("mistral", "{message}")
+        sessions.put(key, fingerprint, [1, 2])
+        with patch("llm_to_matrix.sessions.time.time", return_value=1e12):
+            self.assertIsNone(sessions.get(key, fingerprint))
+
+        # Not a list of token IDs
+        sessions.put(key, fingerprint, [2 ** 40])
+        self.assertIsNone(sessions.get(key, fingerprint))
+
+    def test_eviction(self):
+        """Tests that the least recently used sessions are dropped first"""
+        sessions = SessionCache(max_sessions=2)
+        for key in "abc":
+            sessions.put(key, "", [1])
+            if key == "b":
+                sessions.get("a", "")
+
+        self.assertEqual(sessions.get("a", ""), [1])
+        self.assertIsNone(sessions.get("b", ""))
+        self.assertEqual(sessions.get("c", ""), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
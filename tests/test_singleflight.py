@@ -0,0 +1,128 @@
+import asyncio
+import unittest
+
+from llm_to_matrix.singleflight import SingleFlight
+
+from tests.utils import run_coroutine
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_concurrent_calls_share_one_call(self):
+        """Tests that concurrent calls with the same key run the work once and share its result"""
+        flight = SingleFlight()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return {"response": "hi"}
+
+        async def run():
+            results = await asyncio.gather(*(flight.do("key", work) for _ in range(5)))
+            return results, len(flight)
+
+        results, in_flight = run_coroutine(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([result for result, _ in results], [{"response": "hi"}] * 5)
+        self.assertIs(results[0][0], results[4][0])
+        self.assertEqual(
+            [shared for _, shared in results], [False, True, True, True, True]
+        )
+        self.assertEqual(in_flight, 0)
+
+    def test_different_keys(self):
+        """Tests that calls with different keys don't share"""
+        flight = SingleFlight()
+        calls = []
+
+        async def work(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key
+
+        async def run():
+            return await asyncio.gather(
+                flight.do("a", lambda: work("a")), flight.do("b", lambda: work("b"))
+            )
+
+        self.assertEqual(run_coroutine(run()), [("a", False), ("b", False)])
+        self.assertEqual(sorted(calls), ["a", "b"])
+
+    def test_exception_reaches_every_caller(self):
+        """Tests that the leader's exception is raised to every waiter, and that the key is cleared"""
+        flight = SingleFlight()
+        calls = []
+
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise ValueError("backend down")
+
+        async def succeed():
+            return "hi"
+
+        async def run():
+            results = await asyncio.gather(
+                *(flight.do("key", fail) for _ in range(3)), return_exceptions=True
+            )
+            in_flight = len(flight)
+            # The next call starts over instead of getting the old failure
+            return results, in_flight, await flight.do("key", succeed)
+
+        results, in_flight, retried = run_coroutine(run())
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+            self.assertEqual(str(result), "backend down")
+        self.assertEqual(in_flight, 0)
+        self.assertEqual(retried, ("hi", False))
+
+    def test_waiter_cancelled(self):
+        """Tests that a waiter giving up doesn't cancel the call for the others"""
+        flight = SingleFlight()
+
+        async def work():
+            await asyncio.sleep(0.02)
+            return "hi"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do("key", work))
+            waiter = asyncio.ensure_future(flight.do("key", work))
+            await asyncio.sleep(0.005)
+            waiter.cancel()
+            return await leader
+
+        self.assertEqual(run_coroutine(run()), ("hi", False))
+
+    def test_leader_cancelled(self):
+        """Tests that the caller whose call is shared giving up doesn't cancel the call
+        for the waiters, and that the key is cleared once the call finished
+        """
+        flight = SingleFlight()
+        calls = 0
+
+        async def work():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return "hi"
+
+        async def run():
+            leader = asyncio.ensure_future(flight.do("key", work))
+            waiters = [asyncio.ensure_future(flight.do("key", work)) for _ in range(2)]
+            await asyncio.sleep(0.005)
+            leader.cancel()
+            results = await asyncio.gather(*waiters)
+            self.assertTrue(leader.cancelled())
+            return results
+
+        self.assertEqual(run_coroutine(run()), [("hi", True), ("hi", True)])
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(flight), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
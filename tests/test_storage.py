@@ -0,0 +1,166 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from llm_to_matrix.conversation_store import (
+    CONVERSATION_QUERY,
+    HISTORY_QUERIES,
+    ConversationStore,
+)
+from llm_to_matrix.storage import (
+    latest_migration_version,
+    postgres_query,
+    prepared_statement,
+)
+
+from tests.utils import run_coroutine
+
+# The schema of a database created before any migrations existed
+BASELINE_SCHEMA = [
+    "CREATE TABLE migration_version (version INTEGER PRIMARY KEY)",
+    "INSERT INTO migration_version (version) VALUES (0)",
+    """
+    CREATE TABLE messages (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      role TEXT,
+      content TEXT,
+      user TEXT,
+      model TEXT,
+      messageType TEXT,
+      prompt TEXT,
+      event_id TEXT,
+      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    INSERT INTO messages (role, content, user, messageType, event_id)
+    VALUES ('user', 'hello there', '@alice:example.com', 'default', '$1')
+    """,
+]
+
+
+class StorageTestCase(unittest.TestCase):
+    def test_postgres_query(self):
+        """Tests the translation of placeholders for psycopg2"""
+        self.assertEqual(
+            postgres_query("SELECT * FROM messages WHERE id = ? AND role = ?"),
+            "SELECT * FROM messages WHERE id = %s AND role = %s",
+        )
+
+    def test_prepared_statement(self):
+        """Tests that queries are translated into prepared statements once"""
+        query = 'SELECT content FROM messages WHERE "user" = ? ORDER BY id DESC LIMIT ?'
+        name, prepare, execute = prepared_statement(query)
+
+        self.assertEqual(
+            prepare,
+            f'PREPARE {name} AS SELECT content FROM messages WHERE "user" = $1 ORDER BY id DESC LIMIT $2',
+        )
+        self.assertEqual(execute, f"EXECUTE {name} (%s, %s)")
+        self.assertEqual(prepared_statement(query)[0], name)
+
+        other_name, _, other_execute = prepared_statement("SELECT 1")
+        self.assertNotEqual(other_name, name)
+        self.assertEqual(other_execute, f"EXECUTE {other_name}")
+
+    def test_pool_stats(self):
+        """Tests that connection usage is counted"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = ConversationStore(
+                {"type": "sqlite", "connection_string": os.path.join(tmpdir, "bot.db")}
+            )
+            checkouts = store.pool_stats()["checkouts"]
+            store._fetchone("SELECT version FROM migration_version")
+
+            stats = store.pool_stats()
+            self.assertEqual(stats["checkouts"], checkouts + 1)
+            self.assertEqual(stats["in_use"], 0)
+            self.assertEqual(stats["peak_in_use"], 1)
+            run_coroutine(store.close())
+
+    def test_sqlite_profile(self):
+        """Tests that the configured pragmas are applied and maintenance runs"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = ConversationStore(
+                {
+                    "type": "sqlite",
+                    "connection_string": os.path.join(tmpdir, "bot.db"),
+                    "pragmas": {"journal_mode": "WAL", "synchronous": "NORMAL"},
+                    "vacuum_pages": 10,
+                }
+            )
+            self.assertEqual(store._fetchone("PRAGMA journal_mode")[0], "wal")
+            self.assertEqual(store._fetchone("PRAGMA synchronous")[0], 1)
+            # 2 means INCREMENTAL
+            self.assertEqual(store._fetchone("PRAGMA auto_vacuum")[0], 2)
+
+            store._execute_batch(
+                "INSERT INTO response_cache (cache_key, response, created_at) VALUES (?, ?, ?)",
+                [(str(i), "x" * 1000, i) for i in range(200)],
+            )
+            store._execute("DELETE FROM response_cache")
+            free_pages = store._fetchone("PRAGMA freelist_count")[0]
+            self.assertGreater(free_pages, 10)
+
+            store.maintain()
+            self.assertLessEqual(
+                store._fetchone("PRAGMA freelist_count")[0], free_pages - 10
+            )
+            run_coroutine(store.close())
+
+    def test_migrate_baseline_database(self):
+        """Tests that a database from before the migrations gets the history indexes, and
+        that the history queries use them
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "bot.db")
+            conn = sqlite3.connect(path)
+            for statement in BASELINE_SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+            conn.close()
+
+            store = ConversationStore({"type": "sqlite", "connection_string": path})
+
+            self.assertEqual(
+                store._fetchone("SELECT version FROM migration_version")[0],
+                latest_migration_version,
+            )
+            indexes = {
+                row[0]: row[1]
+                for row in store._fetchall(
+                    "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index'"
+                )
+            }
+            self.assertEqual(indexes.get("messages_user_type_id"), "messages")
+            self.assertEqual(indexes.get("messages_event_id"), "messages")
+            # Existing messages get an estimated token count
+            self.assertEqual(store._fetchone("SELECT token_count FROM messages")[0], 3)
+
+            def plan(query, params):
+                return " ".join(
+                    row[-1]
+                    for row in store._fetchall("EXPLAIN QUERY PLAN " + query, params)
+                )
+
+            self.assertIn(
+                "USING INDEX messages_user_type_id",
+                plan(
+                    HISTORY_QUERIES[(True, True)], ("@alice:example.com", "default", 5)
+                ),
+            )
+            self.assertIn(
+                "USING INDEX messages_user_type_id",
+                plan(HISTORY_QUERIES[(True, False)], ("@alice:example.com", 5)),
+            )
+            conversation = plan(
+                CONVERSATION_QUERY, ("@alice:example.com", "default", 5, 10)
+            )
+            self.assertIn("USING INDEX messages_user_type_id", conversation)
+            self.assertIn("USING INDEX messages_event_id", conversation)
+            run_coroutine(store.close())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+from llm_to_matrix.summary_cache import SummaryCache
+
+
+class SummaryCacheTestCase(unittest.TestCase):
+    def test_key(self):
+        """Tests that summaries are found by model, prompt and content"""
+        key = SummaryCache.make_key("mistral", "Summarize: {content}", "Part 0.")
+        self.assertEqual(
+            key, SummaryCache.make_key("mistral", "Summarize: {content}", "Part 0.")
+        )
+        self.assertNotEqual(
+            key, SummaryCache.make_key("llama2", "Summarize: {content}", "Part 0.")
+        )
+        self.assertNotEqual(
+            key, SummaryCache.make_key("mistral", "Combine: {content}", "Part 0.")
+        )
+        self.assertNotEqual(
+            key, SummaryCache.make_key("mistral", "Summarize: {content}", "Part 1.")
+        )
+
+    def test_least_recently_used_dropped(self):
+        """Tests that the least recently used summary is dropped when the cache is full"""
+        cache = SummaryCache(max_entries=2)
+        cache.put("a", "summary a")
+        cache.put("b", "summary b")
+        self.assertEqual(cache.get("a"), "summary a")
+        cache.put("c", "summary c")
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "summary a")
+        self.assertEqual(cache.get("c"), "summary c")
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+    def test_disabled(self):
+        """Tests that nothing is kept with a size of 0"""
+        cache = SummaryCache(max_entries=0)
+        cache.put("a", "summary a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
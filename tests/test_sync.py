@@ -0,0 +1,141 @@
+import json
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from llm_to_matrix.sync import STATE_TYPES, SyncClient, build_sync_filter
+
+from tests.utils import make_awaitable, run_coroutine
+
+SYNC_BODY = {
+    "next_batch": "s2",
+    "rooms": {
+        "join": {
+            "!room:example.org": {
+                "summary": {"m.joined_member_count": 5000, "m.invited_member_count": 0},
+                "timeline": {
+                    "events": [
+                        {
+                            "type": "m.room.message",
+                            "event_id": "$1",
+                            "sender": "@alice:example.org",
+                            "origin_server_ts": 1,
+                            "content": {"msgtype": "m.text", "body": "!c hello"},
+                        }
+                    ],
+                    "limited": False,
+                    "prev_batch": "s1",
+                },
+                "state": {
+                    "events": [
+                        {
+                            "type": "m.room.member",
+                            "state_key": "@alice:example.org",
+                            "event_id": "$0",
+                            "sender": "@alice:example.org",
+                            "origin_server_ts": 0,
+                            "content": {"membership": "join"},
+                        }
+                    ]
+                },
+            }
+        }
+    },
+}
+
+
+class FakeTransportResponse:
+    def __init__(self, body):
+        self.body = json.dumps(body).encode()
+        self.status = 200
+        self.content_type = "application/json"
+        self.content_disposition = None
+
+    async def read(self):
+        return self.body
+
+    async def json(self):
+        return json.loads(self.body)
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store_path = tempfile.mkdtemp()
+
+    def make_client(self, **kwargs):
+        return SyncClient(
+            "https://example.org",
+            "@bot:example.org",
+            store_path=self.store_path,
+            **kwargs
+        )
+
+    def test_filter(self):
+        """Tests that the filter leaves out what the bot doesn't use and lazy-loads members"""
+        sync_filter = build_sync_filter(timeline_limit=10)
+
+        self.assertEqual(sync_filter["presence"], {"not_types": ["*"]})
+        self.assertEqual(sync_filter["room"]["ephemeral"], {"not_types": ["*"]})
+        timeline = sync_filter["room"]["timeline"]
+        self.assertEqual(timeline["limit"], 10)
+        self.assertTrue(timeline["lazy_load_members"])
+        self.assertIn("m.reaction", timeline["types"])
+        self.assertIn("m.room.encrypted", timeline["types"])
+        self.assertEqual(
+            sync_filter["room"]["state"],
+            {"types": STATE_TYPES, "lazy_load_members": True},
+        )
+
+    def test_sync_filter_uploaded_once(self):
+        """Tests that the filter is uploaded once and then referred to by its ID"""
+        client = self.make_client()
+        client.upload_filter = Mock(
+            return_value=make_awaitable(nio.UploadFilterResponse("f1"))
+        )
+
+        async def run():
+            return [await client.sync_filter(), await client.sync_filter()]
+
+        self.assertEqual(run_coroutine(run()), ["f1", "f1"])
+        client.upload_filter.assert_called_once_with(**build_sync_filter())
+
+    def test_sync_filter_fallback(self):
+        """Tests that the filter is sent with the syncs if it can't be uploaded, and not at all when disabled"""
+        client = self.make_client(timeline_limit=5)
+        client.upload_filter = Mock(
+            return_value=make_awaitable(nio.UploadFilterError("nope"))
+        )
+        with self.assertLogs("llm_to_matrix.sync", level="WARNING"):
+            self.assertEqual(run_coroutine(client.sync_filter()), build_sync_filter(5))
+
+        client = self.make_client(lean=False)
+        client.upload_filter = Mock()
+        self.assertIsNone(run_coroutine(client.sync_filter()))
+        client.upload_filter.assert_not_called()
+
+    def test_sync_metrics(self):
+        """Tests that syncs are measured and that the full state is only needed before the first one"""
+        client = self.make_client()
+        self.assertTrue(client.needs_full_state())
+
+        async def run():
+            transport = FakeTransportResponse(SYNC_BODY)
+            response = await client.create_matrix_response(nio.SyncResponse, transport)
+            await client.receive_response(response)
+            return response, len(transport.body)
+
+        response, size = run_coroutine(run())
+
+        self.assertIsInstance(response, nio.SyncResponse)
+        stats = client.sync_stats.stats()
+        self.assertEqual(stats["syncs"], 1)
+        self.assertEqual(stats["bytes"], size)
+        self.assertEqual(stats["largest_bytes"], size)
+        self.assertFalse(client.needs_full_state())
+        self.assertEqual(client.rooms["!room:example.org"].member_count, 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from llm_to_matrix.outbox import Outbox
+from llm_to_matrix.typing_indicators import TypingIndicators
+
+from tests.utils import run_coroutine
+
+
+class TypingIndicatorsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sent = []
+        self.client = Mock(spec=nio.AsyncClient)
+
+        async def room_typing(room_id, typing, timeout):
+            self.sent.append((room_id, typing))
+
+        self.client.room_typing.side_effect = room_typing
+
+    def test_shared_indicator(self):
+        """Tests that the indicator stays up until the last request in the room is done"""
+        indicators = Outbox(self.client).indicators
+
+        async def run():
+            first = indicators.hold("!room")
+            with indicators.hold("!room"):
+                other = indicators.hold("!other")
+                await asyncio.sleep(0.01)
+                first.release()
+                first.release()
+                await asyncio.sleep(0.01)
+                self.assertEqual(indicators.holds("!room"), 1)
+                self.assertNotIn(("!room", False), self.sent)
+            other.release()
+            await asyncio.sleep(0.01)
+
+        run_coroutine(run())
+
+        self.assertEqual(self.sent.count(("!room", True)), 1)
+        self.assertEqual(self.sent[-2:], [("!room", False), ("!other", False)])
+        self.assertEqual(indicators.holds("!room"), 0)
+
+    def test_refresh(self):
+        """Tests that the indicator is sent again before it expires"""
+        indicators = TypingIndicators(Outbox(self.client), timeout=100)
+
+        async def run():
+            with indicators.hold("!room"):
+                await asyncio.sleep(0.25)
+            await asyncio.sleep(0.01)
+
+        run_coroutine(run())
+
+        self.assertGreaterEqual(self.sent.count(("!room", True)), 3)
+        self.assertEqual(self.sent[-1], ("!room", False))
+
+
+if __name__ == "__main__":
+    unittest.main()
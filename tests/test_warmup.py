@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+from llm_to_matrix.errors import LLMError
+from llm_to_matrix.warmup import ModelWarmer
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+def make_warmer(**kwargs) -> ModelWarmer:
+    llm = Mock()
+    llm.load = Mock(side_effect=lambda model, keep_alive: make_awaitable(None))
+    return ModelWarmer(llm, keep_alive=300, hot_keep_alive=-1, **kwargs)
+
+
+class ModelWarmerTestCase(unittest.TestCase):
+    def test_keep_alive(self):
+        """Tests that the most used models are kept loaded for longer"""
+        warmer = make_warmer(hot_models=1)
+        for model in ("mistral", "mistral", "llama"):
+            warmer.observe(warmer.prepare({"model": model}), {})
+
+        self.assertEqual(warmer.prepare({"model": "mistral"})["keep_alive"], -1)
+        self.assertEqual(warmer.prepare({"model": "llama"})["keep_alive"], 300)
+        self.assertEqual(
+            warmer.prepare({"model": "llama", "keep_alive": 0})["keep_alive"], 0
+        )
+
+    def test_cold_starts(self):
+        """Tests that generations that waited for their model are counted"""
+        warmer = make_warmer()
+        warmer.observe({"model": "mistral"}, {"load_duration": 4 * 10 ** 9})
+        warmer.observe({"model": "mistral"}, {"load_duration": 3 * 10 ** 6})
+        self.assertEqual(
+            warmer.stats(), {"cold_starts": 1, "warm_starts": 1, "preloads": 0}
+        )
+
+    def test_warm(self):
+        """Tests that models are only loaded if they aren't expected to be loaded"""
+        warmer = make_warmer()
+        warmer.observe({"model": "mistral", "keep_alive": 300}, {})
+
+        async def warm():
+            warmer.warm("mistral")
+            warmer.warm("llama")
+            warmer.warm("llama")
+            warmer.warm(None)
+            await asyncio.gather(*warmer._tasks)
+
+        run_coroutine(warm())
+        warmer.llm.load.assert_called_once_with("llama", 300)
+        self.assertEqual(warmer.preloads, 1)
+
+    def test_preload(self):
+        """Tests that each model is loaded once at startup, even if loading fails"""
+        warmer = make_warmer()
+        warmer.llm.load = Mock(side_effect=LLMError("not found"))
+        run_coroutine(warmer.preload(["mistral", None, "llama", "mistral"]))
+        self.assertEqual(warmer.llm.load.call_count, 2)
+        self.assertEqual(warmer.preloads, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()